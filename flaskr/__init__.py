@@ -1,6 +1,12 @@
-from flask import Flask, send_from_directory
+from flask import Flask, Response, send_from_directory, request, g
 from . import controller
+from . import compaction
+from . import storage
+from . import metrics
+from . import tracing
 import logging
+import time
+import click
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,4 +25,48 @@ def create_app(test_config=None):
     def swagger_schema(path):
         return send_from_directory('api', path)
 
+    @app.route('/metrics')
+    def metrics_endpoint():
+        body, content_type = metrics.exposition()
+        return Response(body, mimetype=content_type)
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.request_span = tracing.start_request(request.method, route, request.headers)
+
+    @app.after_request
+    def record_request(response):
+        g.request_recorded = True
+        g.response_status = response.status_code
+        route = request.url_rule.rule if request.url_rule is not None else None
+        metrics.observe_request(request.method, route, response.status_code, g.request_started)
+        return response
+
+    @app.teardown_request
+    def record_failed_request(error):
+        # Unhandled errors skip after_request
+        if error is not None and 'request_started' in g and 'request_recorded' not in g:
+            route = request.url_rule.rule if request.url_rule is not None else None
+            metrics.observe_request(request.method, route, 500, g.request_started)
+        if 'request_span' in g:
+            tracing.end_request(*g.request_span, g.get('response_status', 500))
+
+    @app.cli.command('migrate-events')
+    def migrate_events():
+        migrated = storage.migrate_events_layout()
+        click.echo(f'Migrated events for {migrated} users')
+
+    @app.cli.command('compact-events')
+    def compact_events():
+        report = compaction.run()
+        click.echo(f"Archived {report['events']} events ({report['bytes']} bytes) of {report['users']} users")
+
+    @app.cli.command('migrate-users')
+    def migrate_users():
+        migrated = storage.migrate_users_layout()
+        click.echo(f'Migrated Google refresh tokens for {migrated} users')
+
+    tracing.configure()
     return app
\ No newline at end of file
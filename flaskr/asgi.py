@@ -0,0 +1,206 @@
+from quart import Quart, Blueprint, request, Response, send_from_directory, g, make_response
+from . import async_service
+from . import auth
+from . import notifications
+from . import storage
+from . import metrics
+from . import tracing
+from . import utils
+import asyncio
+import logging
+import time
+import os
+import json
+
+bp = Blueprint('planner', __name__)
+logger = logging.getLogger(__name__)
+
+
+@bp.before_request
+async def authenticate():
+    auth_token = request.cookies.get('authToken')
+    claims = auth.verify(auth_token) if auth_token is not None else None
+    if claims is None:
+        resp = json.dumps({'message': 'Unauthorized'})
+        return Response(resp, status=401, mimetype='application/json')
+    g.username = claims['username']
+    g.plan = claims.get('plan', 'base')
+    logger.info(f'Processing request for user {g.username}')
+
+
+@bp.route('/events', methods=['GET', 'POST', 'PUT'])
+async def event():
+    username = g.username
+
+    if request.method == 'POST':
+        body = await request.get_json()
+        is_valid, message = utils.validate_event(body, 'POST')
+        if not is_valid:
+            resp = json.dumps({'message': message})
+            return Response(resp, status=400, mimetype='application/json')
+        created, message, *error_code = await async_service.create_event(username, body)
+        if not created:
+            resp = json.dumps({'message': message})
+            if len(error_code) == 0:
+                return Response(resp, status=400, mimetype='application/json')
+            return Response(resp, status=error_code[0], mimetype='application/json')
+        return Response(None, status=201)
+
+    elif request.method == 'GET':
+        is_valid, query_or_message = utils.validate_events_query(request.args)
+        if not is_valid:
+            resp = json.dumps({'message': query_or_message})
+            return Response(resp, status=400, mimetype='application/json')
+        etag, events = await async_service.cached_events(username, request.query_string.decode(), query_or_message)
+        if type(events) is str:
+            resp = json.dumps({'message': events})
+            return Response(resp, status=500, mimetype='application/json')
+        if request.if_none_match.contains(etag):
+            response = Response(None, status=304)
+        else:
+            response = await make_response(events)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    elif request.method == 'PUT':
+        modified_event = await request.get_json()
+        is_valid, message = utils.validate_event(modified_event, 'PUT')
+        if not is_valid:
+            resp = json.dumps({'message': message})
+            return Response(resp, status=400, mimetype='application/json')
+        modified, message, *status_code = await async_service.update_event(username, modified_event)
+        if not modified:
+            resp = json.dumps({'message': message})
+            if len(status_code) == 0:
+                return Response(resp, status=400, mimetype='application/json')
+            return Response(resp, status=status_code[0], mimetype='application/json')
+        if len(status_code) == 0:
+            return Response(None, status=200)
+        return Response(None, status=status_code[0])
+
+
+@bp.route('/events/batch', methods=['POST'])
+async def batch_events():
+    username = g.username
+
+    is_valid, operations_or_message = utils.validate_batch(await request.get_json())
+    if not is_valid:
+        resp = json.dumps({'message': operations_or_message})
+        return Response(resp, status=400, mimetype='application/json')
+    results = await async_service.apply_batch(username, operations_or_message)
+    return Response(json.dumps({'results': results}), status=200, mimetype='application/json')
+
+
+@bp.route('/events/stream', methods=['GET'])
+async def stream_events():
+    username = g.username
+
+    async def generate():
+        loop = asyncio.get_event_loop()
+        subscription = notifications.subscribe(notifications.AsyncSubscription(username, loop))
+        try:
+            yield ': connected\n\n'
+            while True:
+                yield notifications.server_sent_event(await subscription.get(notifications.HEARTBEAT))
+        finally:
+            notifications.unsubscribe(subscription)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(generate(), mimetype='text/event-stream', headers=headers)
+    response.timeout = None
+    return response
+
+
+@bp.route('/events/<id>', methods=['DELETE'])
+async def delete_event(id):
+    username = g.username
+
+    deleted, message, *status_code = await async_service.delete_event(username, id)
+    if not deleted:
+        resp = json.dumps({'message': message})
+        return Response(resp, status=status_code[0], mimetype='application/json')
+    return Response(None, status=204)
+
+
+@bp.route('/events/sync', methods=['POST'])
+async def login_with_google():
+    username = g.username
+
+    if g.plan == "base":
+        resp = json.dumps({'message': 'Unauthorized'})
+        return Response(resp, status=401, mimetype='application/json')
+
+    body = await request.get_json()
+    is_valid, refresh_token_or_message = utils.validate_refresh_token(body)
+    if not is_valid:
+        resp = json.dumps({'message': refresh_token_or_message})
+        return Response(resp, status=400, mimetype='application/json')
+    await async_service.login_with_google(username, refresh_token_or_message)
+    return Response(None, status=200)
+
+
+@bp.route('/events/sync-all', methods=['POST'])
+async def sync_all_events():
+    username = g.username
+
+    synced, result, *error_code = await async_service.sync_all_events(username)
+    if not synced:
+        resp = json.dumps({'message': result})
+        if len(error_code) == 0:
+            return Response(resp, status=400, mimetype='application/json')
+        return Response(resp, status=error_code[0], mimetype='application/json')
+    return Response(json.dumps(result), status=200, mimetype='application/json')
+
+
+@bp.route('/events/logout', methods=['GET'])
+async def logout_from_google():
+    username = g.username
+
+    await async_service.logout_from_google(username)
+    return Response(None, status=200)
+
+
+def create_asgi_app():
+    app = Quart(__name__)
+    app.config.from_mapping(
+        SECRET_KEY='dev',
+    )
+    app.register_blueprint(bp, url_prefix='/api/v1')
+
+    @app.route('/')
+    async def health_check():
+        return 'The Planner API is running!'
+
+    @app.route('/docs/<path:path>')
+    async def swagger_schema(path):
+        return await send_from_directory(os.path.join(app.root_path, 'api'), path)
+
+    @app.route('/metrics')
+    async def metrics_endpoint():
+        body, content_type = metrics.exposition()
+        return Response(body, mimetype=content_type)
+
+    @app.before_request
+    async def start_timer():
+        g.request_started = time.perf_counter()
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.request_span = tracing.start_request(request.method, route, request.headers)
+
+    @app.after_request
+    async def record_request(response):
+        route = request.url_rule.rule if request.url_rule is not None else None
+        metrics.observe_request(request.method, route, response.status_code, g.request_started)
+        tracing.end_request(*g.request_span, response.status_code)
+        return response
+
+    @app.after_serving
+    async def close_clients():
+        await async_service.close_client()
+        await async_service.run_blocking(storage.flush_writes)
+
+    tracing.configure()
+    return app
+
+
+# hypercorn flaskr.asgi:app
+app = create_asgi_app()
@@ -0,0 +1,250 @@
+from circuitbreaker import CircuitBreakerError
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from . import event_store
+from . import firebase_client
+from . import service
+from . import storage
+from . import recipes
+from . import metrics
+from . import tracing
+from . import utils
+import contextvars
+import functools
+import asyncio
+import logging
+import httpx
+import time
+import os
+
+load_dotenv()
+BLOCKING_WORKERS = int(os.getenv('ASYNC_BLOCKING_WORKERS', '16'))
+
+logger = logging.getLogger(__name__)
+
+# Writes and Google calls use blocking client libraries and run here
+executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='blocking')
+client = None
+client_loop = None
+inflight = {}
+
+
+def get_client():
+    global client, client_loop
+    loop = asyncio.get_event_loop()
+    if client is None or client_loop is not loop:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=utils.HTTP_POOL_SIZE, max_keepalive_connections=utils.HTTP_POOL_SIZE),
+            timeout=httpx.Timeout(utils.HTTP_READ_TIMEOUT, connect=utils.HTTP_CONNECT_TIMEOUT),
+            transport=httpx.AsyncHTTPTransport(retries=utils.HTTP_RETRIES)
+        )
+        client_loop = loop
+    return client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+async def run_blocking(function, *args):
+    # Runs in a copy of the caller's context, so spans opened there belong to the request's trace
+    loop = asyncio.get_event_loop()
+    call = functools.partial(contextvars.copy_context().run, function, *args)
+    return await loop.run_in_executor(executor, call)
+
+
+async def communicate(method, url, body=None, not_found=None):
+    # Same contract as utils.communicate
+    circuit = utils.communicate_circuit
+    if circuit.opened:
+        raise CircuitBreakerError(circuit)
+    with circuit, metrics.observe('recipes', method):
+        response = await get_client().request(method, url, json=body, headers=tracing.outgoing_headers())
+    if response.status_code >= 500:
+        metrics.count_error('recipes', method)
+    if response.status_code == 200:
+        return response.json()
+    if not_found is not None and response.status_code not in not_found:
+        raise httpx.HTTPStatusError(f'{response.status_code} from {method} {url}',
+                                    request=response.request, response=response)
+
+
+async def fetch_recipe(recipe_id):
+    return await communicate('GET', recipes.recipe_url(recipe_id), None, not_found=recipes.NOT_FOUND)
+
+
+async def fetch_batch(recipe_ids):
+    found = {}
+    for start in range(0, len(recipe_ids), recipes.BATCH_SIZE):
+        chunk = recipe_ids[start:start + recipes.BATCH_SIZE]
+        response = await communicate('POST', "".join([recipes.RECIPES_URL, recipes.BATCH_PATH]), {'ids': chunk},
+                                     not_found=recipes.BATCH_NOT_FOUND)
+        if response is None:
+            logger.warning("Recipes batch endpoint unavailable, falling back to single lookups")
+            recipes.batch_unavailable_until = time.monotonic() + recipes.BATCH_RETRY_AFTER
+            return None
+        for recipe in response:
+            found[recipe['_id']] = recipe
+    return {recipe_id: found.get(recipe_id) for recipe_id in recipe_ids}
+
+
+async def fetch_recipes(recipe_ids):
+    if len(recipe_ids) == 1:
+        return {recipe_ids[0]: await fetch_recipe(recipe_ids[0])}
+    if recipes.batch_unavailable_until < time.monotonic():
+        fetched = await fetch_batch(recipe_ids)
+        if fetched is not None:
+            return fetched
+    fetched = await asyncio.gather(*[fetch_recipe(recipe_id) for recipe_id in recipe_ids])
+    return dict(zip(recipe_ids, fetched))
+
+
+def settle_recipes(recipe_ids, task):
+    # Runs when a lookup task finishes, even if the request that started it has gone away
+    if task.cancelled():
+        error = RuntimeError('Recipe lookup cancelled')
+    else:
+        error = task.exception()
+    for recipe_id in recipe_ids:
+        future = inflight.pop(recipe_id)
+        if error is not None:
+            future.set_exception(error)
+            # Only waiting tasks need to see it
+            future.exception()
+        else:
+            recipe = task.result()[recipe_id]
+            recipes.cache.set(recipe_id, recipe)
+            future.set_result(recipe)
+
+
+async def get_recipes(recipe_ids):
+    # Same contract and cache as recipes.get_recipes, coalescing lookups across tasks. The lookup
+    # runs in its own task, so cancelling the request that started it doesn't cancel the others
+    loop = asyncio.get_event_loop()
+    detailed_recipes = {}
+    owned = []
+    waiting = {}
+    for recipe_id in dict.fromkeys(recipe_ids):
+        found, recipe = recipes.cache.get(recipe_id)
+        if found:
+            detailed_recipes[recipe_id] = recipe
+        elif recipe_id in inflight:
+            waiting[recipe_id] = inflight[recipe_id]
+        else:
+            inflight[recipe_id] = loop.create_future()
+            owned.append(recipe_id)
+
+    if len(owned) > 0:
+        task = asyncio.ensure_future(fetch_recipes(owned))
+        task.add_done_callback(functools.partial(settle_recipes, owned))
+        fetched = await asyncio.shield(task)
+        for recipe_id in owned:
+            detailed_recipes[recipe_id] = fetched[recipe_id]
+
+    for recipe_id, future in waiting.items():
+        detailed_recipes[recipe_id] = await asyncio.shield(future)
+    return detailed_recipes
+
+
+async def firebase_get(path, params=None):
+    # Same timeouts and circuit breaker as the blocking FirebaseClient
+    circuit = firebase_client.firebase_circuit
+    if circuit.opened:
+        raise CircuitBreakerError(circuit)
+    timeout = httpx.Timeout(firebase_client.FIREBASE_READ_TIMEOUT, connect=firebase_client.FIREBASE_CONNECT_TIMEOUT)
+    with circuit, metrics.observe('firebase', 'GET'):
+        response = await get_client().get(storage.database_endpoint(path), params=params, timeout=timeout)
+        if response.status_code >= 500:
+            response.raise_for_status()
+    response.raise_for_status()
+    return response.json()
+
+
+async def read_events(username, start=None, end=None, limit=None):
+    if storage.BACKEND != 'firebase' or storage.write_buffer is not None:
+        return await run_blocking(storage.get_events, username, start, end, limit)
+    path = f'{storage.EVENTS_PATH}/{username}'
+    try:
+        events = await firebase_get(path, storage.events_query(start, end, limit))
+    except httpx.HTTPStatusError as error:
+        if not storage.missing_index(error.response):
+            raise
+        logger.warning('Database rules lack ".indexOn": "timestamp" on /events/$username, filtering events here')
+        return storage.filter_events(event_store.parse_events(await firebase_get(path)), start, end, limit)
+    return event_store.parse_events(events)
+
+
+async def check_user_logged_in(username):
+    found, refresh_token = storage.tokens_cache.get(username)
+    if not found and storage.BACKEND != 'firebase':
+        return await run_blocking(storage.get_refresh_token, username)
+    if not found:
+        refresh_token = await firebase_get(f'{storage.USERS_PATH}/{username}')
+        storage.tokens_cache.set(username, refresh_token)
+    return refresh_token
+
+
+async def get_events(username, query):
+    my_events, is_logged = await asyncio.gather(read_events(username, *service.events_window(query)),
+                                                check_user_logged_in(username))
+    my_events, next_cursor = service.events_page(my_events, query)
+    try:
+        detailed_recipes = await get_recipes([event['recipe'] for event in my_events])
+    except Exception:
+        logger.error("Failed to communicate with recipes service")
+        return "Failed to communicate with recipes service"
+    return service.events_response(my_events, detailed_recipes, is_logged, next_cursor)
+
+
+async def read_version(username):
+    # Same as storage.version
+    if storage.BACKEND != 'firebase':
+        return await run_blocking(storage.version, username)
+    try:
+        stored = await firebase_get(f'{storage.VERSIONS_PATH}/{username}')
+    except Exception:
+        logger.exception(f'Failed to read version of {username}')
+        return None
+    return stored or 0, storage.local_version(username)
+
+
+async def cached_events(username, query_key, query):
+    version = await read_version(username)
+    found, entry = service.events_cache.get((username, query_key)) if version is not None else (False, None)
+    if found and entry['version'] == version:
+        return entry['etag'], entry['response']
+    response = await get_events(username, query)
+    if type(response) is str:
+        return None, response
+    return service.cache_events(username, query_key, version, response), response
+
+
+async def create_event(username, body):
+    return await run_blocking(service.create_event, username, body)
+
+
+async def update_event(username, modified_event):
+    return await run_blocking(service.update_event, username, modified_event)
+
+
+async def delete_event(username, id):
+    return await run_blocking(service.delete_event, username, id)
+
+
+async def apply_batch(username, operations):
+    return await run_blocking(service.apply_batch, username, operations)
+
+
+async def sync_all_events(username):
+    return await run_blocking(service.sync_all_events, username)
+
+
+async def login_with_google(username, refresh_token):
+    return await run_blocking(service.login_with_google, username, refresh_token)
+
+
+async def logout_from_google(username):
+    return await run_blocking(service.logout_from_google, username)
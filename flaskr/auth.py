@@ -0,0 +1,37 @@
+from dotenv import load_dotenv
+from . import utils
+import hashlib
+import logging
+import time
+import jwt
+import os
+
+load_dotenv()
+JWT_SECRET = os.getenv('JWT_SECRET')
+CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '300'))
+CACHE_MAX_ENTRIES = int(os.getenv('AUTH_CACHE_MAX_ENTRIES', '4096'))
+
+logger = logging.getLogger(__name__)
+
+# sha256 of the token -> its verified claims. Invalid tokens are never cached
+verified_tokens = utils.TTLCache(CACHE_TTL, 0, CACHE_MAX_ENTRIES)
+
+
+def verify(auth_token):
+    # Returns the claims of a valid token with a username, or None
+    key = hashlib.sha256(auth_token.encode()).hexdigest()
+    found, claims = verified_tokens.get(key)
+    if found:
+        return claims
+    try:
+        claims = jwt.decode(auth_token, JWT_SECRET, algorithms=['HS256'])
+    except jwt.InvalidTokenError as error:
+        logger.info(f'Rejected auth token: {error}')
+        return None
+    if 'username' not in claims:
+        return None
+    ttl = CACHE_TTL
+    if 'exp' in claims:
+        ttl = min(ttl, claims['exp'] - time.time())
+    verified_tokens.set(key, claims, ttl)
+    return claims
@@ -0,0 +1,103 @@
+# Minimal stand-in for a pub/sub broker such as Redis: every newline-delimited JSON message
+# a client sends is relayed to all the other connected clients.
+#
+#   python -m flaskr.broker --port 7070
+import socketserver
+import threading
+import argparse
+import logging
+import socket
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1
+
+
+class RelayHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        with self.server.clients_lock:
+            self.server.clients.add(self)
+        try:
+            for line in self.rfile:
+                self.server.relay(self, line)
+        finally:
+            with self.server.clients_lock:
+                self.server.clients.discard(self)
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, RelayHandler)
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+
+    def relay(self, sender, line):
+        with self.clients_lock:
+            receivers = [client for client in self.clients if client is not sender]
+        for client in receivers:
+            try:
+                client.wfile.write(line)
+            except OSError:
+                logger.info('Dropped message for a disconnected client')
+
+
+class BrokerClient:
+    # Keeps one connection to the broker, reconnecting when it drops. Messages published
+    # while disconnected are lost, like with Redis pub/sub
+
+    def __init__(self, host, port, on_message):
+        self.address = (host, port)
+        self.on_message = on_message
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.listen, name='broker', daemon=True).start()
+
+    def publish(self, message):
+        line = (json.dumps(message) + '\n').encode()
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.sendall(line)
+            except OSError as error:
+                logger.warning(f'Failed to publish to the broker: {error}')
+
+    def listen(self):
+        while True:
+            try:
+                connection = socket.create_connection(self.address)
+            except OSError as error:
+                logger.warning(f'Failed to connect to the broker: {error}')
+                time.sleep(RECONNECT_DELAY)
+                continue
+            with self.lock:
+                self.connection = connection
+            try:
+                for line in connection.makefile('rb'):
+                    try:
+                        self.on_message(json.loads(line))
+                    except Exception:
+                        logger.exception('Failed to handle a broker message')
+            except OSError:
+                pass
+            with self.lock:
+                self.connection = None
+            connection.close()
+            time.sleep(RECONNECT_DELAY)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=7070)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    Broker((args.host, args.port)).serve_forever()
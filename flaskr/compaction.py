@@ -0,0 +1,57 @@
+from dotenv import load_dotenv
+from . import storage
+import logging
+import json
+import time
+import os
+
+load_dotenv()
+# Runs through `flask --app flaskr compact-events`, scheduled by the chart's CronJob
+HORIZON_DAYS = float(os.getenv('COMPACTION_HORIZON_DAYS', '30'))
+BATCH_SIZE = int(os.getenv('COMPACTION_BATCH_SIZE', '100'))
+
+logger = logging.getLogger(__name__)
+
+
+def compact_user(username, horizon):
+    # Copies events older than horizon to the archive, then removes them with a conditional write.
+    # Returns (events, bytes) archived
+    old_events = list(storage.get_events(username, end=horizon))
+    if len(old_events) == 0:
+        return 0, 0
+    for start in range(0, len(old_events), BATCH_SIZE):
+        batch = old_events[start:start + BATCH_SIZE]
+        storage.archive_events(username, {event['id']: event for event in batch})
+
+    def remove_archived(my_events):
+        removed = []
+        for event in old_events:
+            current = my_events.get(event['id'])
+            if current is not None and int(current['timestamp']) <= horizon:
+                removed.append(my_events.remove(event['id']))
+        return len(removed) > 0, removed
+    removed = storage.update_events(username, remove_archived)
+
+    # Events moved to the future while being archived stay in the planner only
+    removed_ids = {event['id'] for event in removed}
+    restored = {event['id']: None for event in old_events if event['id'] not in removed_ids}
+    if len(restored) > 0:
+        storage.archive_events(username, restored)
+    return len(removed), sum(len(json.dumps(event)) for event in removed)
+
+
+def run():
+    horizon = int(time.time() - HORIZON_DAYS * 86400)
+    report = {'users': 0, 'events': 0, 'bytes': 0}
+    for username in storage.list_event_owners():
+        try:
+            events, size = compact_user(username, horizon)
+        except Exception:
+            logger.exception(f'Failed to compact events of {username}')
+            continue
+        if events > 0:
+            report['users'] += 1
+            report['events'] += events
+            report['bytes'] += size
+    logger.info(f"Archived {report['events']} events ({report['bytes']} bytes) of {report['users']} users")
+    return report
@@ -1,28 +1,31 @@
-from flask import Blueprint, request, Response
-from dotenv import load_dotenv
+from flask import Blueprint, request, Response, g, make_response
 from . import service
+from . import auth
+from . import notifications
 import logging
-import jwt
-import os
 from . import utils
 import json
 
 bp = Blueprint('planner', __name__)
 logger = logging.getLogger(__name__)
-load_dotenv()
-JWT_SECRET = os.getenv('JWT_SECRET')
 
 
-@bp.route('/events', methods=['GET', 'POST', 'PUT'])
-def event():
+@bp.before_request
+def authenticate():
     auth_token = request.cookies.get('authToken')
-    if auth_token is None:
+    claims = auth.verify(auth_token) if auth_token is not None else None
+    if claims is None:
         resp = json.dumps({'message': 'Unauthorized'})
         return Response(resp, status=401, mimetype='application/json')
-    encoded_jwt = jwt.decode(auth_token, JWT_SECRET, algorithms=['HS256'])
-    username = encoded_jwt['username']
-    logger.info(f'Processing request for user {username}')
-    
+    g.username = claims['username']
+    g.plan = claims.get('plan', 'base')
+    logger.info(f'Processing request for user {g.username}')
+
+
+@bp.route('/events', methods=['GET', 'POST', 'PUT'])
+def event():
+    username = g.username
+
     if request.method == 'POST':
         body = request.get_json()
         is_valid, message = utils.validate_event(body, 'POST')
@@ -38,11 +41,21 @@ def event():
         return Response(None, status=201)
 
     elif request.method == 'GET':
-        events = service.get_events(username)
+        is_valid, query_or_message = utils.validate_events_query(request.args)
+        if not is_valid:
+            resp = json.dumps({'message': query_or_message})
+            return Response(resp, status=400, mimetype='application/json')
+        etag, events = service.cached_events(username, request.query_string.decode(), query_or_message)
         if type(events) is str:
             resp = json.dumps({'message': events})
             return Response(resp, status=500, mimetype='application/json')
-        return events
+        if request.if_none_match.contains(etag):
+            response = Response(None, status=304)
+        else:
+            response = make_response(events)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
 
     elif request.method == 'PUT':
         modified_event = request.get_json()
@@ -50,40 +63,68 @@ def event():
         if not is_valid:
             resp = json.dumps({'message': message})
             return Response(resp, status=400, mimetype='application/json')
-        modified, message, *error_code = service.update_event(username, modified_event)
+        modified, message, *status_code = service.update_event(username, modified_event)
         if not modified:
             resp = json.dumps({'message': message})
-            if len(error_code) == 0:
+            if len(status_code) == 0:
                 return Response(resp, status=400, mimetype='application/json')
-            return Response(resp, status=error_code[0], mimetype='application/json')
-        return Response(None, status=200)
+            return Response(resp, status=status_code[0], mimetype='application/json')
+        if len(status_code) == 0:
+            return Response(None, status=200)
+        return Response(None, status=status_code[0])
+
+
+@bp.route('/events/batch', methods=['POST'])
+def batch_events():
+    username = g.username
+
+    is_valid, operations_or_message = utils.validate_batch(request.get_json())
+    if not is_valid:
+        resp = json.dumps({'message': operations_or_message})
+        return Response(resp, status=400, mimetype='application/json')
+    results = service.apply_batch(username, operations_or_message)
+    return Response(json.dumps({'results': results}), status=200, mimetype='application/json')
+
+
+@bp.route('/events/stream', methods=['GET'])
+def stream_events():
+    username = g.username
+
+    if not notifications.acquire_blocking_stream():
+        resp = json.dumps({'message': 'Too many open streams, try again later'})
+        return Response(resp, status=503, mimetype='application/json', headers={'Retry-After': '30'})
+
+    def generate():
+        subscription = notifications.subscribe(notifications.Subscription(username))
+        try:
+            yield ': connected\n\n'
+            while True:
+                yield notifications.server_sent_event(subscription.get(notifications.HEARTBEAT))
+        finally:
+            notifications.unsubscribe(subscription)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(generate(), mimetype='text/event-stream', headers=headers)
+    # Also runs when the client goes away before the stream starts
+    response.call_on_close(notifications.release_blocking_stream)
+    return response
 
 
 @bp.route('/events/<id>', methods=['DELETE'])
 def delete_event(id):
-    auth_token = request.cookies.get('authToken')
-    if auth_token is None:
-        return Response(None, status=401)
-    encoded_jwt = jwt.decode(auth_token, JWT_SECRET, algorithms=['HS256'])
-    username = encoded_jwt['username']
-    logger.info(f'Processing request for user {username}')
+    username = g.username
 
-    service.delete_event(username, id)
+    deleted, message, *status_code = service.delete_event(username, id)
+    if not deleted:
+        resp = json.dumps({'message': message})
+        return Response(resp, status=status_code[0], mimetype='application/json')
     return Response(None, status=204)
 
 
 @bp.route('/events/sync', methods=['POST'])
 def login_with_google():
-    auth_token = request.cookies.get('authToken')
-    if auth_token is None:
-        resp = json.dumps({'message': 'Unauthorized'})
-        return Response(resp, status=401, mimetype='application/json')
-    encoded_jwt = jwt.decode(auth_token, JWT_SECRET, algorithms=['HS256'])
-    username = encoded_jwt['username']
-    logger.info(f'Processing request for user {username}')
+    username = g.username
 
-    plan_selected = encoded_jwt['plan']
-    if plan_selected == "base":
+    if g.plan == "base":
         resp = json.dumps({'message': 'Unauthorized'})
         return Response(resp, status=401, mimetype='application/json')
 
@@ -96,15 +137,22 @@ def login_with_google():
     return Response(None, status=200)
 
 
+@bp.route('/events/sync-all', methods=['POST'])
+def sync_all_events():
+    username = g.username
+
+    synced, result, *error_code = service.sync_all_events(username)
+    if not synced:
+        resp = json.dumps({'message': result})
+        if len(error_code) == 0:
+            return Response(resp, status=400, mimetype='application/json')
+        return Response(resp, status=error_code[0], mimetype='application/json')
+    return Response(json.dumps(result), status=200, mimetype='application/json')
+
+
 @bp.route('/events/logout', methods=['GET'])
 def logout_from_google():
-    auth_token = request.cookies.get('authToken')
-    if auth_token is None:
-        resp = json.dumps({'message': 'Unauthorized'})
-        return Response(resp, status=401, mimetype='application/json')
-    encoded_jwt = jwt.decode(auth_token, JWT_SECRET, algorithms=['HS256'])
-    username = encoded_jwt['username']
-    logger.info(f'Processing request for user {username}')
+    username = g.username
 
     service.logout_from_google(username)
     return Response(None, status=200)
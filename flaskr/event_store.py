@@ -0,0 +1,70 @@
+from bisect import bisect_left, insort
+import time
+
+
+class UserEvents:
+    # A user's events by id, plus (timestamp, id) pairs kept sorted for time range queries.
+    # Timestamps must be changed through set_timestamp so both indexes stay in step.
+
+    def __init__(self, events=()):
+        self.by_id = {}
+        self.by_time = []
+        for event in events:
+            self.add(event)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __contains__(self, event_id):
+        return event_id in self.by_id
+
+    def get(self, event_id):
+        return self.by_id.get(event_id)
+
+    def add(self, event):
+        self.remove(event['id'])
+        self.by_id[event['id']] = event
+        insort(self.by_time, (int(event['timestamp']), event['id']))
+
+    def remove(self, event_id):
+        event = self.by_id.pop(event_id, None)
+        if event is not None:
+            del self.by_time[bisect_left(self.by_time, (int(event['timestamp']), event_id))]
+        return event
+
+    def set_timestamp(self, event_id, timestamp):
+        event = self.remove(event_id)
+        event['timestamp'] = timestamp
+        self.add(event)
+
+    def between(self, start=None, end=None):
+        # Events with start <= timestamp <= end, oldest first
+        low = 0 if start is None else bisect_left(self.by_time, (int(start),))
+        high = len(self.by_time) if end is None else bisect_left(self.by_time, (int(end) + 1,))
+        return [self.by_id[event_id] for _, event_id in self.by_time[low:high]]
+
+    def upcoming(self):
+        return self.between(start=int(time.time()))
+
+    def to_map(self):
+        return dict(self.by_id)
+
+
+def is_map_layout(events):
+    # Events used to be stored as an array, which Firebase may return as an index-keyed object
+    return isinstance(events, dict) and all(
+        isinstance(event, dict) and event.get('id') == event_id for event_id, event in events.items()
+    )
+
+
+def parse_events(events):
+    if events is None:
+        return UserEvents()
+    if is_map_layout(events):
+        return UserEvents(events.values())
+    if isinstance(events, dict):
+        events = [events[key] for key in sorted(events, key=int)]
+    return UserEvents(event for event in events if event is not None)
@@ -0,0 +1,176 @@
+from circuitbreaker import circuit
+from dotenv import load_dotenv
+from . import metrics
+from . import utils
+import threading
+import requests
+import codecs
+import json
+import os
+
+load_dotenv()
+FIREBASE_POOL_SIZE = int(os.getenv('FIREBASE_POOL_SIZE', str(utils.HTTP_POOL_SIZE)))
+FIREBASE_CONNECT_TIMEOUT = float(os.getenv('FIREBASE_CONNECT_TIMEOUT', str(utils.HTTP_CONNECT_TIMEOUT)))
+FIREBASE_READ_TIMEOUT = float(os.getenv('FIREBASE_READ_TIMEOUT', str(utils.HTTP_READ_TIMEOUT)))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Same settings as the breaker on utils.communicate, shared with the async client
+firebase_circuit = circuit(failure_threshold=3, recovery_timeout=10, name='firebase')
+metrics.watch_circuit(firebase_circuit)
+
+
+class FirebaseClient:
+    # Realtime Database REST API over keep-alive connections pooled per process. Sessions are per
+    # thread but share the pool. Responses come gzipped, and server errors count against the breaker
+
+    def __init__(self, database_url):
+        self.database_url = database_url.rstrip('/')
+        self.adapter = utils.create_adapter(FIREBASE_POOL_SIZE)
+        self.local = threading.local()
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip'
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self.local.session = session
+        return session
+
+    def endpoint(self, path):
+        return "".join([self.database_url, path, '.json'])
+
+    @firebase_circuit
+    def request(self, method, path, body=None, headers=None, params=None, timeout=None, stream=False):
+        timeout = timeout or (FIREBASE_CONNECT_TIMEOUT, FIREBASE_READ_TIMEOUT)
+        with metrics.observe('firebase', method):
+            response = self.session().request(method, self.endpoint(path), json=body, headers=headers,
+                                              params=params, timeout=timeout, stream=stream)
+            if response.status_code >= 500:
+                response.close()
+                response.raise_for_status()
+        return response
+
+    # get, put and delete take the same arguments as python-firebase's FirebaseApplication
+
+    def get(self, path, name=None, params=None, timeout=None):
+        response = self.request('GET', child_path(path, name), params=params, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def put(self, path, name, data, timeout=None):
+        response = self.request('PUT', child_path(path, name), data, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def patch(self, path, data, timeout=None):
+        response = self.request('PATCH', path, data, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def delete(self, path, name, timeout=None):
+        response = self.request('DELETE', child_path(path, name), timeout=timeout)
+        response.raise_for_status()
+
+    def shallow(self, path, name=None, timeout=None):
+        # Keys of the node's children, without downloading them
+        return list(self.get(path, name, params={'shallow': 'true'}, timeout=timeout) or {})
+
+    def iter_children(self, path, name=None, timeout=None):
+        # (key, value) of each child, decoded while the body streams in so a large node is never held whole
+        response = self.request('GET', child_path(path, name), timeout=timeout, stream=True)
+        try:
+            response.raise_for_status()
+            yield from iter_members(text_chunks(response))
+        finally:
+            response.close()
+
+
+def child_path(path, name):
+    if name is None:
+        return path
+    return "/".join([path.rstrip('/'), name])
+
+
+def text_chunks(response):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+NUMBER_CHARS = frozenset('0123456789.eE+-')
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def iter_members(chunks):
+    # Incremental decoder for a JSON object: yields its members as soon as each one is complete.
+    # Anything else (null, an array) is decoded whole and yielded as index -> value pairs
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+
+    def more():
+        nonlocal buffer, position
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    def peek():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\n\r':
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not more():
+                return ''
+
+    def value():
+        nonlocal position
+        peek()
+        while True:
+            try:
+                decoded, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if more():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk, even when it was
+            # cut right after a '.', 'e' or sign that ended the part decoded so far
+            if is_number(decoded) and all(char in NUMBER_CHARS for char in buffer[end:]) and more():
+                continue
+            position = end
+            return decoded
+
+    first = peek()
+    if first == '':
+        return
+    if first != '{':
+        whole = value()
+        if isinstance(whole, list):
+            yield from ((str(index), item) for index, item in enumerate(whole) if item is not None)
+        return
+    position += 1
+    if peek() == '}':
+        return
+    while True:
+        key = value()
+        if peek() != ':':
+            raise json.JSONDecodeError('Expecting ":"', buffer, position)
+        position += 1
+        yield key, value()
+        separator = peek()
+        position += 1
+        if separator == '}':
+            return
+        if separator != ',':
+            raise json.JSONDecodeError('Expecting "," or "}"', buffer, position - 1)
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from . import metrics
+from . import utils
+import threading
+import logging
+import json
+import os
+
+load_dotenv()
+SCOPES = ['https://www.googleapis.com/auth/calendar']
+TOKEN_URI = os.getenv('GOOGLE_TOKEN_URI', 'https://oauth2.googleapis.com/token')
+CLIENTS_CACHE_SIZE = int(os.getenv('CALENDAR_CLIENTS_CACHE_SIZE', '256'))
+
+logger = logging.getLogger(__name__)
+
+# username -> CalendarClient, least recently used first
+clients = OrderedDict()
+clients_lock = threading.Lock()
+discovery_document = None
+
+
+def get_discovery_document():
+    # Parsed once from the document shipped with google-api-python-client
+    global discovery_document
+    if discovery_document is None:
+        discovery_document = json.loads(discovery_cache.get_static_doc('calendar', 'v3'))
+    return discovery_document
+
+
+class CalendarClient:
+    # The underlying httplib2 connection is not thread safe, so use is serialized per user
+
+    def __init__(self, refresh_token):
+        self.refresh_token = refresh_token
+        self.credentials = Credentials(
+            token=None,
+            refresh_token=refresh_token,
+            client_id=os.getenv('CLIENT_ID'),
+            client_secret=os.getenv('CLIENT_SECRET'),
+            token_uri=TOKEN_URI,
+            scopes=SCOPES
+        )
+        self.service = None
+        self.lock = threading.Lock()
+
+    def get_service(self):
+        if not self.credentials.valid:
+            with metrics.observe('google', 'token_refresh'):
+                self.credentials.refresh(Request(utils.get_session()))
+            logger.info('Refreshed Google access token')
+        if self.service is None:
+            self.service = build_from_document(get_discovery_document(), credentials=self.credentials)
+        return self.service
+
+
+def get_client(username, refresh_token):
+    with clients_lock:
+        client = clients.get(username)
+        if client is None or client.refresh_token != refresh_token:
+            client = CalendarClient(refresh_token)
+            clients[username] = client
+        clients.move_to_end(username)
+        while len(clients) > CLIENTS_CACHE_SIZE:
+            clients.popitem(last=False)
+    return client
+
+
+def forget(username):
+    with clients_lock:
+        clients.pop(username, None)
+
+
+@contextmanager
+def calendar_service(username, refresh_token):
+    client = get_client(username, refresh_token)
+    with client.lock:
+        try:
+            service = client.get_service()
+        except Exception:
+            forget(username)
+            raise
+        yield service
@@ -0,0 +1,68 @@
+from dotenv import load_dotenv
+import threading
+import logging
+import queue
+import os
+
+load_dotenv()
+WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+RETRY_BACKOFF = float(os.getenv('JOB_RETRY_BACKOFF', '1'))
+
+logger = logging.getLogger(__name__)
+
+jobs = queue.Queue()
+workers = []
+workers_lock = threading.Lock()
+
+
+class Job:
+
+    def __init__(self, name, run, give_up=None):
+        self.name = name
+        self.run = run
+        self.give_up = give_up
+        self.attempts = 0
+
+
+def submit(name, run, give_up=None):
+    # run raises to be retried; give_up is called once every attempt has failed
+    start_workers()
+    jobs.put(Job(name, run, give_up))
+
+
+def start_workers():
+    with workers_lock:
+        while len(workers) < WORKERS:
+            worker = threading.Thread(target=work, name=f'jobs-{len(workers)}', daemon=True)
+            worker.start()
+            workers.append(worker)
+
+
+def work():
+    while True:
+        job = jobs.get()
+        try:
+            execute(job)
+        finally:
+            jobs.task_done()
+
+
+def execute(job):
+    job.attempts += 1
+    try:
+        job.run()
+    except Exception as error:
+        if job.attempts < MAX_ATTEMPTS:
+            delay = RETRY_BACKOFF * 2 ** (job.attempts - 1)
+            logger.warning(f'Job {job.name} failed ({error}), retrying in {delay}s')
+            retry = threading.Timer(delay, jobs.put, args=(job,))
+            retry.daemon = True
+            retry.start()
+        else:
+            logger.error(f'Job {job.name} failed after {job.attempts} attempts: {error}')
+            if job.give_up is not None:
+                try:
+                    job.give_up()
+                except Exception:
+                    logger.exception(f'Job {job.name} failed to give up')
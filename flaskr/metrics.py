@@ -0,0 +1,118 @@
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client import multiprocess
+from . import tracing
+import time
+import os
+
+# With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory so
+# /metrics adds up the samples of every worker instead of the one serving the scrape
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+# gunicorn.conf.py empties it on start, other servers (flask run, hypercorn) find it here
+if MULTIPROC_DIR is not None:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# Seconds, from cache hits to a slow Google batch
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+request_duration = Histogram(
+    'planner_request_duration_seconds', 'Time spent serving HTTP requests',
+    ['method', 'route', 'status'], buckets=BUCKETS
+)
+dependency_duration = Histogram(
+    'planner_dependency_duration_seconds', 'Time spent in calls to other services',
+    ['dependency', 'operation'], buckets=BUCKETS
+)
+dependency_errors = Counter(
+    'planner_dependency_errors_total', 'Calls to other services that raised an error',
+    ['dependency', 'operation']
+)
+write_conflicts = Counter(
+    'planner_storage_write_conflicts_total', 'Conditional writes of events rejected for a stale ETag'
+)
+write_retries = Counter(
+    'planner_storage_write_retries_total', 'Writes of events attempted again after a conflict'
+)
+cache_lookups = Counter(
+    'planner_cache_lookups_total', 'Lookups in in-process caches, by whether they found the key',
+    ['cache', 'result']
+)
+
+# name -> circuitbreaker.CircuitBreaker
+circuits = {}
+
+
+class CircuitCollector:
+    # Read at scrape time, the breakers keep their own state
+
+    def collect(self):
+        state = GaugeMetricFamily('planner_circuit_breaker_state', 'Whether each circuit breaker is in a state',
+                                  labels=['name', 'state'])
+        failures = GaugeMetricFamily('planner_circuit_breaker_failures', 'Consecutive failures counted by each breaker',
+                                     labels=['name'])
+        for name, circuit in circuits.items():
+            for possible_state in ('closed', 'open', 'half_open'):
+                state.add_metric([name, possible_state], 1 if circuit.state == possible_state else 0)
+            failures.add_metric([name], circuit.failure_count)
+        yield state
+        yield failures
+
+
+circuit_collector = CircuitCollector()
+REGISTRY.register(circuit_collector)
+
+
+def watch_circuit(circuit):
+    circuits[circuit.name] = circuit
+
+
+@contextmanager
+def observe(dependency, operation):
+    # Also traced as a child span of the current request
+    started = time.perf_counter()
+    try:
+        with tracing.span(f'{dependency} {operation}', dependency=dependency, operation=operation):
+            yield
+    except BaseException:
+        dependency_errors.labels(dependency, operation).inc()
+        raise
+    finally:
+        dependency_duration.labels(dependency, operation).observe(time.perf_counter() - started)
+
+
+def count_error(dependency, operation):
+    # For calls that answer with an error status instead of raising
+    dependency_errors.labels(dependency, operation).inc()
+
+
+def count_write_conflict():
+    # Every conflict is followed by a retry, unless the attempts run out
+    write_conflicts.inc()
+
+
+def count_write_retry():
+    write_retries.inc()
+
+
+def count_cache_lookup(cache, hit):
+    cache_lookups.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def observe_request(method, route, status, started):
+    request_duration.labels(method, route or 'unmatched', str(status)).observe(time.perf_counter() - started)
+
+
+def exposition():
+    # Returns (body, content type) for the /metrics endpoint
+    if MULTIPROC_DIR is None:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(circuit_collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    if MULTIPROC_DIR is not None:
+        multiprocess.mark_process_dead(pid)
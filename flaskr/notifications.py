@@ -0,0 +1,162 @@
+from dotenv import load_dotenv
+from . import broker
+import threading
+import asyncio
+import logging
+import queue
+import uuid
+import json
+import os
+
+load_dotenv()
+QUEUE_SIZE = int(os.getenv('NOTIFICATIONS_QUEUE_SIZE', '64'))
+HEARTBEAT = float(os.getenv('NOTIFICATIONS_HEARTBEAT', '15'))
+# host:port of a broker (python -m flaskr.broker) shared by every replica, unset to stay in process
+BROKER_ADDRESS = os.getenv('NOTIFICATIONS_BROKER') or None
+# Streams a WSGI worker serves at once, a quarter of its threads by default. Each one holds a gunicorn
+# thread while it is open, so this must stay well below GUNICORN_THREADS or the worker stops answering
+# other requests, health checks included. The ASGI app (hypercorn flaskr.asgi:app) holds no thread
+# per stream and has no limit
+BLOCKING_STREAMS_MAX = int(os.getenv('NOTIFICATIONS_BLOCKING_STREAMS',
+                                     str(int(os.getenv('GUNICORN_THREADS', '8')) // 4)))
+
+logger = logging.getLogger(__name__)
+
+# Sent instead of the backlog to a client that falls too far behind, which should reload its events
+RESYNC = {'type': 'resync'}
+
+# username -> set of Subscription
+subscribers = {}
+subscribers_lock = threading.Lock()
+broker_client = None
+broker_lock = threading.Lock()
+# Messages from this process come back from the broker and must not be delivered twice
+instance_id = uuid.uuid4().hex
+blocking_streams = 0
+blocking_streams_lock = threading.Lock()
+
+
+def acquire_blocking_stream():
+    # False once the worker serves BLOCKING_STREAMS_MAX streams
+    global blocking_streams
+    with blocking_streams_lock:
+        if blocking_streams >= BLOCKING_STREAMS_MAX:
+            return False
+        blocking_streams += 1
+        return True
+
+
+def release_blocking_stream():
+    global blocking_streams
+    with blocking_streams_lock:
+        blocking_streams -= 1
+
+
+class Subscription:
+    Full = queue.Full
+    Empty = queue.Empty
+
+    def __init__(self, username):
+        self.username = username
+        self.messages = queue.Queue(maxsize=QUEUE_SIZE)
+        self.lock = threading.Lock()
+
+    def push(self, message):
+        # Never blocks the publisher: a full queue is replaced by a single RESYNC
+        with self.lock:
+            try:
+                self.messages.put_nowait(message)
+            except self.Full:
+                self.drop_backlog()
+                self.messages.put_nowait(RESYNC)
+
+    def drop_backlog(self):
+        while True:
+            try:
+                self.messages.get_nowait()
+            except self.Empty:
+                return
+
+    def get(self, timeout):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    # Delivers into an asyncio queue owned by the loop serving the stream
+    Full = asyncio.QueueFull
+    Empty = asyncio.QueueEmpty
+
+    def __init__(self, username, loop):
+        super().__init__(username)
+        self.loop = loop
+        self.messages = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def push(self, message):
+        try:
+            self.loop.call_soon_threadsafe(super().push, message)
+        except RuntimeError:
+            # The loop is closed, the stream is gone
+            pass
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def server_sent_event(message):
+    if message is None:
+        return ': keep-alive\n\n'
+    return f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+
+
+def subscribe(subscription):
+    start_broker_client()
+    with subscribers_lock:
+        subscribers.setdefault(subscription.username, set()).add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    with subscribers_lock:
+        user_subscribers = subscribers.get(subscription.username, set())
+        user_subscribers.discard(subscription)
+        if len(user_subscribers) == 0:
+            subscribers.pop(subscription.username, None)
+
+
+def deliver(username, message):
+    with subscribers_lock:
+        user_subscribers = list(subscribers.get(username, ()))
+    for subscription in user_subscribers:
+        subscription.push(message)
+
+
+def publish(username, kind, event_id):
+    message = {'type': kind, 'id': event_id}
+    deliver(username, message)
+    client = start_broker_client()
+    if client is not None:
+        client.publish({'origin': instance_id, 'username': username, 'message': message})
+
+
+def receive(envelope):
+    if envelope.get('origin') != instance_id:
+        deliver(envelope['username'], envelope['message'])
+
+
+def start_broker_client():
+    # Connected lazily, so gunicorn workers connect after fork
+    global broker_client
+    if BROKER_ADDRESS is None:
+        return None
+    with broker_lock:
+        if broker_client is None:
+            host, port = BROKER_ADDRESS.rsplit(':', 1)
+            broker_client = broker.BrokerClient(host, int(port), receive)
+            broker_client.start()
+        return broker_client
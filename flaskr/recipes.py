@@ -0,0 +1,115 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+from . import utils
+import contextvars
+import threading
+import logging
+import time
+import os
+
+load_dotenv()
+RECIPES_URL = os.getenv('RECIPES_URL', 'http://recipes')
+MAX_WORKERS = int(os.getenv('RECIPES_MAX_WORKERS', '8'))
+CACHE_TTL = float(os.getenv('RECIPE_CACHE_TTL', '300'))
+CACHE_NEGATIVE_TTL = float(os.getenv('RECIPE_CACHE_NEGATIVE_TTL', '30'))
+CACHE_MAX_ENTRIES = int(os.getenv('RECIPE_CACHE_MAX_ENTRIES', '1024'))
+BATCH_PATH = os.getenv('RECIPES_BATCH_PATH', '/api/v1/recipes/batch')
+BATCH_SIZE = int(os.getenv('RECIPES_BATCH_SIZE', '100'))
+BATCH_RETRY_AFTER = float(os.getenv('RECIPES_BATCH_RETRY_AFTER', '300'))
+# Only these answers are cached as a missing recipe, any other error fails the lookup
+NOT_FOUND = (404,)
+# Answers meaning the recipes service has no batch endpoint, any other error fails the lookup
+BATCH_NOT_FOUND = (404, 405)
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='recipes')
+logger = logging.getLogger(__name__)
+
+# Lookups in flight, shared by every request waiting on the same recipe id
+inflight = {}
+inflight_lock = threading.Lock()
+batch_unavailable_until = 0
+
+
+cache = utils.TTLCache(CACHE_TTL, CACHE_NEGATIVE_TTL, CACHE_MAX_ENTRIES, name='recipes')
+
+
+def recipe_url(recipe_id):
+    return "".join([RECIPES_URL, '/api/v1/recipes/', recipe_id])
+
+
+def fetch_recipe(recipe_id):
+    return utils.communicate('GET', recipe_url(recipe_id), None, not_found=NOT_FOUND)
+
+
+def fetch_batch(recipe_ids):
+    # Returns None when the recipes service has no batch endpoint, and raises if it is failing
+    global batch_unavailable_until
+    found = {}
+    for start in range(0, len(recipe_ids), BATCH_SIZE):
+        chunk = recipe_ids[start:start + BATCH_SIZE]
+        response = utils.communicate('POST', "".join([RECIPES_URL, BATCH_PATH]), {'ids': chunk},
+                                       not_found=BATCH_NOT_FOUND)
+        if response is None:
+            logger.warning("Recipes batch endpoint unavailable, falling back to single lookups")
+            batch_unavailable_until = time.monotonic() + BATCH_RETRY_AFTER
+            return None
+        for recipe in response:
+            found[recipe['_id']] = recipe
+    return {recipe_id: found.get(recipe_id) for recipe_id in recipe_ids}
+
+
+def fetch_recipes(recipe_ids):
+    if len(recipe_ids) == 1:
+        return {recipe_ids[0]: fetch_recipe(recipe_ids[0])}
+    if batch_unavailable_until < time.monotonic():
+        fetched = fetch_batch(recipe_ids)
+        if fetched is not None:
+            return fetched
+    # Each lookup runs in a copy of this context so its span joins the request's trace
+    lookups = [executor.submit(contextvars.copy_context().run, fetch_recipe, recipe_id) for recipe_id in recipe_ids]
+    return {recipe_id: lookup.result() for recipe_id, lookup in zip(recipe_ids, lookups)}
+
+
+def release(recipe_ids):
+    with inflight_lock:
+        for recipe_id in recipe_ids:
+            inflight.pop(recipe_id, None)
+
+
+def get_recipes(recipe_ids):
+    # Returns {recipe id: recipe or None}, raising if any lookup fails
+    detailed_recipes = {}
+    owned = {}
+    waiting = {}
+    with inflight_lock:
+        for recipe_id in dict.fromkeys(recipe_ids):
+            found, recipe = cache.get(recipe_id)
+            if found:
+                detailed_recipes[recipe_id] = recipe
+            elif recipe_id in inflight:
+                waiting[recipe_id] = inflight[recipe_id]
+            else:
+                owned[recipe_id] = inflight[recipe_id] = Future()
+
+    if len(owned) > 0:
+        try:
+            fetched = fetch_recipes(list(owned))
+        except Exception as error:
+            release(owned)
+            for future in owned.values():
+                future.set_exception(error)
+            raise
+        for recipe_id in owned:
+            cache.set(recipe_id, fetched[recipe_id])
+            detailed_recipes[recipe_id] = fetched[recipe_id]
+        release(owned)
+        for recipe_id, future in owned.items():
+            future.set_result(fetched[recipe_id])
+
+    for recipe_id, future in waiting.items():
+        detailed_recipes[recipe_id] = future.result()
+    return detailed_recipes
+
+
+def get_recipe(recipe_id):
+    return get_recipes([recipe_id])[recipe_id]
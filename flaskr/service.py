@@ -1,43 +1,38 @@
 from dotenv import load_dotenv
-from firebase import firebase
 import os
 from . import utils
+from . import storage
+from . import recipes
+from . import google_calendar
+from . import jobs
+from . import notifications
+from . import metrics
 import uuid
 import os.path
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 import logging
 import datetime
+import time
 
 load_dotenv()
-database_url = os.getenv('DATABASE_URL')
-firebase = firebase.FirebaseApplication(database_url, None)
+GOOGLE_BATCH_SIZE = 50
+# Responses are checked against the user's stored version, the TTL only bounds how long one is kept
+EVENTS_CACHE_TTL = float(os.getenv('EVENTS_CACHE_TTL', '30'))
+EVENTS_CACHE_MAX_ENTRIES = int(os.getenv('EVENTS_CACHE_MAX_ENTRIES', '1024'))
+# 'async' answers PUT before syncing and syncs from the background job workers
+SYNC_MODE = os.getenv('SYNC_MODE', 'sync')
+# A pending sync is not scheduled again for this long, unless its job gave up before
+SYNC_JOB_TIMEOUT = float(os.getenv('SYNC_JOB_TIMEOUT', '300'))
+CONFLICT_MESSAGE = "Too many concurrent changes, try again later"
 
 logger = logging.getLogger(__name__)
 
-def get_firebase_events(username):
-    events = firebase.get('/events', None)
-    events_id = None
-    if events is not None:
-        events_id = list(events)[0]
-        events = events[events_id]
-    else:
-        return None, None
-    if username not in events:
-        events[username] = []
-    return events, events_id
+# (username, query string) -> hydrated GET /events response, see cached_events
+events_cache = utils.TTLCache(EVENTS_CACHE_TTL, 0, EVENTS_CACHE_MAX_ENTRIES)
 
 
 def create_event(username, body):
-    events, events_id = get_firebase_events(username)
-
-    exist_events = True
-    if events is None:
-        exist_events = False
-        events = {username: []}
-
     try:
-        detailed_recipe = utils.communicate('GET', "".join(['http://recipes/api/v1/recipes/', body['id']]), None)
+        detailed_recipe = recipes.get_recipe(body['id'])
     except:
         logger.error("Failed to communicate with recipes service")
         return False, "Failed to communicate with recipes service", 500
@@ -45,169 +40,420 @@ def create_event(username, body):
     if detailed_recipe is None:
         return False, "Recipe not found"
 
-    my_events = events[username]
     new_event = {
         "id": uuid.uuid4().hex,
         "timestamp": body["timestamp"],
         "synced": False,
         "recipe": body["id"]
     }
-    my_events.append(new_event)
-    events[username] = my_events
 
-    if not exist_events:
-        firebase.post('/events', events)
-    else:
-        firebase.put('/events', events_id, events)
+    def add_event(my_events):
+        my_events.add(new_event)
+        return True, None
+    try:
+        storage.update_events(username, add_event)
+    except storage.ConflictError:
+        return False, CONFLICT_MESSAGE, 409
 
+    notifications.publish(username, 'created', new_event['id'])
     return True, "Created event successfully"
 
-def get_events(username):
-    events, _ = get_firebase_events(username)
-    if events is None:
-        events = {username : []}
-    my_events = events[username]
+def events_window(query):
+    # The (start, end, limit) to read, enough to fill the page that follows the cursor
+    start, limit = query['from'], query['limit']
+    cursor = query['cursor']
+    if cursor is not None:
+        start = max(start, cursor['timestamp'])
+        limit += cursor['seen']
+    if limit is not None:
+        limit += 1
+    return start, query['to'], limit
+
+
+def events_page(my_events, query):
+    # Events are ordered by timestamp and then id, like Firebase orders them
+    page = my_events.between(query['from'], query['to'])
+    cursor = query['cursor']
+    if cursor is not None:
+        after = (cursor['timestamp'], cursor['id'])
+        page = [event for event in page if (int(event['timestamp']), event['id']) > after]
+    if query['limit'] is None or len(page) <= query['limit']:
+        return page, None
+    page = page[:query['limit']]
+    last_timestamp = int(page[-1]['timestamp'])
+    seen = len([event for event in page if int(event['timestamp']) == last_timestamp])
+    if cursor is not None and cursor['timestamp'] == last_timestamp:
+        seen += cursor['seen']
+    return page, utils.encode_cursor(last_timestamp, page[-1]['id'], seen)
+
+
+def events_response(my_events, detailed_recipes, is_logged, next_cursor=None):
     detailed_events = []
     for event in my_events:
-        if event is not None and datetime.datetime.fromtimestamp(int(event['timestamp'])) < datetime.datetime.now():
-            continue
-        else:
-            try:
-                detailed_recipe = utils.communicate('GET', "".join(['http://recipes/api/v1/recipes/', event['recipe']]), None)
-            except:
-                logger.error("Failed to communicate with recipes service")
-                return "Failed to communicate with recipes service"
-            if detailed_recipe is not None:
-                detailed_recipe = {
-                    "id": detailed_recipe['_id'],
-                    "name": detailed_recipe['name'],
-                    "description": " " if 'summary' not in detailed_recipe else detailed_recipe['summary'],
-                    "tags": detailed_recipe['tags'],
-                    "imageUrl": " " if 'imageUrl' not in detailed_recipe else detailed_recipe['imageUrl'],
-                }
-                detailed_event = {
-                    'id': event['id'],
-                    'timestamp': int(event['timestamp']),
-                    'synced': event['synced'],
-                    'recipe': detailed_recipe
-                }
-                detailed_events.append(detailed_event)
-    is_logged = check_user_logged_in(username)
+        detailed_recipe = detailed_recipes[event['recipe']]
+        if detailed_recipe is not None:
+            detailed_recipe = {
+                "id": detailed_recipe['_id'],
+                "name": detailed_recipe['name'],
+                "description": " " if 'summary' not in detailed_recipe else detailed_recipe['summary'],
+                "tags": detailed_recipe['tags'],
+                "imageUrl": " " if 'imageUrl' not in detailed_recipe else detailed_recipe['imageUrl'],
+            }
+            detailed_event = {
+                'id': event['id'],
+                'timestamp': int(event['timestamp']),
+                'synced': event['synced'],
+                'syncStatus': sync_status(event),
+                'recipe': detailed_recipe
+            }
+            detailed_events.append(detailed_event)
     response = {
         "isLogged": True if is_logged is not None else False, 
-        "events": detailed_events
+        "events": detailed_events,
+        "nextCursor": next_cursor
     }
     return response
 
 
+def get_events(username, query):
+    my_events, next_cursor = events_page(storage.get_events(username, *events_window(query)), query)
+    try:
+        detailed_recipes = recipes.get_recipes([event['recipe'] for event in my_events])
+    except:
+        logger.error("Failed to communicate with recipes service")
+        return "Failed to communicate with recipes service"
+    is_logged = check_user_logged_in(username)
+    return events_response(my_events, detailed_recipes, is_logged, next_cursor)
+
+
+def cached_events(username, query_key, query):
+    # Returns (etag, response), reusing the response while the user's version is unchanged
+    version = storage.version(username)
+    # Without a version there is no telling whether a cached response is current
+    found, entry = events_cache.get((username, query_key)) if version is not None else (False, None)
+    if found and entry['version'] == version:
+        return entry['etag'], entry['response']
+    response = get_events(username, query)
+    if type(response) is str:
+        return None, response
+    return cache_events(username, query_key, version, response), response
+
+
+def cache_events(username, query_key, version, response):
+    # Random, so ETags from other processes, whose local versions are unrelated, never match
+    etag = uuid.uuid4().hex
+    if version is not None:
+        events_cache.set((username, query_key), {'version': version, 'etag': etag, 'response': response})
+    return etag
+
+
 def update_event(username, modified_event):
-    events, events_id = get_firebase_events(username)
-    my_events = events[username]
-    aux_event_count = 0
-    for event in my_events:
-        if event is not None and event['id'] == modified_event['id']:
-            aux_event_count += 1
-            if event['synced'] is True:
-                return False, "You can't modify a synced event"
-            if 'timestamp' in modified_event:
-                event['timestamp'] = modified_event['timestamp']
-            if 'synced' in modified_event and modified_event['synced'] is True:
-                modified_event['recipe'] = event['recipe']
-                synced, message, *error_code = sync_with_google_calendar(username, modified_event)
-                if not synced:
-                    if len(error_code) == 0:
-                        return False, message
-                    return False, message, error_code[0]
-                event['synced'] = modified_event['synced']
-            break
-    if aux_event_count == 0:
+    snapshot = storage.read_events(username)
+    event = snapshot[0].get(modified_event['id'])
+    if event is None:
         return False, "Event not found"
-    events[username] = my_events
-    firebase.put('/events', events_id, events)
+    if event['synced'] is True:
+        return False, "You can't modify a synced event"
+
+    sync_requested = 'synced' in modified_event and modified_event['synced'] is True
+    if sync_requested and SYNC_MODE == 'async':
+        if check_user_logged_in(username) is None:
+            return False, "User not logged in Google"
+    elif sync_requested:
+        modified_event['recipe'] = event['recipe']
+        synced, message, *error_code = sync_with_google_calendar(username, modified_event)
+        if not synced:
+            if len(error_code) == 0:
+                return False, message
+            return False, message, error_code[0]
+
+    def apply_changes(my_events):
+        event = my_events.get(modified_event['id'])
+        if event is None:
+            return False, ((False, "Event not found"), False)
+        if 'timestamp' in modified_event:
+            my_events.set_timestamp(event['id'], modified_event['timestamp'])
+        if sync_requested and SYNC_MODE == 'async':
+            return True, (None, request_sync(event))
+        elif sync_requested:
+            event['synced'] = True
+        return True, (None, False)
+    try:
+        error, needs_job = storage.update_events(username, apply_changes, snapshot)
+    except storage.ConflictError:
+        return False, CONFLICT_MESSAGE, 409
+    if error is not None:
+        return error
+
+    if sync_requested and SYNC_MODE == 'async':
+        notifications.publish(username, 'updated', modified_event['id'])
+        if needs_job:
+            schedule_sync(username, modified_event['id'])
+        return True, "Event sync scheduled", 202
+    notifications.publish(username, 'synced' if sync_requested else 'updated', modified_event['id'])
     return True, "Updated event successfully"
 
 
+def sync_status(event):
+    if event['synced']:
+        return 'synced'
+    return event.get('syncStatus', 'unsynced')
+
+
+def request_sync(event):
+    # Marks the event pending and returns whether it needs a job, False if one is already on it
+    if event.get('syncStatus') == 'pending' and time.time() - event.get('syncRequested', 0) < SYNC_JOB_TIMEOUT:
+        return False
+    event['syncStatus'] = 'pending'
+    event['syncRequested'] = int(time.time())
+    event.pop('syncClaim', None)
+    return True
+
+
+def set_sync_status(username, event_id, status):
+    def apply_status(my_events):
+        event = my_events.get(event_id)
+        if event is None:
+            return False, None
+        if status == 'synced':
+            event['synced'] = True
+            event.pop('syncStatus', None)
+        else:
+            event['syncStatus'] = status
+        event.pop('syncRequested', None)
+        event.pop('syncClaim', None)
+        return True, True
+    if storage.update_events(username, apply_status):
+        notifications.publish(username, 'synced' if status == 'synced' else 'updated', event_id)
+
+
+def schedule_sync(username, event_id):
+    jobs.submit(f'sync {username}/{event_id}',
+                lambda: run_sync_job(username, event_id),
+                lambda: set_sync_status(username, event_id, 'failed'))
+
+
+def claim_sync(username, event_id, claim):
+    # Returns the event if this job may insert it in Google, so two jobs never both do
+    def apply_claim(my_events):
+        event = my_events.get(event_id)
+        if event is None or sync_status(event) != 'pending' or event.get('syncClaim', claim) != claim:
+            return False, None
+        event['syncClaim'] = claim
+        return True, dict(event)
+    return storage.update_events(username, apply_claim)
+
+
+def release_sync(username, event_id, claim):
+    # Lets a retry of the job claim the event again
+    def apply_release(my_events):
+        event = my_events.get(event_id)
+        if event is None or event.get('syncClaim') != claim:
+            return False, None
+        del event['syncClaim']
+        return True, None
+    storage.update_events(username, apply_release)
+
+
+def run_sync_job(username, event_id):
+    claim = uuid.uuid4().hex
+    event = claim_sync(username, event_id, claim)
+    if event is None:
+        return
+    try:
+        synced, message, *error_code = sync_with_google_calendar(username, event)
+        if not synced and len(error_code) > 0:
+            raise Exception(message)
+    except Exception:
+        release_sync(username, event_id, claim)
+        raise
+    set_sync_status(username, event_id, 'synced' if synced else 'failed')
+
+
 def delete_event(username, id):
-    events, events_id = get_firebase_events(username)
-    my_events = events[username]
-    for event in my_events:
-        if event['id'] == id:
-            my_events.remove(event)
-            break
-    events[username] = my_events
-    firebase.put('/events', events_id, events)
+    def remove_event(my_events):
+        removed = my_events.remove(id) is not None
+        return removed, removed
+    try:
+        removed = storage.update_events(username, remove_event)
+    except storage.ConflictError:
+        return False, CONFLICT_MESSAGE, 409
+    if removed:
+        notifications.publish(username, 'deleted', id)
+    return True, None
+
+def item_error(message, status=400):
+    return {"status": status, "message": message}
+
+
+def apply_batch(username, operations):
+    # Applies every valid operation in a single write and returns one result per operation
+    results = [None] * len(operations)
+    accepted = {}
+    for index, operation in enumerate(operations):
+        is_valid, message = utils.validate_operation(operation)
+        if is_valid:
+            accepted[index] = operation
+        else:
+            results[index] = item_error(message)
+
+    creates = {index: operation for index, operation in accepted.items() if operation['op'] == 'create'}
+    try:
+        detailed_recipes = recipes.get_recipes([operation['id'] for operation in creates.values()])
+    except:
+        logger.error("Failed to communicate with recipes service")
+        for index in creates:
+            results[index] = item_error("Failed to communicate with recipes service", 500)
+            del accepted[index]
+        creates = {}
+    new_events = {}
+    for index, operation in creates.items():
+        if detailed_recipes[operation['id']] is None:
+            results[index] = item_error("Recipe not found")
+            del accepted[index]
+        else:
+            new_events[index] = {
+                "id": uuid.uuid4().hex,
+                "timestamp": operation["timestamp"],
+                "synced": False,
+                "recipe": operation["id"]
+            }
+
+    snapshot = storage.read_events(username)
+    sync_requests = {index for index, operation in accepted.items()
+                     if operation['op'] == 'update' and operation['synced'] is True}
+    if len(sync_requests) > 0 and SYNC_MODE == 'async' and check_user_logged_in(username) is None:
+        for index in sync_requests:
+            results[index] = item_error("User not logged in Google")
+            del accepted[index]
+    for index in sync_requests & set(accepted):
+        event = snapshot[0].get(accepted[index]['id'])
+        if event is None or event['synced'] is True or SYNC_MODE == 'async':
+            continue
+        synced, message, *error_code = sync_with_google_calendar(username, dict(accepted[index], recipe=event['recipe']))
+        if not synced:
+            results[index] = item_error(message, *error_code)
+            del accepted[index]
+
+    def apply_operations(my_events):
+        outcomes = {}
+        needs_job = set()
+        changed = False
+        for index, operation in accepted.items():
+            if operation['op'] == 'create':
+                my_events.add(dict(new_events[index]))
+                outcomes[index] = {"status": 201, "id": new_events[index]['id']}
+                changed = True
+            elif operation['op'] == 'delete':
+                changed = my_events.remove(operation['id']) is not None or changed
+                outcomes[index] = {"status": 204, "id": operation['id']}
+            else:
+                event = my_events.get(operation['id'])
+                if event is None:
+                    outcomes[index] = item_error("Event not found")
+                    continue
+                if event['synced'] is True:
+                    outcomes[index] = item_error("You can't modify a synced event")
+                    continue
+                my_events.set_timestamp(event['id'], operation['timestamp'])
+                changed = True
+                if index in sync_requests and SYNC_MODE == 'async':
+                    if request_sync(event):
+                        needs_job.add(index)
+                    outcomes[index] = {"status": 202, "id": event['id']}
+                else:
+                    if index in sync_requests:
+                        event['synced'] = True
+                    outcomes[index] = {"status": 200, "id": event['id']}
+        return changed, (outcomes, needs_job)
+    try:
+        outcomes, needs_job = storage.update_events(username, apply_operations, snapshot)
+    except storage.ConflictError:
+        for index in accepted:
+            results[index] = item_error(CONFLICT_MESSAGE, 409)
+        return results
+
+    kinds = {201: 'created', 202: 'updated', 204: 'deleted'}
+    for index, outcome in outcomes.items():
+        results[index] = outcome
+        if outcome['status'] == 200:
+            notifications.publish(username, 'synced' if index in sync_requests else 'updated', outcome['id'])
+        elif outcome['status'] in kinds:
+            notifications.publish(username, kinds[outcome['status']], outcome['id'])
+        if index in needs_job:
+            schedule_sync(username, outcome['id'])
+    return results
+
 
 def sync_with_google_calendar(username, event):
-    SCOPE= ['https://www.googleapis.com/auth/calendar']
-    
     refresh_token = check_user_logged_in(username)
     if refresh_token is not None:
-        credentials = {
-            "token": None,
-            "refresh_token": refresh_token,
-            "client_id": os.getenv('CLIENT_ID'),
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "client_secret": os.getenv('CLIENT_SECRET'),
-            "scopes": SCOPE
-        }
-        creds = Credentials.from_authorized_user_info(credentials, SCOPE)
-        logger.info('Credentials are valid')
-        service = build('calendar', 'v3', credentials=creds)
-        
         try:
-            recipe = utils.communicate('GET', "".join(['http://recipes/api/v1/recipes/', event['recipe']]), None)
+            recipe = recipes.get_recipe(event['recipe'])
         except:
             logger.error("Failed to communicate with recipes service")
             return False, "Failed to communicate with recipes service", 500
 
-        insert_event_in_google_calendar(service, event, recipe)
+        with google_calendar.calendar_service(username, refresh_token) as service:
+            insert_event_in_google_calendar(service, event, recipe)
         return True, "Event modified successfully"
     else:
         return False, "User not logged in Google"
 
+def sync_all_events(username):
+    refresh_token = check_user_logged_in(username)
+    if refresh_token is None:
+        return False, "User not logged in Google"
+
+    snapshot = storage.read_events(username)
+    unsynced_events = [event for event in snapshot[0].upcoming() if not event['synced']]
+    if len(unsynced_events) == 0:
+        return True, {"synced": 0, "failed": 0}
+
+    try:
+        detailed_recipes = recipes.get_recipes([event['recipe'] for event in unsynced_events])
+    except:
+        logger.error("Failed to communicate with recipes service")
+        return False, "Failed to communicate with recipes service", 500
+
+    pending_events = [(event, detailed_recipes[event['recipe']]) for event in unsynced_events
+                      if detailed_recipes[event['recipe']] is not None]
+    with google_calendar.calendar_service(username, refresh_token) as service:
+        synced_ids = insert_events_in_google_calendar(service, pending_events)
+
+    def mark_synced(my_events):
+        for event_id in synced_ids:
+            event = my_events.get(event_id)
+            if event is not None:
+                event['synced'] = True
+                event.pop('syncStatus', None)
+        return len(synced_ids) > 0, None
+    try:
+        storage.update_events(username, mark_synced, snapshot)
+    except storage.ConflictError:
+        return False, CONFLICT_MESSAGE, 409
+    for event_id in synced_ids:
+        notifications.publish(username, 'synced', event_id)
+    return True, {"synced": len(synced_ids), "failed": len(unsynced_events) - len(synced_ids)}
+
 def login_with_google(username, refresh_token):
-    users = firebase.get('/users', None)
-    users_id = None
-    if users is not None:
-        users_id = list(users)[0]
-        users = users[users_id]
-    else:
-        users = {}
-    users[username] = refresh_token
-    if users_id is None:
-        firebase.post('/users', users)
-    else:
-        firebase.put('/users', users_id, users)
+    storage.put_refresh_token(username, refresh_token)
 
 def check_user_logged_in(username):
-    users = firebase.get('/users', None)
-    if users is not None:
-        users_id = list(users)[0]
-        users = users[users_id]
-        if username in users:
-            return users[username]
-    return None
+    return storage.get_refresh_token(username)
 
 def logout_from_google(username):
-    users = firebase.get('/users', None)
-    users_id = None
-    if users is not None:
-        users_id = list(users)[0]
-        users = users[users_id]
-    else:
-        return
-    if username in users:
-        users.pop(username)
-    firebase.put('/users', users_id, users)
+    storage.delete_refresh_token(username)
+    google_calendar.forget(username)
 
-def insert_event_in_google_calendar(service, event, recipe):
+def calendar_event_body(event, recipe):
     startDateTime = datetime.datetime.fromtimestamp(int(event['timestamp'])).isoformat()
     endDateTime = (datetime.datetime.fromtimestamp(int(event['timestamp'])) + datetime.timedelta(hours=1)).isoformat()
     timeZone = 'Europe/Madrid'
 
-    event = {
+    return {
         'summary': 'YourYummy: ' + recipe['name'],
-        'description': " " if 'summary' in recipe else recipe['summary'],
+        'description': " " if 'summary' not in recipe else recipe['summary'],
         'start': {
             'dateTime': startDateTime,
             'timeZone': timeZone,
@@ -218,5 +464,32 @@ def insert_event_in_google_calendar(service, event, recipe):
         }
     }
 
-    event = service.events().insert(calendarId='primary', body=event).execute()
-    logger.info('Event created: %s' % (event.get('htmlLink')))
\ No newline at end of file
+def insert_event_in_google_calendar(service, event, recipe):
+    with metrics.observe('google', 'insert'):
+        event = service.events().insert(calendarId='primary', body=calendar_event_body(event, recipe)).execute()
+    logger.info('Event created: %s' % (event.get('htmlLink')))
+
+def insert_events_in_google_calendar(service, events):
+    # Sends the inserts in Google batch requests and returns the ids of the synced events. A batch
+    # that fails counts its events as failed, the ones already inserted are still returned
+    synced_ids = set()
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            logger.error('Failed to create event %s: %s' % (request_id, exception))
+            metrics.count_error('google', 'insert')
+        else:
+            synced_ids.add(request_id)
+            logger.info('Event created: %s' % (response.get('htmlLink')))
+
+    for start in range(0, len(events), GOOGLE_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for event, recipe in events[start:start + GOOGLE_BATCH_SIZE]:
+            request = service.events().insert(calendarId='primary', body=calendar_event_body(event, recipe))
+            batch.add(request, request_id=event['id'])
+        try:
+            with metrics.observe('google', 'batch_insert'):
+                batch.execute()
+        except Exception:
+            logger.exception('Failed to send batch of events to Google Calendar')
+    return synced_ids
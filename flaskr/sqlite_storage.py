@@ -0,0 +1,165 @@
+from dotenv import load_dotenv
+from . import event_store
+import threading
+import sqlite3
+import json
+import os
+
+load_dotenv()
+STORAGE_SQLITE_PATH = os.getenv('STORAGE_SQLITE_PATH', 'planner.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    username TEXT NOT NULL,
+    id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (username, id)
+);
+CREATE INDEX IF NOT EXISTS events_by_time ON events (username, timestamp, id);
+CREATE INDEX IF NOT EXISTS events_by_id ON events (id);
+CREATE TABLE IF NOT EXISTS archived_events (
+    username TEXT NOT NULL,
+    id TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (username, id)
+);
+CREATE TABLE IF NOT EXISTS event_versions (
+    username TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    refresh_token TEXT
+);
+'''
+
+
+class SQLiteStorage:
+    # Embedded backend with the same interface as storage.FirebaseStorage, for on-prem
+    # installs and load tests that must not depend on the network. The ETag of a user's
+    # events is a counter bumped on every write, which is also the user's version
+
+    def __init__(self, path=None):
+        self.path = path or STORAGE_SQLITE_PATH
+        self.local = threading.local()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def ping(self):
+        self.connection().execute('SELECT 1')
+
+    def read_events(self, username):
+        connection = self.connection()
+        connection.execute('BEGIN')
+        try:
+            return self.load_events(connection, username), self.etag(connection, username)
+        finally:
+            connection.execute('COMMIT')
+
+    def write_events(self, username, events, etag):
+        connection = self.connection()
+        # Taking the write lock up front makes the version check and the write atomic
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            current = self.load_events(connection, username)
+            current_etag = self.etag(connection, username)
+            if current_etag != etag:
+                connection.execute('ROLLBACK')
+                return False, (current, current_etag)
+            stored = current.to_map()
+            wanted = events.to_map()
+            connection.executemany(
+                'DELETE FROM events WHERE username = ? AND id = ?',
+                [(username, event_id) for event_id in stored if event_id not in wanted]
+            )
+            connection.executemany(
+                'INSERT OR REPLACE INTO events (username, id, timestamp, body) VALUES (?, ?, ?, ?)',
+                [(username, event_id, int(event['timestamp']), json.dumps(event))
+                 for event_id, event in wanted.items() if stored.get(event_id) != event]
+            )
+            self.increment_version(connection, username)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return True, None
+
+    def query_events(self, username, start, end, limit):
+        sql = 'SELECT body FROM events WHERE username = ?'
+        params = [username]
+        if start is not None:
+            sql += ' AND timestamp >= ?'
+            params.append(int(start))
+        if end is not None:
+            sql += ' AND timestamp <= ?'
+            params.append(int(end))
+        sql += ' ORDER BY timestamp, id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        rows = self.connection().execute(sql, params)
+        return event_store.UserEvents(json.loads(body) for body, in rows)
+
+    def list_event_owners(self):
+        return [username for username, in self.connection().execute('SELECT DISTINCT username FROM events')]
+
+    def archive_events(self, username, changes):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for event_id, event in changes.items():
+                if event is None:
+                    connection.execute('DELETE FROM archived_events WHERE username = ? AND id = ?',
+                                       (username, event_id))
+                else:
+                    connection.execute('INSERT OR REPLACE INTO archived_events (username, id, body) VALUES (?, ?, ?)',
+                                       (username, event_id, json.dumps(event)))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def read_version(self, username):
+        return int(self.etag(self.connection(), username))
+
+    def bump_version(self, username):
+        # Also makes writes based on an earlier read of the events conflict, which they retry
+        self.increment_version(self.connection(), username)
+
+    def get_refresh_token(self, username):
+        row = self.connection().execute('SELECT refresh_token FROM users WHERE username = ?', (username,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_refresh_token(self, username, refresh_token):
+        self.connection().execute('INSERT OR REPLACE INTO users (username, refresh_token) VALUES (?, ?)',
+                                  (username, refresh_token))
+        self.bump_version(username)
+
+    def delete_refresh_token(self, username):
+        self.connection().execute('DELETE FROM users WHERE username = ?', (username,))
+        self.bump_version(username)
+
+    def load_events(self, connection, username):
+        rows = connection.execute('SELECT body FROM events WHERE username = ?', (username,))
+        return event_store.UserEvents(json.loads(body) for body, in rows)
+
+    def increment_version(self, connection, username):
+        connection.execute(
+            'INSERT INTO event_versions (username, version) VALUES (?, 1) '
+            'ON CONFLICT (username) DO UPDATE SET version = version + 1',
+            (username,)
+        )
+
+    def etag(self, connection, username):
+        row = connection.execute('SELECT version FROM event_versions WHERE username = ?', (username,)).fetchone()
+        return str(0 if row is None else row[0])
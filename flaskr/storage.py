@@ -0,0 +1,321 @@
+from dotenv import load_dotenv
+from .firebase_client import FirebaseClient
+from . import event_store
+from . import metrics
+from . import utils
+import threading
+import atexit
+import logging
+import os
+
+load_dotenv()
+# 'firebase', or 'sqlite' for the embedded backend in sqlite_storage
+BACKEND = os.getenv('STORAGE_BACKEND', 'firebase')
+database_url = os.getenv('DATABASE_URL')
+firebase = FirebaseClient(database_url) if BACKEND == 'firebase' else None
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PATH = '/events'
+USERS_PATH = '/users'
+ARCHIVE_PATH = '/archive'
+VERSIONS_PATH = '/versions'
+TOKEN_CACHE_TTL = float(os.getenv('TOKEN_CACHE_TTL', '60'))
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv('TOKEN_CACHE_MAX_ENTRIES', '4096'))
+WRITE_MAX_ATTEMPTS = int(os.getenv('STORAGE_WRITE_MAX_ATTEMPTS', '5'))
+# 'immediate' writes every change to events before it is acknowledged. 'buffered' acknowledges it from
+# memory and writes each user's changes of the last STORAGE_WRITE_BEHIND_WINDOW seconds at once:
+# fewer writes during bursts, but a crashed process loses up to a window of changes. The buffered state
+# is only authoritative with a single process: one gunicorn worker and one replica
+DURABILITY = os.getenv('STORAGE_DURABILITY', 'immediate')
+WRITE_BEHIND_WINDOW = float(os.getenv('STORAGE_WRITE_BEHIND_WINDOW', '0.5'))
+
+# username -> Google refresh token, or None for users not logged in Google
+tokens_cache = utils.TTLCache(TOKEN_CACHE_TTL, TOKEN_CACHE_TTL, TOKEN_CACHE_MAX_ENTRIES)
+
+# username -> number of changes to the user's events or Google login made by this process. Other
+# processes see them through the version kept by the backend, except those still in the write buffer
+versions = {}
+versions_lock = threading.Lock()
+
+
+class ConflictError(Exception):
+    pass
+
+
+def database_endpoint(path):
+    return "".join([database_url.rstrip('/'), path, '.json'])
+
+
+def database_request(method, path, body=None, headers=None, params=None):
+    return firebase.request(method, path, body, headers=headers, params=params)
+
+
+def events_query(start=None, end=None, limit=None):
+    # Filtered by Firebase, which needs ".indexOn": "timestamp" on /events/$username to do it efficiently
+    params = {'orderBy': '"timestamp"'}
+    if start is not None:
+        params['startAt'] = start
+    if end is not None:
+        params['endAt'] = end
+    if limit is not None:
+        params['limitToFirst'] = limit
+    return params
+
+
+def missing_index(response):
+    # Firebase rejects ordered queries with a 400 until the rules have the index
+    return response.status_code == 400 and 'Index not defined' in response.text
+
+
+def filter_events(events, start=None, end=None, limit=None):
+    # Same result as events_query, computed here
+    return event_store.UserEvents(events.between(start, end)[:limit])
+
+
+class FirebaseStorage:
+    # Every backend implements these methods. ETags are opaque strings that change on every write
+
+    def ping(self):
+        # Opens a pooled connection to the database, reading only the top-level keys
+        firebase.shallow('/')
+
+    def read_events(self, username):
+        response = database_request('GET', f'{EVENTS_PATH}/{username}', headers={'X-Firebase-ETag': 'true'})
+        response.raise_for_status()
+        return event_store.parse_events(response.json()), response.headers['ETag']
+
+    def write_events(self, username, events, etag):
+        response = database_request('PUT', f'{EVENTS_PATH}/{username}', events.to_map(), headers={'if-match': etag})
+        if response.status_code == 412:
+            return False, (event_store.parse_events(response.json()), response.headers['ETag'])
+        response.raise_for_status()
+        self.bump_version(username)
+        return True, None
+
+    def read_version(self, username):
+        # A counter bumped on every change to the user's events or Google login
+        return firebase.get(VERSIONS_PATH, username) or 0
+
+    def bump_version(self, username):
+        # Incremented by the server, so bumps from every replica count. A failed bump leaves other
+        # processes serving cached responses until EVENTS_CACHE_TTL, so it doesn't fail the write
+        try:
+            response = database_request('PUT', f'{VERSIONS_PATH}/{username}', {'.sv': {'increment': 1}})
+            response.raise_for_status()
+        except Exception:
+            logger.exception(f'Failed to bump version of {username}')
+
+    def query_events(self, username, start, end, limit):
+        response = database_request('GET', f'{EVENTS_PATH}/{username}', params=events_query(start, end, limit))
+        if missing_index(response):
+            logger.warning('Database rules lack ".indexOn": "timestamp" on /events/$username, filtering events here')
+            return filter_events(self.read_events(username)[0], start, end, limit)
+        response.raise_for_status()
+        return event_store.parse_events(response.json())
+
+    def list_event_owners(self):
+        return [username for username in firebase.shallow(EVENTS_PATH) if not is_push_key(username)]
+
+    def archive_events(self, username, changes):
+        response = database_request('PATCH', f'{ARCHIVE_PATH}/{username}', changes)
+        response.raise_for_status()
+
+    def get_refresh_token(self, username):
+        return firebase.get(USERS_PATH, username)
+
+    def put_refresh_token(self, username, refresh_token):
+        firebase.put(USERS_PATH, username, refresh_token)
+        self.bump_version(username)
+
+    def delete_refresh_token(self, username):
+        firebase.delete(USERS_PATH, username)
+        self.bump_version(username)
+
+
+def create_backend():
+    if BACKEND == 'sqlite':
+        from .sqlite_storage import SQLiteStorage
+        return SQLiteStorage()
+    return FirebaseStorage()
+
+
+backend = create_backend()
+
+
+def create_write_buffer():
+    if DURABILITY != 'buffered':
+        return None
+    from .write_behind import WriteBehind
+    # Reads bypass the buffer, which answers for the users it holds
+    return WriteBehind(WRITE_BEHIND_WINDOW, lambda username: backend.read_events(username),
+                       lambda username, events, etag: write_events(username, events, etag),
+                       lambda username: bump_version(username), WRITE_MAX_ATTEMPTS)
+
+
+write_buffer = create_write_buffer()
+
+
+def connect():
+    # Called after fork, so every process opens its own connections
+    global firebase, backend, write_buffer
+    if BACKEND == 'firebase':
+        firebase = FirebaseClient(database_url)
+    backend = create_backend()
+    write_buffer = create_write_buffer()
+
+
+def flush_writes():
+    # Writes the buffered changes, called when the process shuts down
+    if write_buffer is not None:
+        write_buffer.flush_all()
+
+
+atexit.register(flush_writes)
+
+
+def ping():
+    backend.ping()
+
+
+def read_events(username):
+    if write_buffer is not None:
+        buffered = write_buffer.snapshot(username)
+        if buffered is not None:
+            return buffered
+    return backend.read_events(username)
+
+
+def write_events(username, events, etag):
+    # Returns (True, None), or (False, (events, etag)) with the current data if the ETag is stale
+    return backend.write_events(username, events, etag)
+
+
+def get_events(username, start=None, end=None, limit=None):
+    if start is None and end is None and limit is None:
+        return read_events(username)[0]
+    buffered = write_buffer.snapshot(username) if write_buffer is not None else None
+    if buffered is not None:
+        return filter_events(buffered[0], start, end, limit)
+    return backend.query_events(username, start, end, limit)
+
+
+def put_events(username, events):
+    # Only used by the Firebase layout migrations
+    firebase.put(EVENTS_PATH, username, events.to_map())
+
+
+def version(username):
+    # Changes whenever any process changes the user's events or Google login. None if the stored
+    # version can't be read, for example before the database rules allow /versions
+    try:
+        stored = backend.read_version(username)
+    except Exception:
+        logger.exception(f'Failed to read version of {username}')
+        return None
+    return stored, local_version(username)
+
+
+def local_version(username):
+    with versions_lock:
+        return versions.get(username, 0)
+
+
+def bump_version(username):
+    with versions_lock:
+        versions[username] = versions.get(username, 0) + 1
+
+
+def update_events(username, mutate, snapshot=None):
+    # mutate(events) edits the UserEvents in place and returns (changed, result). It may run
+    # again on newer events if the write conflicts, or later when the change is buffered
+    if write_buffer is not None:
+        return write_buffer.update(username, mutate)
+    events, etag = snapshot if snapshot is not None else read_events(username)
+    for attempt in range(WRITE_MAX_ATTEMPTS):
+        if attempt > 0:
+            metrics.count_write_retry()
+        changed, result = mutate(events)
+        if not changed:
+            return result
+        written, current = write_events(username, events, etag)
+        if written:
+            bump_version(username)
+            return result
+        metrics.count_write_conflict()
+        logger.info(f'Concurrent change to events of {username}, retrying')
+        events, etag = current
+    raise ConflictError(f'Too many concurrent changes to events of {username}')
+
+
+def list_event_owners():
+    return backend.list_event_owners()
+
+
+def archive_events(username, changes):
+    # changes maps event ids to events, or to None to take them out of the archive
+    backend.archive_events(username, changes)
+
+
+def get_refresh_token(username):
+    found, refresh_token = tokens_cache.get(username)
+    if not found:
+        refresh_token = backend.get_refresh_token(username)
+        tokens_cache.set(username, refresh_token)
+    return refresh_token
+
+
+def put_refresh_token(username, refresh_token):
+    backend.put_refresh_token(username, refresh_token)
+    tokens_cache.set(username, refresh_token)
+    bump_version(username)
+
+
+def delete_refresh_token(username):
+    backend.delete_refresh_token(username)
+    tokens_cache.set(username, None)
+    bump_version(username)
+
+
+def is_push_key(key):
+    return key.startswith('-') and len(key) == 20
+
+
+def migrate_events_layout():
+    # Moves /events/<push key>/<username> into /events/<username>, and rewrites
+    # array layouts as maps keyed by event id. The tree is streamed one child at a time
+    migrated = set()
+    for key, node in firebase.iter_children(EVENTS_PATH):
+        if is_push_key(key):
+            if not isinstance(node, dict):
+                continue
+            for username, legacy_events in node.items():
+                events = get_events(username)
+                for event in event_store.parse_events(legacy_events):
+                    if event['id'] not in events:
+                        events.add(event)
+                put_events(username, events)
+                migrated.add(username)
+            firebase.delete(EVENTS_PATH, key)
+            logger.info(f'Migrated legacy events node {key}')
+        elif key not in migrated and not event_store.is_map_layout(node):
+            put_events(key, event_store.parse_events(node))
+            migrated.add(key)
+    return len(migrated)
+
+
+def migrate_users_layout():
+    # Moves /users/<push key>/<username> into /users/<username>
+    usernames = set(firebase.shallow(USERS_PATH))
+    migrated = 0
+    for key, node in firebase.iter_children(USERS_PATH):
+        if not is_push_key(key) or not isinstance(node, dict):
+            continue
+        for username, refresh_token in node.items():
+            if username not in usernames:
+                firebase.put(USERS_PATH, username, refresh_token)
+                migrated += 1
+        firebase.delete(USERS_PATH, key)
+        logger.info(f'Migrated legacy users node {key}')
+    tokens_cache.clear()
+    return migrated
@@ -0,0 +1,76 @@
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from opentelemetry.trace import SpanKind, StatusCode
+import os
+
+load_dotenv()
+# 'file' appends one JSON span per line to TRACING_FILE, 'otlp' sends spans to a collector
+# listening on TRACING_ENDPOINT. Unset, spans are not recorded and cost next to nothing
+EXPORTER = os.getenv('TRACING_EXPORTER') or None
+TRACING_FILE = os.getenv('TRACING_FILE', 'traces.jsonl')
+TRACING_ENDPOINT = os.getenv('TRACING_ENDPOINT', 'http://localhost:4318/v1/traces')
+SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'planner')
+
+tracer = trace.NoOpTracer()
+provider = None
+
+
+def create_processor():
+    if EXPORTER == 'file':
+        output = open(TRACING_FILE, 'a')
+        exporter = ConsoleSpanExporter(out=output, formatter=lambda span: span.to_json(indent=None) + '\n')
+    elif EXPORTER == 'otlp':
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=TRACING_ENDPOINT)
+    else:
+        return None
+    return BatchSpanProcessor(exporter)
+
+
+def configure(processor=None):
+    # The batch processor restarts its export thread in forked workers
+    global tracer, provider
+    if processor is None:
+        if provider is not None:
+            return
+        processor = create_processor()
+        if processor is None:
+            return
+    provider = TracerProvider(resource=Resource.create({'service.name': SERVICE_NAME}))
+    provider.add_span_processor(processor)
+    tracer = provider.get_tracer(__name__)
+
+
+@contextmanager
+def span(name, **attributes):
+    # A call to another service. Errors raised inside are recorded on the span
+    with tracer.start_as_current_span(name, kind=SpanKind.CLIENT, attributes=attributes) as current:
+        yield current
+
+
+def start_request(method, route, headers):
+    # Continues the caller's trace when the request carries a traceparent header
+    request_span = tracer.start_span(
+        f'{method} {route}', context=propagate.extract(headers), kind=SpanKind.SERVER,
+        attributes={'http.request.method': method, 'http.route': route}
+    )
+    return request_span, context.attach(trace.set_span_in_context(request_span))
+
+
+def end_request(request_span, token, status):
+    request_span.set_attribute('http.response.status_code', status)
+    if status >= 500:
+        request_span.set_status(StatusCode.ERROR)
+    request_span.end()
+    context.detach(token)
+
+
+def outgoing_headers():
+    # traceparent for the current span, empty when there is nothing to propagate
+    headers = {}
+    propagate.inject(headers)
+    return headers
@@ -1,15 +1,140 @@
 from circuitbreaker import circuit
+from collections import OrderedDict
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from . import metrics
+from . import tracing
 import requests
+import threading
+import base64
+import json
 import time
+import os
 
-@circuit(failure_threshold=3, recovery_timeout=10)
-def communicate(method, url, body=None):
+load_dotenv()
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '16'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '2'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '5'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.1'))
+EVENTS_MAX_LIMIT = int(os.getenv('EVENTS_MAX_LIMIT', '100'))
+EVENTS_BATCH_MAX_OPERATIONS = int(os.getenv('EVENTS_BATCH_MAX_OPERATIONS', '100'))
+
+
+def create_adapter(pool_size=HTTP_POOL_SIZE):
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+        raise_on_status=False
+    )
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+
+# Sessions are per thread, but all of them share the adapter and its connection pool
+adapter = create_adapter()
+local = threading.local()
+
+
+def get_session():
+    session = getattr(local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        local.session = session
+    return session
+
+
+def reset_clients():
+    # Pooled connections must not be shared with the process this one was forked from
+    global adapter, local
+    adapter = create_adapter()
+    local = threading.local()
+
+
+class TTLCache:
+    # Missing values (None) are cached with their own, usually shorter, TTL. Caches with a
+    # name count their hits and misses in planner_cache_lookups_total
+
+    def __init__(self, ttl, negative_ttl, max_entries, name=None):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if self.name is not None:
+            metrics.count_cache_lookup(self.name, entry is not None)
+        if entry is None:
+            return False, None
+        return True, entry[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+# Shared with the async client in async_service
+communicate_circuit = circuit(failure_threshold=3, recovery_timeout=10, name='communicate')
+metrics.watch_circuit(communicate_circuit)
+
+
+@communicate_circuit
+def communicate(method, url, body=None, not_found=None):
+    # Returns the JSON body of a 200 response, or None. With not_found, None only stands for those
+    # statuses and any other failed response raises, so callers can tell missing from unavailable
+    options = {'timeout': (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)}
     if body is not None:
-        response = requests.request(method, url, json=body)
-    else:
-        response = requests.request(method, url)
+        options['json'] = body
+    with metrics.observe('recipes', method):
+        headers = tracing.outgoing_headers()
+        if headers:
+            options['headers'] = headers
+        response = get_session().request(method, url, **options)
+    if response.status_code >= 500:
+        metrics.count_error('recipes', method)
     if response.status_code == 200:
         return response.json()
+    if not_found is not None and response.status_code not in not_found:
+        raise requests.HTTPError(f'{response.status_code} from {method} {url}', response=response)
 
 def validate_event(event, method):
     if method == "POST" or method == "PUT":
@@ -41,9 +166,66 @@ def validate_event(event, method):
             return False, "Synced must be a boolean"
         return True, "OK"
 
+def validate_batch(body):
+    if body is None or "operations" not in body:
+        return False, "No operations provided"
+    if type(body["operations"]) != list or len(body["operations"]) == 0:
+        return False, "Operations must be a non-empty list"
+    if len(body["operations"]) > EVENTS_BATCH_MAX_OPERATIONS:
+        return False, f"At most {EVENTS_BATCH_MAX_OPERATIONS} operations are allowed"
+    return True, body["operations"]
+
+def validate_operation(operation):
+    if type(operation) != dict:
+        return False, "Operation must be an object"
+    if operation.get("op") == "create":
+        return validate_event(operation, "POST")
+    if operation.get("op") == "update":
+        return validate_event(operation, "PUT")
+    if operation.get("op") == "delete":
+        if "id" not in operation:
+            return False, "No event id provided"
+        if type(operation["id"]) != str:
+            return False, "Event id must be a string"
+        return True, "OK"
+    return False, "Op must be create, update or delete"
+
 def validate_refresh_token(body):
     if "refreshToken" not in body:
         return False, "No refresh token provided"
     if type(body["refreshToken"]) != str:
         return False, "Refresh token must be a string"
     return True, body["refreshToken"]
+
+def encode_cursor(timestamp, event_id, seen):
+    # seen counts the events already returned with this same timestamp
+    return base64.urlsafe_b64encode(json.dumps([timestamp, event_id, seen]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        timestamp, event_id, seen = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        return None
+    if type(timestamp) != int or type(event_id) != str or type(seen) != int or seen < 1:
+        return None
+    return {"timestamp": timestamp, "id": event_id, "seen": seen}
+
+def validate_events_query(args):
+    query = {"from": int(time.time()), "to": None, "limit": None, "cursor": None}
+    for name in ["from", "to", "limit"]:
+        if name in args:
+            try:
+                query[name] = int(args[name])
+            except ValueError:
+                return False, f"{name.capitalize()} must be an integer"
+    if query["to"] is not None and query["to"] < query["from"]:
+        return False, "To must not be before from"
+    if query["limit"] is not None and not 1 <= query["limit"] <= EVENTS_MAX_LIMIT:
+        return False, f"Limit must be between 1 and {EVENTS_MAX_LIMIT}"
+    if "cursor" in args:
+        if query["limit"] is None:
+            return False, "Cursor requires a limit"
+        query["cursor"] = decode_cursor(args["cursor"])
+        if query["cursor"] is None:
+            return False, "Invalid cursor"
+    return True, query
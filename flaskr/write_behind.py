@@ -0,0 +1,179 @@
+from . import event_store
+from . import metrics
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Longest wait for in-flight writes when flushing on shutdown
+FLUSH_TIMEOUT = 10
+
+
+class UserState:
+
+    def __init__(self, events, etag):
+        self.events = events
+        self.etag = etag
+        # Mutations applied to events but not written yet, replayed if the write conflicts
+        self.pending = []
+        self.flushing = False
+
+
+class WriteBehind:
+    # Holds the events of users with unwritten changes and answers their reads and mutations from
+    # memory. All the mutations of a user within window seconds are written together, with the
+    # same conditional write as storage.update_events. A user's state is dropped once written.
+    #
+    # load(username) and store(username, events, etag) are the backend's read_events and
+    # write_events, on_change(username) is called whenever the user's events change
+
+    def __init__(self, window, load, store, on_change, max_attempts):
+        self.window = window
+        self.load = load
+        self.store = store
+        self.on_change = on_change
+        self.max_attempts = max_attempts
+        self.states = {}
+        # username -> monotonic time its pending mutations are due
+        self.deadlines = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.worker = None
+        self.mutations = 0
+        self.writes = 0
+
+    def snapshot(self, username):
+        # A copy of the user's buffered events and ETag, or None if nothing is buffered
+        with self.lock:
+            state = self.states.get(username)
+            if state is None:
+                return None
+            return event_store.UserEvents(dict(event) for event in state.events), state.etag
+
+    def update(self, username, mutate):
+        while True:
+            state = self.state(username)
+            with self.lock:
+                # Retried if the state was written and dropped in between
+                if self.states.get(username) is not state:
+                    continue
+                changed, result = mutate(state.events)
+                if changed:
+                    state.pending.append(mutate)
+                    self.mutations += 1
+                    self.schedule(username)
+            break
+        if changed:
+            self.on_change(username)
+        return result
+
+    def state(self, username):
+        with self.lock:
+            state = self.states.get(username)
+        if state is not None:
+            return state
+        events, etag = self.load(username)
+        with self.lock:
+            return self.states.setdefault(username, UserState(events, etag))
+
+    def schedule(self, username):
+        # Called with the lock held. The first pending mutation sets the deadline, so a
+        # steady stream of changes is still written every window
+        if username not in self.deadlines:
+            self.deadlines[username] = time.monotonic() + self.window
+            self.wakeup.notify()
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, name='write-behind', daemon=True)
+            self.worker.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                due = [username for username, deadline in self.deadlines.items() if deadline <= now]
+                if len(due) == 0:
+                    timeout = min(self.deadlines.values()) - now if len(self.deadlines) > 0 else None
+                    self.wakeup.wait(timeout)
+                    continue
+                for username in due:
+                    del self.deadlines[username]
+            for username in due:
+                self.flush(username)
+
+    def flush(self, username):
+        with self.lock:
+            state = self.states.get(username)
+            if state is None or state.flushing or len(state.pending) == 0:
+                return
+            state.flushing = True
+            pending = state.pending
+            state.pending = []
+            events = event_store.UserEvents(dict(event) for event in state.events)
+            etag = state.etag
+        try:
+            self.write(username, events, etag, pending)
+        except Exception:
+            logger.exception(f'Failed to write buffered events of {username}, retrying')
+            with self.lock:
+                state.pending = pending + state.pending
+                state.flushing = False
+                self.schedule(username)
+            return
+        with self.lock:
+            state.flushing = False
+            self.writes += 1
+            if len(state.pending) == 0:
+                del self.states[username]
+                rebase = False
+            else:
+                rebase = True
+        if rebase:
+            # Mutations arrived during the write, apply them again on top of what was stored. If
+            # that can't be read, the stale ETag makes the next write conflict and replay them
+            try:
+                events, etag = self.load(username)
+            except Exception:
+                logger.exception(f'Failed to reload events of {username}, replaying on the next write')
+                events = None
+            with self.lock:
+                if events is not None:
+                    for mutate in state.pending:
+                        mutate(events)
+                    state.events = events
+                    state.etag = etag
+                self.schedule(username)
+        self.on_change(username)
+
+    def write(self, username, events, etag, pending):
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                metrics.count_write_retry()
+            written, current = self.store(username, events, etag)
+            if written:
+                return
+            metrics.count_write_conflict()
+            logger.info(f'Concurrent change to events of {username}, replaying buffered changes')
+            events, etag = current
+            for mutate in pending:
+                mutate(events)
+        raise Exception(f'Too many concurrent changes to events of {username}')
+
+    def flush_all(self):
+        # Writes every buffered change, waiting for the writes already in flight
+        deadline = time.monotonic() + FLUSH_TIMEOUT
+        while time.monotonic() < deadline:
+            with self.lock:
+                usernames = list(self.states)
+                busy = any(state.flushing for state in self.states.values())
+            if len(usernames) == 0:
+                return
+            for username in usernames:
+                self.flush(username)
+            if busy:
+                time.sleep(0.05)
+        logger.error('Gave up flushing buffered events on shutdown')
+
+    def stats(self):
+        with self.lock:
+            return {'mutations': self.mutations, 'writes': self.writes, 'users': len(self.states)}
@@ -0,0 +1,28 @@
+from . import create_app
+from . import google_calendar
+from . import storage
+from . import utils
+import logging
+
+logger = logging.getLogger(__name__)
+
+# gunicorn -c gunicorn.conf.py flaskr.wsgi:app
+app = create_app()
+
+
+def init_clients():
+    # Called in each worker right after fork
+    utils.reset_clients()
+    storage.connect()
+    google_calendar.clients.clear()
+
+
+def warm_up():
+    # Workers only accept connections once this returns, so the readiness probe waits for it
+    google_calendar.get_discovery_document()
+    app.test_client().get('/')
+    try:
+        storage.ping()
+    except Exception as error:
+        logger.warning(f'Could not reach the database during warm-up: {error}')
+    logger.info('Worker warmed up')
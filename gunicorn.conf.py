@@ -0,0 +1,46 @@
+import shutil
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:80')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+worker_class = 'gthread'
+# Time a worker gets to finish its requests on shutdown, and to flush the write-behind buffer
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+accesslog = '-'
+
+# The app is imported once in the master; connection pools are created per worker
+preload_app = True
+
+# Each worker would buffer its own changes, and the others would keep answering from the database
+if os.getenv('STORAGE_DURABILITY') == 'buffered' and workers > 1:
+    raise RuntimeError('STORAGE_DURABILITY=buffered needs GUNICORN_WORKERS=1')
+
+# Workers write their metrics here so /metrics reports all of them. Samples of a previous run are discarded
+metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if metrics_dir:
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):
+    from flaskr import wsgi
+    wsgi.init_clients()
+
+
+def post_worker_init(worker):
+    from flaskr import wsgi
+    wsgi.warm_up()
+
+
+def worker_exit(server, worker):
+    # Writes the changes a worker still buffers before it goes away
+    from flaskr import storage
+    storage.flush_writes()
+
+
+def child_exit(server, worker):
+    from flaskr import metrics
+    metrics.mark_process_dead(worker.pid)
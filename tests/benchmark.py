@@ -0,0 +1,429 @@
+# Benchmarks GET/POST/PUT/DELETE /api/v1/events against in-process fakes of Firebase, the recipes
+# service and Google Calendar, through the Flask test client and through a real HTTP server
+#
+#   python tests/benchmark.py --users 1,100 --events 10,200 --latency-ms 1
+#   python tests/benchmark.py --save baseline.json     # before a change
+#   python tests/benchmark.py --check baseline.json    # after it, on the same machine and Python
+#
+# Reports requests/sec, p50/p99 latency and the peak memory allocated per request (KiB).
+# --check exits with 1 when throughput or p50 is worse than the baseline by more than --tolerance,
+# or the allocations by more than --alloc-tolerance. p99 is reported but too noisy to check.
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import tracemalloc
+import functools
+import argparse
+import requests
+import random
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JWT_SECRET = 'benchmark-secret-benchmark-secret-benchmark'
+os.environ.update(
+    JWT_SECRET=JWT_SECRET,
+    DATABASE_URL='https://benchmark.invalid',
+    RECIPES_URL='http://recipes.invalid',
+    SYNC_MODE='sync'
+)
+os.environ.pop('TRACING_EXPORTER', None)
+sys.path.insert(0, ROOT)
+
+from werkzeug.serving import make_server
+from flaskr import create_app
+from flaskr import event_store
+from flaskr import google_calendar
+from flaskr import recipes
+from flaskr import service
+from flaskr import storage
+from flaskr import utils
+import logging
+import jwt
+
+ENDPOINTS = ['get', 'get-cached', 'post', 'put', 'sync', 'delete']
+RECIPES = 20
+# Far enough ahead to stay upcoming, close enough to pass validation
+FUTURE = int(time.time()) + 30 * 24 * 3600
+
+
+class FakeDatabase:
+    # Implements the storage backend interface in memory, waiting latency seconds per call
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.events = {}
+        self.etags = {}
+        self.tokens = {}
+        self.archive = {}
+        self.lock = threading.Lock()
+
+    def seed(self, users, events_per_user):
+        for user in range(users):
+            username = f'user{user}'
+            self.events[username] = {
+                f'{username}-{number}': event(f'{username}-{number}', number) for number in range(events_per_user)
+            }
+            self.etags[username] = 0
+            # Half the users are logged in Google
+            self.tokens[username] = 'refreshToken' if user % 2 == 0 else None
+
+    def restore(self, username, event_id, stored):
+        with self.lock:
+            self.events[username][event_id] = stored
+
+    def ping(self):
+        time.sleep(self.latency)
+
+    def read_events(self, username):
+        time.sleep(self.latency)
+        with self.lock:
+            events = [dict(stored) for stored in self.events.get(username, {}).values()]
+            return event_store.UserEvents(events), str(self.etags.get(username, 0))
+
+    def write_events(self, username, events, etag):
+        time.sleep(self.latency)
+        with self.lock:
+            current_etag = str(self.etags.get(username, 0))
+            if current_etag != etag:
+                events = [dict(stored) for stored in self.events.get(username, {}).values()]
+                return False, (event_store.UserEvents(events), current_etag)
+            self.events[username] = {event_id: dict(stored) for event_id, stored in events.to_map().items()}
+            self.etags[username] = self.etags.get(username, 0) + 1
+        return True, None
+
+    def query_events(self, username, start, end, limit):
+        events = self.read_events(username)[0].between(start, end)
+        return event_store.UserEvents(events[:limit] if limit is not None else events)
+
+    def list_event_owners(self):
+        time.sleep(self.latency)
+        with self.lock:
+            return list(self.events)
+
+    def archive_events(self, username, changes):
+        time.sleep(self.latency)
+        with self.lock:
+            self.archive.setdefault(username, {}).update(changes)
+
+    def read_version(self, username):
+        # The ETag counter doubles as the version, like in the SQLite backend
+        time.sleep(self.latency)
+        with self.lock:
+            return self.etags.get(username, 0)
+
+    def bump_version(self, username):
+        with self.lock:
+            self.etags[username] = self.etags.get(username, 0) + 1
+
+    def get_refresh_token(self, username):
+        time.sleep(self.latency)
+        with self.lock:
+            return self.tokens.get(username)
+
+    def put_refresh_token(self, username, refresh_token):
+        time.sleep(self.latency)
+        with self.lock:
+            self.tokens[username] = refresh_token
+        self.bump_version(username)
+
+    def delete_refresh_token(self, username):
+        time.sleep(self.latency)
+        with self.lock:
+            self.tokens[username] = None
+        self.bump_version(username)
+
+
+class FakeResponse:
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeRecipesSession:
+    # Stands in for utils.get_session() when communicate calls the recipes service
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def request(self, method, url, json=None, timeout=None, headers=None):
+        time.sleep(self.latency)
+        if method == 'POST':
+            return FakeResponse([recipe(recipe_id) for recipe_id in json['ids']])
+        return FakeResponse(recipe(url.rsplit('/', 1)[1]))
+
+
+class FakeCalendar:
+    # Enough of the Calendar API client for the inserts in service.py
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId, body):
+        return FakeInsert(self.latency)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self.latency, callback)
+
+
+class FakeInsert:
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency)
+        return {'htmlLink': 'https://calendar.invalid/event'}
+
+
+class FakeBatch:
+
+    def __init__(self, latency, callback):
+        self.latency = latency
+        self.callback = callback
+        self.request_ids = []
+
+    def add(self, request, request_id):
+        self.request_ids.append(request_id)
+
+    def execute(self):
+        time.sleep(self.latency)
+        for request_id in self.request_ids:
+            self.callback(request_id, {'htmlLink': 'https://calendar.invalid/event'}, None)
+
+
+def event(event_id, number):
+    return {'id': event_id, 'recipe': str(number % RECIPES), 'synced': False, 'timestamp': FUTURE + number * 60}
+
+
+def recipe(recipe_id):
+    return {'_id': recipe_id, 'name': f'recipe {recipe_id}', 'summary': 'benchmark', 'tags': ['benchmark']}
+
+
+def install_fakes(latency):
+    database = FakeDatabase(latency)
+    storage.backend = database
+    session = FakeRecipesSession(latency)
+    utils.get_session = lambda: session
+    calendar = FakeCalendar(latency)
+
+    @contextmanager
+    def calendar_service(username, refresh_token):
+        yield calendar
+    google_calendar.calendar_service = calendar_service
+    return database
+
+
+def reset(database, users, events_per_user):
+    database.events.clear()
+    database.seed(users, events_per_user)
+    storage.tokens_cache.clear()
+    service.events_cache.clear()
+    recipes.cache.clear()
+
+
+def plan(endpoint, users, events_per_user, count, seed):
+    # The same requests for a given seed: (username, method, path, body, after) where
+    # after(database) undoes the change so every request sees the same data size
+    rng = random.Random(seed)
+    requests_plan = []
+    for number in range(count):
+        user = rng.randrange(users)
+        username = f'user{user}'
+        event_id = f'{username}-{rng.randrange(events_per_user)}'
+        original = event(event_id, int(event_id.rsplit('-', 1)[1]))
+        restore = (lambda database, username=username, event_id=event_id, original=original:
+                   database.restore(username, event_id, dict(original)))
+        if endpoint in ('get', 'get-cached'):
+            requests_plan.append((username, 'GET', '/api/v1/events', None, None))
+        elif endpoint == 'post':
+            body = {'timestamp': FUTURE + rng.randrange(3600), 'id': str(rng.randrange(RECIPES))}
+            requests_plan.append((username, 'POST', '/api/v1/events', body, None))
+        elif endpoint == 'put':
+            body = {'id': event_id, 'timestamp': FUTURE + rng.randrange(3600), 'synced': False}
+            requests_plan.append((username, 'PUT', '/api/v1/events', body, restore))
+        elif endpoint == 'sync':
+            # Users with an odd number are not logged in Google and get a 400
+            username = f'user{user - user % 2}'
+            event_id = f'{username}-{rng.randrange(events_per_user)}'
+            original = event(event_id, int(event_id.rsplit('-', 1)[1]))
+            restore = (lambda database, username=username, event_id=event_id, original=original:
+                       database.restore(username, event_id, dict(original)))
+            body = {'id': event_id, 'timestamp': original['timestamp'], 'synced': True}
+            requests_plan.append((username, 'PUT', '/api/v1/events', body, restore))
+        elif endpoint == 'delete':
+            requests_plan.append((username, 'DELETE', f'/api/v1/events/{event_id}', None, restore))
+    return requests_plan
+
+
+@functools.lru_cache(maxsize=None)
+def token(username):
+    return jwt.encode({'username': username, 'plan': 'premium'}, JWT_SECRET, algorithm='HS256')
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_client(app, database, endpoint, requests_plan):
+    # Sequential, through the Flask test client
+    clients = {}
+    latencies = []
+    failed = 0
+    started = time.perf_counter()
+    for username, method, path, body, after in requests_plan:
+        client = clients.get(username)
+        if client is None:
+            client = clients[username] = app.test_client()
+            client.set_cookie('localhost', 'authToken', token(username))
+        if endpoint == 'get':
+            service.events_cache.clear()
+        request_started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        latencies.append(time.perf_counter() - request_started)
+        failed += response.status_code >= 400
+        if after is not None:
+            after(database)
+    return time.perf_counter() - started, latencies, failed
+
+
+def run_server(base_url, database, endpoint, requests_plan, concurrency):
+    # Concurrent, over HTTP to a threaded werkzeug server in this process
+    local = threading.local()
+
+    def send(planned):
+        username, method, path, body, after = planned
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        if endpoint == 'get':
+            service.events_cache.clear()
+        request_started = time.perf_counter()
+        response = session.request(method, base_url + path, json=body, cookies={'authToken': token(username)})
+        latency = time.perf_counter() - request_started
+        if after is not None:
+            after(database)
+        return latency, response.status_code >= 400
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, requests_plan))
+    return time.perf_counter() - started, [latency for latency, _ in results], sum(failed for _, failed in results)
+
+
+def allocations(app, database, endpoint, requests_plan):
+    # Mean peak of memory allocated while serving one request, traced separately from the timings
+    client = app.test_client()
+    peaks = []
+    for username, method, path, body, after in requests_plan:
+        client.set_cookie('localhost', 'authToken', token(username))
+        if endpoint == 'get':
+            service.events_cache.clear()
+        tracemalloc.start()
+        client.open(path, method=method, json=body)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        if after is not None:
+            after(database)
+    return sum(peaks) / len(peaks) / 1024
+
+
+def compare(results, baseline, tolerance, alloc_tolerance):
+    regressions = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        if result['throughput'] < expected['throughput'] * (1 - tolerance):
+            regressions.append(f"{key}: {result['throughput']:.1f} requests/sec, baseline {expected['throughput']:.1f}")
+        for metric, allowed in (('p50_ms', tolerance), ('alloc_kib', alloc_tolerance)):
+            if metric in expected and result[metric] > expected[metric] * (1 + allowed):
+                regressions.append(f'{key}: {metric} {result[metric]:.2f}, baseline {expected[metric]:.2f}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default='1,100', help='users in the database, comma separated')
+    parser.add_argument('--events', default='10,200', help='events per user, comma separated')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--modes', default='client,server')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--allocation-requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=1, help='injected in every fake call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results to this baseline file')
+    parser.add_argument('--check', help='compare the results with this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--alloc-tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Request logs would dominate the timings
+    logging.disable(logging.INFO)
+    app = create_app()
+    database = install_fakes(args.latency_ms / 1000)
+    modes = args.modes.split(',')
+    server = None
+    if 'server' in modes:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+    results = {}
+    print(f"{'scenario':<36} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'KiB/req':>8} {'failed':>6}")
+    try:
+        for users in [int(value) for value in args.users.split(',')]:
+            for events_per_user in [int(value) for value in args.events.split(',')]:
+                for endpoint in args.endpoints.split(','):
+                    requests_plan = plan(endpoint, users, events_per_user, args.requests, args.seed)
+                    for mode in modes:
+                        reset(database, users, events_per_user)
+                        if mode == 'client':
+                            elapsed, latencies, failed = run_client(app, database, endpoint, requests_plan)
+                        else:
+                            elapsed, latencies, failed = run_server(base_url, database, endpoint, requests_plan,
+                                                                    args.concurrency)
+                        key = f'{mode}/{endpoint}/{users}u/{events_per_user}e'
+                        result = {
+                            'throughput': len(requests_plan) / elapsed,
+                            'p50_ms': percentile(latencies, 0.5) * 1000,
+                            'p99_ms': percentile(latencies, 0.99) * 1000,
+                            'failed': failed
+                        }
+                        if mode == 'client':
+                            reset(database, users, events_per_user)
+                            result['alloc_kib'] = allocations(app, database, endpoint,
+                                                              requests_plan[:args.allocation_requests])
+                        results[key] = result
+                        print(f"{key:<36} {result['throughput']:>9.1f} {result['p50_ms']:>8.2f} "
+                              f"{result['p99_ms']:>8.2f} {result.get('alloc_kib', 0):>8.1f} {failed:>6}")
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+    if args.check:
+        with open(args.check) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance, args.alloc_tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
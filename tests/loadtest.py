@@ -0,0 +1,173 @@
+# Measures requests/sec of GET /api/v1/events under gunicorn, with Firebase and recipes stubbed
+#
+#   python tests/loadtest.py --requests 2000 --concurrency 32 --workers 2 --threads 8
+#
+# --storage sqlite reads the events from a seeded embedded database instead of the Firebase stub
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import subprocess
+import threading
+import tempfile
+import ssl
+import argparse
+import requests
+import socket
+import json
+import time
+import jwt
+import sys
+import os
+
+JWT_SECRET = 'loadtest-secret-loadtest-secret-loadtest'
+USERNAME = 'loadtest'
+EVENTS = [
+    {"id": str(number), "recipe": str(number % 5), "synced": False, "timestamp": 3471698180 + number}
+    for number in range(20)
+]
+
+
+class BackendHandler(BaseHTTPRequestHandler):
+    # Serves both the Firebase REST API and the recipes service
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == f'/events/{USERNAME}.json':
+            self.reply(EVENTS, {'ETag': 'loadtest'})
+        elif path.startswith('/users/') or path.startswith('/versions/'):
+            self.reply(None)
+        elif path.startswith('/api/v1/recipes/'):
+            self.reply(recipe(path.rsplit('/', 1)[1]))
+        else:
+            self.reply({})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.reply([recipe(recipe_id) for recipe_id in body['ids']])
+
+    def reply(self, body, headers={}):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def recipe(recipe_id):
+    return {"_id": recipe_id, "name": f"recipe {recipe_id}", "summary": "loadtest", "tags": ["loadtest"]}
+
+
+def self_signed_certificate(directory):
+    # The database is always reached over https
+    certificate = os.path.join(directory, 'backend.pem')
+    key = os.path.join(directory, 'backend.key')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+         '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key, '-out', certificate],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return certificate, key
+
+
+def seed_database(root, env):
+    # Importing flaskr reads its configuration from the environment
+    os.environ.update(env)
+    sys.path.insert(0, root)
+    from flaskr.sqlite_storage import SQLiteStorage
+    from flaskr.event_store import UserEvents
+    SQLiteStorage(env['STORAGE_SQLITE_PATH']).write_events(USERNAME, UserEvents(EVENTS), '0')
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_until_ready(url, deadline):
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('gunicorn did not become ready')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--keepalive', type=int, default=5)
+    parser.add_argument('--storage', choices=['firebase', 'sqlite'], default='firebase')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    certificate, key = self_signed_certificate(directory)
+    backend = ThreadingHTTPServer(('127.0.0.1', 0), BackendHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+    backend.socket = context.wrap_socket(backend.socket, server_side=True)
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+    backend_url = f'https://127.0.0.1:{backend.server_address[1]}'
+
+    port = free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        DATABASE_URL=backend_url,
+        RECIPES_URL=backend_url,
+        JWT_SECRET=JWT_SECRET,
+        REQUESTS_CA_BUNDLE=certificate,
+        GUNICORN_BIND=f'127.0.0.1:{port}',
+        GUNICORN_WORKERS=str(args.workers),
+        GUNICORN_THREADS=str(args.threads),
+        GUNICORN_KEEPALIVE=str(args.keepalive),
+        STORAGE_BACKEND=args.storage,
+        STORAGE_SQLITE_PATH=os.path.join(directory, 'planner.db')
+    )
+    if args.storage == 'sqlite':
+        seed_database(root, env)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'flaskr.wsgi:app'],
+        cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        wait_until_ready(base_url, time.monotonic() + 30)
+        token = jwt.encode({'username': USERNAME, 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+        local = threading.local()
+
+        def get_events(_):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+                session.cookies.set('authToken', token)
+            return session.get(f'{base_url}/api/v1/events').status_code
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            statuses = list(pool.map(get_events, range(args.requests)))
+        elapsed = time.monotonic() - started
+
+        failed = len([status for status in statuses if status != 200])
+        print(f'{args.requests} requests, {args.concurrency} concurrent, '
+              f'{args.workers} workers x {args.threads} threads')
+        print(f'{args.requests / elapsed:.1f} requests/sec, {failed} failed')
+    finally:
+        server.terminate()
+        server.wait()
+        backend.shutdown()
+
+
+if __name__ == '__main__':
+    main()
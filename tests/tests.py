@@ -1,8 +1,17 @@
 import pytest
 from flaskr import create_app
-from unittest.mock import Mock
+from flaskr import recipes
+from flaskr import storage
+from flaskr import event_store
+from flaskr import google_calendar
+from flaskr import auth
+from flaskr import service
+from flaskr.sqlite_storage import SQLiteStorage
+from unittest.mock import MagicMock, Mock
 import jwt
 import os
+import json
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +22,17 @@ def app():
     app = create_app()
     yield app
 
+@pytest.fixture(autouse=True)
+def clear_recipe_cache(monkeypatch):
+    recipes.cache.clear()
+    storage.tokens_cache.clear()
+    google_calendar.clients.clear()
+    auth.verified_tokens.clear()
+    service.events_cache.clear()
+    monkeypatch.setattr('flaskr.recipes.batch_unavailable_until', 0)
+    # The stored version of every user, tests that change it patch it themselves
+    monkeypatch.setattr('flaskr.storage.backend.read_version', lambda username: 0)
+
 @pytest.fixture
 def client(app):
     return app.test_client()
@@ -38,26 +58,56 @@ def test_get_events_without_auth(client):
     response = client.get('/api/v1/events')
     assert response.status_code == 401
 
+def test_get_events_with_malformed_token(client):
+    client.set_cookie('localhost', 'authToken', 'not-a-jwt')
+    response = client.get('/api/v1/events')
+    assert response.status_code == 401
+    assert response.json['message'] == 'Unauthorized'
+
+def test_get_events_with_expired_token(client):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base', 'exp': int(time.time()) - 10}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+    assert client.get('/api/v1/events').status_code == 401
+
+def test_get_events_with_token_signed_with_other_secret(client):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, 'other-secret', algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+    assert client.get('/api/v1/events').status_code == 401
+
+def test_auth_verifies_each_token_once(monkeypatch):
+    decode_stub = Mock(side_effect=jwt.decode)
+    monkeypatch.setattr('flaskr.auth.jwt.decode', decode_stub)
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base', 'exp': int(time.time()) + 60}, JWT_SECRET, algorithm='HS256')
+
+    assert auth.verify(token)['username'] == 'maribelrb'
+    assert auth.verify(token)['username'] == 'maribelrb'
+    assert decode_stub.call_count == 1
+    assert auth.verify('not-a-jwt') is None
+    assert auth.verify('not-a-jwt') is None
+    assert decode_stub.call_count == 3
+
+def test_auth_cache_honors_token_expiry(monkeypatch):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base', 'exp': int(time.time()) + 1}, JWT_SECRET, algorithm='HS256')
+    assert auth.verify(token) is not None
+    time.sleep(1.1)
+    assert auth.verify(token) is None
+
 def test_get_events_with_auth(client, monkeypatch):
     events_stub = Mock()
-    events_stub.return_value ={
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 1578243461
-            }
-        ],
+    events_stub.return_value = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 1578243461
         }
-    }
+    ])
     logged_in_stub = Mock()
     logged_in_stub.return_value = "auth_token"
 
@@ -70,7 +120,7 @@ def test_get_events_with_auth(client, monkeypatch):
         "imageUrl": "https://spoonacular.com/recipeImages/1-556x370.jpg",
     }
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
     monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_stub)
 
@@ -83,12 +133,12 @@ def test_get_events_with_auth(client, monkeypatch):
 
 def test_get_events_with_auth_and_no_events_exists_in_db(client, monkeypatch):
     events_stub = Mock()
-    events_stub.return_value = None
+    events_stub.return_value = event_store.UserEvents()
 
     logged_in_stub = Mock()
     logged_in_stub.return_value = "auth_token"
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get' , events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events' , events_stub)
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
     
     token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
@@ -100,29 +150,12 @@ def test_get_events_with_auth_and_no_events_exists_in_db(client, monkeypatch):
 
 def test_get_events_with_auth_and_no_events(client, monkeypatch):
     events_stub = Mock()
-    events_stub.return_value = events_stub.return_value ={
-        "-NJioAHojZF1Plwd4QC3": {
-        "javivm17": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
-        }
-    }
+    events_stub.return_value = event_store.UserEvents()
 
     logged_in_stub = Mock()
     logged_in_stub.return_value = "auth_token"
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get' , events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events' , events_stub)
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
     
     token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
@@ -134,12 +167,12 @@ def test_get_events_with_auth_and_no_events(client, monkeypatch):
 
 def test_get_events_with_auth_and_user_not_logged_in(client, monkeypatch):
     events_stub = Mock()
-    events_stub.return_value = None
+    events_stub.return_value = event_store.UserEvents()
 
     logged_in_stub = Mock()
     logged_in_stub.return_value = None
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get' , events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events' , events_stub)
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
     
     token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
@@ -151,28 +184,24 @@ def test_get_events_with_auth_and_user_not_logged_in(client, monkeypatch):
 
 def test_get_events_with_auth_and_fail_to_connect_with_recipes(client, monkeypatch):
     events_stub = Mock()
-    events_stub.return_value ={
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 1578243461
-            }
-        ],
+    events_stub.return_value = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 1578243461
         }
-    }
+    ])
     logged_in_stub = Mock()
     logged_in_stub.return_value = "auth_token"
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
 
     token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
@@ -184,31 +213,27 @@ def test_get_events_with_auth_and_fail_to_connect_with_recipes(client, monkeypat
 
 def test_get_events_with_auth_and_an_invalid_recipe(client, monkeypatch):
     events_stub = Mock()
-    events_stub.return_value ={
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 1578243461
-            }
-        ],
+    events_stub.return_value = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 1578243461
         }
-    }
+    ])
     logged_in_stub = Mock()
     logged_in_stub.return_value = "auth_token"
 
     recipes_stub = Mock()
     recipes_stub.return_value = None
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
     monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_stub)
 
@@ -218,6 +243,192 @@ def test_get_events_with_auth_and_an_invalid_recipe(client, monkeypatch):
     response = client.get('/api/v1/events')
     assert response.status_code == 200
 
+def test_get_events_with_auth_fetches_each_recipe_once_and_keeps_order(client, monkeypatch):
+    events_stub = Mock()
+    events_stub.return_value = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "2",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698181
+        },
+        {
+            "id": "2b8c1f0d8a2d4e0a9c6b3f3e1d2c4b5a",
+            "recipe": "2",
+            "synced": False,
+            "timestamp": 3471698182
+        }
+    ])
+    logged_in_stub = Mock()
+    logged_in_stub.return_value = None
+
+    def recipes_stub(method, url, body=None, not_found=None):
+        if url.endswith('/batch'):
+            return [{"_id": recipe_id, "name": "test", "tags": []} for recipe_id in body['ids']]
+        recipe_id = url.rsplit('/', 1)[-1]
+        return {"_id": recipe_id, "name": "test", "tags": []}
+    recipes_mock = Mock(side_effect=recipes_stub)
+
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_mock)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    response = client.get('/api/v1/events')
+    assert response.status_code == 200
+    assert recipes_mock.call_count == 1
+    assert recipes_mock.call_args.args[2] == {'ids': ["2", "1"]}
+    assert [event['recipe']['id'] for event in response.json['events']] == ["2", "1", "2"]
+
+def test_get_events_with_invalid_query(client):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    assert client.get('/api/v1/events?from=tomorrow').json['message'] == 'From must be an integer'
+    assert client.get('/api/v1/events?limit=0').status_code == 400
+    assert client.get('/api/v1/events?from=200&to=100').status_code == 400
+    assert client.get('/api/v1/events?limit=2&cursor=abc').json['message'] == 'Invalid cursor'
+
+def test_get_events_pages_through_time_window(client, monkeypatch):
+    stored_events = [
+        {"id": event_id, "recipe": "1", "synced": False, "timestamp": timestamp}
+        for event_id, timestamp in [("e", 3471698190), ("a", 3471698180), ("c", 3471698180),
+                                    ("b", 3471698180), ("d", 3471698185), ("f", 3471698300)]
+    ]
+    reads = []
+
+    def get_events(username, start=None, end=None, limit=None):
+        # Same ordering and filtering as the Firebase query
+        reads.append((start, end, limit))
+        window = event_store.UserEvents(stored_events).between(start, end)
+        return event_store.UserEvents(window[:limit])
+
+    logged_in_stub = Mock()
+    logged_in_stub.return_value = None
+    recipes_stub = Mock()
+    recipes_stub.return_value = {"_id": "1", "name": "test", "tags": []}
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', get_events)
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_stub)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    pages = []
+    url = '/api/v1/events?from=3471698180&to=3471698200&limit=2'
+    response = client.get(url)
+    while True:
+        assert response.status_code == 200
+        pages.append([event['id'] for event in response.json['events']])
+        if response.json['nextCursor'] is None:
+            break
+        response = client.get(url + '&cursor=' + response.json['nextCursor'])
+
+    assert pages == [["a", "b"], ["c", "d"], ["e"]]
+    assert reads[0] == (3471698180, 3471698200, 3)
+    assert reads[1] == (3471698180, 3471698200, 5)
+
+def test_get_events_is_cached_until_the_user_changes_something(client, monkeypatch):
+    events_stub = Mock()
+    events_stub.return_value = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        }
+    ])
+    logged_in_stub = Mock()
+    logged_in_stub.return_value = None
+    recipes_stub = Mock()
+    recipes_stub.return_value = {"_id": "1", "name": "test", "tags": []}
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', lambda username: (events_stub(), "etag"))
+    write_stub = Mock()
+    write_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', write_stub)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    first = client.get('/api/v1/events')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    second = client.get('/api/v1/events')
+    assert second.json == first.json
+    assert second.headers['ETag'] == etag
+    revalidated = client.get('/api/v1/events', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert events_stub.call_count == 1
+
+    # Other pages are cached separately
+    assert client.get('/api/v1/events?limit=5').headers['ETag'] != etag
+    assert events_stub.call_count == 2
+
+    assert client.delete('/api/v1/events/6d0cde4325df4821afd2d71153f4ae06').status_code == 204
+    write_stub.assert_called_once()
+    changed = client.get('/api/v1/events', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert events_stub.call_count == 4
+
+def test_get_events_cache_sees_changes_from_other_processes(client, monkeypatch):
+    stored_version = {'maribelrb': 3}
+    monkeypatch.setattr('flaskr.storage.backend.read_version', lambda username: stored_version[username])
+    events_stub = Mock()
+    events_stub.return_value = event_store.UserEvents()
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', Mock(return_value=None))
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    etag = client.get('/api/v1/events').headers['ETag']
+    assert client.get('/api/v1/events', headers={'If-None-Match': etag}).status_code == 304
+    # Another worker or replica writes the user's events
+    stored_version['maribelrb'] += 1
+    assert client.get('/api/v1/events', headers={'If-None-Match': etag}).status_code == 200
+    assert events_stub.call_count == 2
+
+def test_get_events_is_served_uncached_when_the_version_cannot_be_read(client, monkeypatch):
+    monkeypatch.setattr('flaskr.storage.backend.read_version', Mock(side_effect=Exception('Permission denied')))
+    events_stub = Mock()
+    events_stub.return_value = event_store.UserEvents()
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', Mock(return_value=None))
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    etag = client.get('/api/v1/events').headers['ETag']
+    assert client.get('/api/v1/events', headers={'If-None-Match': etag}).status_code == 200
+    assert events_stub.call_count == 2
+
+def test_get_events_cache_is_per_user(client, monkeypatch):
+    events_stub = Mock()
+    events_stub.return_value = event_store.UserEvents()
+    logged_in_stub = Mock()
+    logged_in_stub.return_value = None
+    monkeypatch.setattr('flaskr.controller.service.storage.get_events', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', logged_in_stub)
+
+    for username in ['maribelrb', 'javivm17']:
+        token = jwt.encode({'username': username, 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+        client.set_cookie('localhost', 'authToken', token)
+        assert client.get('/api/v1/events').status_code == 200
+    assert [call.args[0] for call in events_stub.call_args_list] == ['maribelrb', 'javivm17']
+
 ############################################################################################################
 ############################################ CREATE TESTS ##################################################
 ############################################################################################################
@@ -235,16 +446,12 @@ def test_create_event_with_auth_and_valid_data(client, monkeypatch):
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
-
-    post_stub = Mock()
-    post_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.post', post_stub)
+    events_stub.return_value = (event_store.UserEvents(), "etag")
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
 
     recipes_stub = Mock()
@@ -314,16 +521,12 @@ def test_create_event_with_auth_and_invalid_recipe(client, monkeypatch):
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
-
-    post_stub = Mock()
-    post_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.post', post_stub)
+    events_stub.return_value = (event_store.UserEvents(), "etag")
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
 
     recipes_stub = Mock()
@@ -345,34 +548,26 @@ def test_create_event_with_auth_and_valid_data_for_user_with_events(client, monk
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
         }
-    }
-
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    ]), "etag")
 
-    post_stub = Mock()
-    post_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.post', post_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     recipes_stub = Mock()
     recipes_stub.return_value = {
@@ -402,16 +597,12 @@ def test_create_event_with_auth_and_valid_data(client, monkeypatch):
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
-
-    post_stub = Mock()
-    post_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.post', post_stub)
+    events_stub.return_value = (event_store.UserEvents(), "etag")
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     recipes_stub = Mock()
     recipes_stub.return_value = {
@@ -480,16 +671,12 @@ def test_create_event_with_auth_and_valid_data_and_fail_to_connect_with_recipes(
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
-
-    post_stub = Mock()
-    post_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.post', post_stub)
+    events_stub.return_value = (event_store.UserEvents(), "etag")
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     body = {
         "timestamp": 1737250585,
@@ -517,30 +704,26 @@ def test_update_event_with_auth_and_valid_data_timestamp(client, monkeypatch):
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
         }
-    }
+    ]), "etag")
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     body = {
         "timestamp": 1737250585,
@@ -556,38 +739,33 @@ def test_update_event_with_auth_and_valid_data_synced_and_logged_in_google(clien
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 1737250585
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 1737250585
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
         }
-    }
+    ]), "etag")
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     check_user_stub = Mock()
     check_user_stub.return_value = "refreshtoken"
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
 
-    build_stub = Mock()
-    build_stub.return_value = True
-    monkeypatch.setattr('flaskr.controller.service.build', build_stub)
+    calendar_stub = MagicMock()
+    monkeypatch.setattr('flaskr.controller.service.google_calendar.calendar_service', calendar_stub)
 
     service_stub = Mock()
     service_stub.return_value = {}
@@ -617,38 +795,33 @@ def test_update_event_with_auth_and_valid_data_synced_and_not_logged_in_google(c
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
         }
-    }
+    ]), "etag")
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     check_user_stub = Mock()
     check_user_stub.return_value = None
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
 
-    build_stub = Mock()
-    build_stub.return_value = True
-    monkeypatch.setattr('flaskr.controller.service.build', build_stub)
+    calendar_stub = MagicMock()
+    monkeypatch.setattr('flaskr.controller.service.google_calendar.calendar_service', calendar_stub)
 
     service_stub = Mock()
     service_stub.return_value = {}
@@ -668,38 +841,33 @@ def test_update_event_with_auth_and_valid_data_synced_for_event_synced(client, m
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": True,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": True,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": True,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": True,
+            "timestamp": 3471698180
         }
-    }
+    ]), "etag")
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     check_user_stub = Mock()
     check_user_stub.return_value = "refreshtoken"
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
 
-    build_stub = Mock()
-    build_stub.return_value = True
-    monkeypatch.setattr('flaskr.controller.service.build', build_stub)
+    calendar_stub = MagicMock()
+    monkeypatch.setattr('flaskr.controller.service.google_calendar.calendar_service', calendar_stub)
 
     service_stub = Mock()
     service_stub.return_value = {}
@@ -719,38 +887,33 @@ def test_update_event_with_auth_and_valid_data_synced_for_non_exists_event(clien
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
         }
-    }
+    ]), "etag")
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     check_user_stub = Mock()
     check_user_stub.return_value = "refreshtoken"
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
 
-    build_stub = Mock()
-    build_stub.return_value = True
-    monkeypatch.setattr('flaskr.controller.service.build', build_stub)
+    calendar_stub = MagicMock()
+    monkeypatch.setattr('flaskr.controller.service.google_calendar.calendar_service', calendar_stub)
 
     service_stub = Mock()
     service_stub.return_value = {}
@@ -820,38 +983,33 @@ def test_update_event_with_auth_and_valid_data_synced_and_logged_in_google_and_f
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": "1",
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
         }
-    }
+    ]), "etag")
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     check_user_stub = Mock()
     check_user_stub.return_value = "refreshtoken"
     monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
 
-    build_stub = Mock()
-    build_stub.return_value = True
-    monkeypatch.setattr('flaskr.controller.service.build', build_stub)
+    calendar_stub = MagicMock()
+    monkeypatch.setattr('flaskr.controller.service.google_calendar.calendar_service', calendar_stub)
 
     service_stub = Mock()
     service_stub.return_value = {}
@@ -867,6 +1025,305 @@ def test_update_event_with_auth_and_valid_data_synced_and_logged_in_google_and_f
     assert response.status_code == 500
     assert response.json['message'] == 'Failed to communicate with recipes service'
 
+def test_update_event_with_auth_and_synced_in_async_mode(client, monkeypatch):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+    monkeypatch.setattr('flaskr.controller.service.SYNC_MODE', 'async')
+
+    stored_events = [
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        }
+    ]
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', lambda username: (event_store.UserEvents(dict(event) for event in stored_events), "etag"))
+
+    def write_events(username, events, etag):
+        stored_events[:] = list(events)
+        return True, None
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', write_events)
+
+    check_user_stub = Mock()
+    check_user_stub.return_value = "refreshtoken"
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
+
+    submit_stub = Mock()
+    monkeypatch.setattr('flaskr.controller.service.jobs.submit', submit_stub)
+
+    sync_stub = Mock()
+    sync_stub.return_value = (True, "Event modified successfully")
+    monkeypatch.setattr('flaskr.controller.service.sync_with_google_calendar', sync_stub)
+
+    body = {
+        "timestamp": int(time.time()) + 86400,
+        "id": "6d0cde4325df4821afd2d71153f4ae06",
+        "synced": True
+    }
+
+    response = client.put('/api/v1/events', json=body)
+    assert response.status_code == 202
+    assert stored_events[0]['syncStatus'] == 'pending'
+    sync_stub.assert_not_called()
+    # Already scheduled
+    assert client.put('/api/v1/events', json=body).status_code == 202
+    submit_stub.assert_called_once()
+
+    run_job = submit_stub.call_args.args[1]
+    # A second job for the same event, running while the first one talks to Google, skips it
+    sync_stub.side_effect = lambda username, event: run_job() or (True, "Event modified successfully")
+    run_job()
+    sync_stub.assert_called_once()
+    assert stored_events[0]['synced'] is True
+    assert 'syncStatus' not in stored_events[0]
+    assert 'syncClaim' not in stored_events[0]
+
+def test_sync_job_is_retried_and_gives_up(monkeypatch):
+    from flaskr import jobs
+    import threading
+
+    monkeypatch.setattr('flaskr.jobs.RETRY_BACKOFF', 0)
+    monkeypatch.setattr('flaskr.jobs.MAX_ATTEMPTS', 3)
+
+    attempts = []
+    gave_up = threading.Event()
+
+    def run():
+        attempts.append(1)
+        raise Exception("Google is down")
+
+    jobs.submit('failing job', run, gave_up.set)
+    assert gave_up.wait(timeout=5)
+    assert len(attempts) == 3
+
+def test_sync_all_events_without_auth(client):
+    response = client.post('/api/v1/events/sync-all')
+    assert response.status_code == 401
+
+def test_sync_all_events_with_auth_and_not_logged_in_google(client, monkeypatch):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'premium'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    check_user_stub = Mock()
+    check_user_stub.return_value = None
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
+
+    response = client.post('/api/v1/events/sync-all')
+    assert response.status_code == 400
+
+def test_sync_all_events_with_auth_and_logged_in_google(client, monkeypatch):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'premium'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    events_stub = Mock()
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "2b8c1f0d8a2d4e0a9c6b3f3e1d2c4b5a",
+            "recipe": "1",
+            "synced": True,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "9f1c2d3e4b5a60718293a4b5c6d7e8f9",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 1578243461
+        }
+    ]), "etag")
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
+
+    put_stub = Mock()
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
+
+    check_user_stub = Mock()
+    check_user_stub.return_value = "refreshtoken"
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', check_user_stub)
+
+    recipes_stub = Mock()
+    recipes_stub.return_value = {"_id": "1", "name": "test", "summary": "test", "tags": ["test"]}
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_stub)
+
+    batches = []
+
+    class BatchStub:
+        def __init__(self, callback):
+            self.callback = callback
+            self.request_ids = []
+
+        def add(self, request, request_id):
+            self.request_ids.append(request_id)
+
+        def execute(self):
+            batches.append(self.request_ids)
+            for request_id in self.request_ids:
+                self.callback(request_id, {"htmlLink": "https://calendar.google.com"}, None)
+
+    calendar_stub = MagicMock()
+    google_service = calendar_stub.return_value.__enter__.return_value
+    google_service.new_batch_http_request.side_effect = lambda callback: BatchStub(callback)
+    monkeypatch.setattr('flaskr.controller.service.google_calendar.calendar_service', calendar_stub)
+
+    response = client.post('/api/v1/events/sync-all')
+    assert response.status_code == 200
+    assert response.json == {"synced": 2, "failed": 0}
+    assert [sorted(batch) for batch in batches] == [["612dd6ffb76744a2951ca14e0755d7d7", "6d0cde4325df4821afd2d71153f4ae06"]]
+    assert recipes_stub.call_count == 1
+    put_stub.assert_called_once()
+    assert [event['synced'] for event in put_stub.call_args.args[1]] == [True, True, True, False]
+
+def test_sync_all_events_saves_synced_events_when_a_batch_fails(client, monkeypatch):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    events_stub = Mock()
+    events_stub.return_value = (event_store.UserEvents([
+        {"id": str(number), "recipe": "1", "synced": False, "timestamp": 3471698180 + number} for number in range(3)
+    ]), "etag")
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
+    put_stub = Mock()
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
+    monkeypatch.setattr('flaskr.controller.service.check_user_logged_in', Mock(return_value="refreshtoken"))
+    recipes_stub = Mock()
+    recipes_stub.return_value = {"_id": "1", "name": "test", "summary": "test", "tags": ["test"]}
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_stub)
+    monkeypatch.setattr('flaskr.controller.service.GOOGLE_BATCH_SIZE', 2)
+
+    class BatchStub:
+        def __init__(self, callback):
+            self.callback = callback
+            self.request_ids = []
+
+        def add(self, request, request_id):
+            self.request_ids.append(request_id)
+
+        def execute(self):
+            if "2" in self.request_ids:
+                raise Exception("Google down")
+            for request_id in self.request_ids:
+                self.callback(request_id, {"htmlLink": "https://calendar.google.com"}, None)
+
+    calendar_stub = MagicMock()
+    google_service = calendar_stub.return_value.__enter__.return_value
+    google_service.new_batch_http_request.side_effect = lambda callback: BatchStub(callback)
+    monkeypatch.setattr('flaskr.controller.service.google_calendar.calendar_service', calendar_stub)
+
+    response = client.post('/api/v1/events/sync-all')
+    assert response.status_code == 200
+    assert response.json == {"synced": 2, "failed": 1}
+    assert [event['synced'] for event in put_stub.call_args.args[1]] == [True, True, False]
+
+############################################################################################################
+############################################ BATCH TESTS ###################################################
+############################################################################################################
+
+def test_batch_events_without_auth(client):
+    assert client.post('/api/v1/events/batch', json={"operations": []}).status_code == 401
+
+def test_batch_events_without_operations(client):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    assert client.post('/api/v1/events/batch', json={}).status_code == 400
+    response = client.post('/api/v1/events/batch', json={"operations": []})
+    assert response.status_code == 400
+    assert response.json['message'] == 'Operations must be a non-empty list'
+
+def test_batch_events_applies_valid_operations_in_one_write(client, monkeypatch):
+    stored_events = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": True,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "2b8c1f0d8a2d4e0a9c6b3f3e1d2c4b5a",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        }
+    ])
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', lambda username: (stored_events, "etag"))
+    write_stub = Mock()
+    write_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', write_stub)
+
+    def recipes_stub(method, url, body=None, not_found=None):
+        assert url.endswith('/batch')
+        return [{"_id": recipe_id, "name": "test", "tags": []} for recipe_id in body['ids'] if recipe_id != "404"]
+    recipes_mock = Mock(side_effect=recipes_stub)
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_mock)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    timestamp = int(time.time()) + 86400
+    response = client.post('/api/v1/events/batch', json={"operations": [
+        {"op": "create", "id": "1", "timestamp": timestamp},
+        {"op": "create", "id": "2", "timestamp": timestamp},
+        {"op": "create", "id": "1", "timestamp": timestamp},
+        {"op": "create", "id": "404", "timestamp": timestamp},
+        {"op": "create", "id": "1", "timestamp": 100},
+        {"op": "update", "id": "6d0cde4325df4821afd2d71153f4ae06", "timestamp": timestamp, "synced": False},
+        {"op": "update", "id": "612dd6ffb76744a2951ca14e0755d7d7", "timestamp": timestamp, "synced": False},
+        {"op": "delete", "id": "2b8c1f0d8a2d4e0a9c6b3f3e1d2c4b5a"},
+        {"op": "move", "id": "2b8c1f0d8a2d4e0a9c6b3f3e1d2c4b5a"}
+    ]})
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [result['status'] for result in results] == [201, 201, 201, 400, 400, 200, 400, 204, 400]
+    assert results[3]['message'] == 'Recipe not found'
+    assert results[4]['message'] == 'Date is in the past'
+    assert results[6]['message'] == "You can't modify a synced event"
+    assert results[8]['message'] == 'Op must be create, update or delete'
+
+    assert recipes_mock.call_count == 1
+    assert sorted(recipes_mock.call_args.args[2]['ids']) == ["1", "2", "404"]
+    write_stub.assert_called_once()
+    written = write_stub.call_args.args[1]
+    assert {results[index]['id'] for index in [0, 1, 2]} <= set(written.to_map())
+    assert "2b8c1f0d8a2d4e0a9c6b3f3e1d2c4b5a" not in written
+    assert written.get("6d0cde4325df4821afd2d71153f4ae06")['timestamp'] == timestamp
+
+def test_batch_events_reports_conflicts_per_item(client, monkeypatch):
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', lambda username: (event_store.UserEvents(), "etag"))
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events',
+                        lambda username, events, etag: (False, (event_store.UserEvents(), "etag")))
+    recipes_stub = Mock()
+    recipes_stub.return_value = {"_id": "1", "name": "test", "tags": []}
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', recipes_stub)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    response = client.post('/api/v1/events/batch', json={"operations": [
+        {"op": "create", "id": "1", "timestamp": int(time.time()) + 86400},
+        {"op": "delete"}
+    ]})
+    assert response.status_code == 200
+    assert [result['status'] for result in response.json['results']] == [409, 400]
+
 ############################################################################################################
 ############################################ DELETE TESTS ##################################################
 ############################################################################################################
@@ -880,34 +1337,43 @@ def test_delete_event_with_auth_and_event_exists(client, monkeypatch):
     client.set_cookie('localhost', 'authToken', token)
 
     events_stub = Mock()
-    events_stub.return_value = {
-        "-NJioAHojZF1Plwd4QC3": {
-        "maribelrb": [
-            {
-                "id": "6d0cde4325df4821afd2d71153f4ae06",
-                "recipe": {"id":"1"},
-                "synced": False,
-                "timestamp": 3471698180
-            },
-            {
-                "id": "612dd6ffb76744a2951ca14e0755d7d7",
-                "recipe": {"id":"1"},
-                "synced": False,
-                "timestamp": 3471698180
-            }
-        ],
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": {"id":"1"},
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": {"id":"1"},
+            "synced": False,
+            "timestamp": 3471698180
         }
-    }
+    ]), "etag")
 
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', events_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
 
     response = client.delete('/api/v1/events/6d0cde4325df4821afd2d71153f4ae06')
     assert response.status_code == 204
 
+def test_delete_event_with_too_many_conflicts(client, monkeypatch):
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    event = {"id": "6d0cde4325df4821afd2d71153f4ae06", "recipe": "1", "synced": False, "timestamp": 3471698180}
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', lambda username: (event_store.UserEvents([event]), "etag"))
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events',
+                        lambda username, events, etag: (False, (event_store.UserEvents([event]), "etag")))
+
+    response = client.delete('/api/v1/events/6d0cde4325df4821afd2d71153f4ae06')
+    assert response.status_code == 409
+    assert response.json == {'message': service.CONFLICT_MESSAGE}
+
 ############################################################################################################
 ############################################ GOOGLE TESTS ##################################################
 ############################################################################################################   
@@ -920,17 +1386,9 @@ def test_post_google_login_with_auth_and_no_users_are_logged(client, monkeypatch
     token = jwt.encode({'username': 'maribelrb', 'plan': 'premium'}, JWT_SECRET, algorithm='HS256')
     client.set_cookie('localhost', 'authToken', token)
 
-    user_get_stub = Mock()
-    user_get_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', user_get_stub)
-
-    post_stub = Mock()
-    post_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.post', post_stub)
-
     put_stub = Mock()
     put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.firebase.put', put_stub)
 
     body = {
         "refreshToken": "refreshToken"
@@ -938,26 +1396,21 @@ def test_post_google_login_with_auth_and_no_users_are_logged(client, monkeypatch
 
     response = client.post('/api/v1/events/sync', json=body)
     assert response.status_code == 200
+    put_stub.assert_called_once_with('/users', 'maribelrb', 'refreshToken')
 
 def test_post_google_login_with_auth_and_users_are_logged(client, monkeypatch):
     token = jwt.encode({'username': 'maribelrb', 'plan': 'premium'}, JWT_SECRET, algorithm='HS256')
     client.set_cookie('localhost', 'authToken', token)
 
     user_get_stub = Mock()
-    user_get_stub.return_value = {
-        "-NL0UNZwgVjJxq0dUxQK": {
-            "javivm17": "refreshToken"
-        }
-    }
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', user_get_stub)
-
-    post_stub = Mock()
-    post_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.post', post_stub)
+    user_get_stub.return_value = None
+    monkeypatch.setattr('flaskr.controller.service.storage.firebase.get', user_get_stub)
 
     put_stub = Mock()
     put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    monkeypatch.setattr('flaskr.controller.service.storage.firebase.put', put_stub)
+
+    assert storage.get_refresh_token('maribelrb') is None
 
     body = {
         "refreshToken": "refreshToken"
@@ -965,6 +1418,8 @@ def test_post_google_login_with_auth_and_users_are_logged(client, monkeypatch):
 
     response = client.post('/api/v1/events/sync', json=body)
     assert response.status_code == 200
+    assert storage.get_refresh_token('maribelrb') == "refreshToken"
+    user_get_stub.assert_called_once_with('/users', 'maribelrb')
 
 def test_post_google_login_with_auth_and_no_refresh_token_provided(client):
     token = jwt.encode({'username': 'maribelrb', 'plan': 'premium'}, JWT_SECRET, algorithm='HS256')
@@ -1006,13 +1461,9 @@ def test_get_google_logout_with_auth_and_no_users_are_logged(client, monkeypatch
     token = jwt.encode({'username': 'maribelrb', 'plan': 'premium'}, JWT_SECRET, algorithm='HS256')
     client.set_cookie('localhost', 'authToken', token)
 
-    user_get_stub = Mock()
-    user_get_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', user_get_stub)
-
-    put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    delete_stub = Mock()
+    delete_stub.return_value = None
+    monkeypatch.setattr('flaskr.controller.service.storage.firebase.delete', delete_stub)
 
     response = client.get('/api/v1/events/logout')
     assert response.status_code == 200
@@ -1022,16 +1473,1180 @@ def test_get_google_logout_with_auth_and_users_are_logged(client, monkeypatch):
     client.set_cookie('localhost', 'authToken', token)
 
     user_get_stub = Mock()
-    user_get_stub.return_value = {
-        "-NL0UNZwgVjJxq0dUxQK": {
-            "javivm17": "refreshToken"
+    user_get_stub.return_value = "refreshToken"
+    monkeypatch.setattr('flaskr.controller.service.storage.firebase.get', user_get_stub)
+
+    delete_stub = Mock()
+    delete_stub.return_value = None
+    monkeypatch.setattr('flaskr.controller.service.storage.firebase.delete', delete_stub)
+
+    assert storage.get_refresh_token('maribelrb') == "refreshToken"
+
+    response = client.get('/api/v1/events/logout')
+    assert response.status_code == 200
+    delete_stub.assert_called_once_with('/users', 'maribelrb')
+    assert storage.get_refresh_token('maribelrb') is None
+    user_get_stub.assert_called_once_with('/users', 'maribelrb')
+
+############################################################################################################
+############################################ STORAGE TESTS #################################################
+############################################################################################################
+
+def test_storage_reads_only_user_node(monkeypatch):
+    from flaskr import storage
+
+    response = Mock()
+    response.status_code = 200
+    response.headers = {'ETag': 'etag'}
+    response.json.return_value = [
+        None,
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        }
+    ]
+    request_stub = Mock()
+    request_stub.return_value = response
+    monkeypatch.setattr('flaskr.storage.database_request', request_stub)
+
+    events, etag = storage.read_events('maribelrb')
+    request_stub.assert_called_once_with('GET', '/events/maribelrb', headers={'X-Firebase-ETag': 'true'})
+    assert [event['id'] for event in events] == ["6d0cde4325df4821afd2d71153f4ae06"]
+    assert etag == 'etag'
+
+def test_storage_filters_events_in_database(monkeypatch):
+    from flaskr import storage
+
+    response = Mock()
+    response.json.return_value = {
+        "6d0cde4325df4821afd2d71153f4ae06": {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
         }
     }
-    monkeypatch.setattr('flaskr.controller.service.firebase.get', user_get_stub)
+    request_stub = Mock()
+    request_stub.return_value = response
+    monkeypatch.setattr('flaskr.storage.database_request', request_stub)
+
+    events = storage.get_events('maribelrb', 3471698000, 3471699000, 10)
+    request_stub.assert_called_once_with('GET', '/events/maribelrb', params={
+        'orderBy': '"timestamp"', 'startAt': 3471698000, 'endAt': 3471699000, 'limitToFirst': 10
+    })
+    assert "6d0cde4325df4821afd2d71153f4ae06" in events
+
+def test_storage_filters_events_itself_without_database_index(monkeypatch):
+    from flaskr import storage
+
+    rejected = Mock(status_code=400, text='Index not defined, add ".indexOn": "timestamp", for path "/events/maribelrb"')
+    everything = Mock(status_code=200, headers={'ETag': 'etag'})
+    everything.json.return_value = {
+        str(number): {"id": str(number), "recipe": "1", "synced": False, "timestamp": 3471698000 + number}
+        for number in range(5)
+    }
+    request_stub = Mock()
+    request_stub.side_effect = [rejected, everything]
+    monkeypatch.setattr('flaskr.storage.database_request', request_stub)
+
+    events = storage.get_events('maribelrb', 3471698001, None, 2)
+    assert [event['id'] for event in events] == ["1", "2"]
+    assert request_stub.call_args.kwargs == {'headers': {'X-Firebase-ETag': 'true'}}
+
+def test_storage_writes_only_user_node_if_unchanged(monkeypatch):
+    from flaskr import storage
+
+    response = Mock()
+    response.status_code = 200
+    request_stub = Mock()
+    request_stub.return_value = response
+    monkeypatch.setattr('flaskr.storage.database_request', request_stub)
+
+    assert storage.write_events('maribelrb', event_store.UserEvents(), 'etag') == (True, None)
+    assert request_stub.call_args_list == [
+        (('PUT', '/events/maribelrb', {}), {'headers': {'if-match': 'etag'}}),
+        (('PUT', '/versions/maribelrb', {'.sv': {'increment': 1}}), {})
+    ]
+
+def test_storage_update_events_retries_on_conflict(monkeypatch):
+    from flaskr import storage
+
+    read_stub = Mock()
+    read_stub.return_value = (event_store.UserEvents(), "etag1")
+    monkeypatch.setattr('flaskr.storage.read_events', read_stub)
+
+    concurrent_event = {
+        "id": "612dd6ffb76744a2951ca14e0755d7d7",
+        "recipe": "1",
+        "synced": False,
+        "timestamp": 3471698180
+    }
+    write_stub = Mock()
+    write_stub.side_effect = [(False, (event_store.UserEvents([concurrent_event]), "etag2")), (True, None)]
+    monkeypatch.setattr('flaskr.storage.write_events', write_stub)
+
+    from prometheus_client import REGISTRY
+    version = storage.local_version('maribelrb')
+    conflicts = REGISTRY.get_sample_value('planner_storage_write_conflicts_total')
+    retries = REGISTRY.get_sample_value('planner_storage_write_retries_total')
+    new_event = {
+        "id": "6d0cde4325df4821afd2d71153f4ae06",
+        "recipe": "1",
+        "synced": False,
+        "timestamp": 3471698180
+    }
+
+    def add_event(events):
+        events.add(new_event)
+        return True, "added"
+
+    assert storage.update_events('maribelrb', add_event) == "added"
+    username, events, etag = write_stub.call_args.args
+    assert (username, list(events), etag) == ('maribelrb', [concurrent_event, new_event], "etag2")
+    # Only the write that went through changes the version
+    assert storage.local_version('maribelrb') == version + 1
+    assert REGISTRY.get_sample_value('planner_storage_write_conflicts_total') == conflicts + 1
+    assert REGISTRY.get_sample_value('planner_storage_write_retries_total') == retries + 1
+
+def test_storage_update_events_gives_up_after_max_attempts(monkeypatch):
+    from flaskr import storage
+
+    monkeypatch.setattr('flaskr.storage.read_events', lambda username: (event_store.UserEvents(), "etag"))
+    monkeypatch.setattr('flaskr.storage.write_events', lambda username, events, etag: (False, (event_store.UserEvents(), "etag")))
+
+    with pytest.raises(storage.ConflictError):
+        storage.update_events('maribelrb', lambda events: (True, None))
+
+def test_storage_migrate_events_layout(monkeypatch):
+    from flaskr import storage
+
+    tree = {
+        "-NJioAHojZF1Plwd4QC3": {
+            "maribelrb": [
+                {
+                    "id": "6d0cde4325df4821afd2d71153f4ae06",
+                    "recipe": "1",
+                    "synced": False,
+                    "timestamp": 3471698180
+                }
+            ],
+            "javivm17": [
+                {
+                    "id": "612dd6ffb76744a2951ca14e0755d7d7",
+                    "recipe": "1",
+                    "synced": False,
+                    "timestamp": 3471698180
+                }
+            ]
+        },
+        "javivm17": [
+            {
+                "id": "612dd6ffb76744a2951ca14e0755d7d7",
+                "recipe": "1",
+                "synced": False,
+                "timestamp": 3471698180
+            }
+        ]
+    }
 
     put_stub = Mock()
-    put_stub.return_value = None
-    monkeypatch.setattr('flaskr.controller.service.firebase.put', put_stub)
+    delete_stub = Mock()
+    monkeypatch.setattr('flaskr.storage.get_events', lambda username: event_store.parse_events(tree.get(username)))
+    monkeypatch.setattr('flaskr.storage.firebase.iter_children', lambda path: iter(tree.items()))
+    monkeypatch.setattr('flaskr.storage.firebase.put', put_stub)
+    monkeypatch.setattr('flaskr.storage.firebase.delete', delete_stub)
+
+    assert storage.migrate_events_layout() == 2
+    written = {call.args[1]: call.args[2] for call in put_stub.call_args_list}
+    assert len(written['maribelrb']) == 1
+    assert len(written['javivm17']) == 1
+    delete_stub.assert_called_once_with('/events', '-NJioAHojZF1Plwd4QC3')
+
+def test_storage_migrate_events_array_layout_to_map(monkeypatch):
+    from flaskr import storage
+
+    event = {
+        "id": "6d0cde4325df4821afd2d71153f4ae06",
+        "recipe": "1",
+        "synced": False,
+        "timestamp": 3471698180
+    }
+    tree = {
+        "maribelrb": [None, event],
+        "javivm17": {"612dd6ffb76744a2951ca14e0755d7d7": dict(event, id="612dd6ffb76744a2951ca14e0755d7d7")}
+    }
+    put_stub = Mock()
+    monkeypatch.setattr('flaskr.storage.firebase.iter_children', lambda path: iter(tree.items()))
+    monkeypatch.setattr('flaskr.storage.firebase.put', put_stub)
+
+    assert storage.migrate_events_layout() == 1
+    put_stub.assert_called_once_with('/events', 'maribelrb', {"6d0cde4325df4821afd2d71153f4ae06": event})
+
+def test_event_store_parses_array_and_map_layouts():
+    events = [
+        {"id": "b", "recipe": "1", "synced": False, "timestamp": 3471698180},
+        {"id": "a", "recipe": "1", "synced": False, "timestamp": 1578243461}
+    ]
+
+    from_array = event_store.parse_events([None] + events)
+    from_indexes = event_store.parse_events({"1": events[0], "3": events[1]})
+    from_map = event_store.parse_events({event['id']: event for event in events})
+
+    for parsed in [from_array, from_indexes, from_map]:
+        assert parsed.to_map() == {"a": events[1], "b": events[0]}
+    assert len(event_store.parse_events(None)) == 0
+
+def test_event_store_keeps_time_index_in_step():
+    events = event_store.UserEvents([
+        {"id": "a", "recipe": "1", "synced": False, "timestamp": 300},
+        {"id": "b", "recipe": "1", "synced": False, "timestamp": 100},
+        {"id": "c", "recipe": "1", "synced": False, "timestamp": 200}
+    ])
+    assert [event['id'] for event in events.between()] == ["b", "c", "a"]
+    assert [event['id'] for event in events.between(150, 300)] == ["c", "a"]
+
+    events.set_timestamp("a", 50)
+    assert events.remove("c")['id'] == "c"
+    assert events.remove("c") is None
+    assert [event['id'] for event in events.between()] == ["a", "b"]
+    assert events.get("a")['timestamp'] == 50
+    assert "c" not in events
+
+def test_storage_migrate_users_layout(monkeypatch):
+    tree = {
+        "-NL0UNZwgVjJxq0dUxQK": {
+            "javivm17": "refreshToken",
+            "maribelrb": "oldRefreshToken"
+        },
+        "maribelrb": "newRefreshToken"
+    }
+    put_stub = Mock()
+    delete_stub = Mock()
+    monkeypatch.setattr('flaskr.storage.firebase.shallow', lambda path: list(tree))
+    monkeypatch.setattr('flaskr.storage.firebase.iter_children', lambda path: iter(tree.items()))
+    monkeypatch.setattr('flaskr.storage.firebase.put', put_stub)
+    monkeypatch.setattr('flaskr.storage.firebase.delete', delete_stub)
+
+    assert storage.migrate_users_layout() == 1
+    put_stub.assert_called_once_with('/users', 'javivm17', 'refreshToken')
+    delete_stub.assert_called_once_with('/users', '-NL0UNZwgVjJxq0dUxQK')
+
+def test_sqlite_storage_rejects_stale_etag(tmp_path):
+    backend = SQLiteStorage(str(tmp_path / 'planner.db'))
+    events, etag = backend.read_events('maribelrb')
+    assert len(events) == 0
+
+    events.add({"id": "a", "recipe": "1", "synced": False, "timestamp": 20})
+    assert backend.write_events('maribelrb', events, etag) == (True, None)
+
+    written, (current, current_etag) = backend.write_events('maribelrb', event_store.UserEvents(), etag)
+    assert not written
+    assert current.get("a")['recipe'] == "1"
+    assert current_etag != etag
+    assert backend.write_events('maribelrb', event_store.UserEvents(), current_etag) == (True, None)
+    assert len(backend.read_events('maribelrb')[0]) == 0
+
+def test_sqlite_storage_filters_events_by_time(tmp_path):
+    backend = SQLiteStorage(str(tmp_path / 'planner.db'))
+    events = event_store.UserEvents(
+        {"id": str(number), "recipe": "1", "synced": False, "timestamp": 100 - number} for number in range(10)
+    )
+    backend.write_events('maribelrb', events, backend.read_events('maribelrb')[1])
+    backend.write_events('javivm17', event_store.UserEvents([{"id": "x", "timestamp": 95}]), '0')
+
+    found = backend.query_events('maribelrb', 93, 98, 3)
+    assert [event['id'] for event in found.between()] == ["7", "6", "5"]
+    assert sorted(backend.list_event_owners()) == ['javivm17', 'maribelrb']
+
+def test_service_runs_on_sqlite_storage(client, tmp_path, monkeypatch):
+    monkeypatch.setattr('flaskr.storage.backend', SQLiteStorage(str(tmp_path / 'planner.db')))
+    recipe = {"_id": "1", "name": "test", "summary": "test", "tags": ["test"]}
+    monkeypatch.setattr('flaskr.controller.service.utils.communicate', Mock(return_value=recipe))
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
 
-    response = client.get('/api/v1/events/logout')
+    response = client.post('/api/v1/events', json={"timestamp": int(time.time()) + 3600, "id": "1"})
+    assert response.status_code == 201
+    response = client.get('/api/v1/events')
+    assert response.status_code == 200
+    assert [event['recipe']['id'] for event in response.json['events']] == ["1"]
+    assert response.json['isLogged'] is False
+
+    storage.put_refresh_token('maribelrb', 'refreshToken')
+    storage.tokens_cache.clear()
+    assert storage.get_refresh_token('maribelrb') == 'refreshToken'
+
+def add_event(event):
+    def mutate(events):
+        events.add(dict(event))
+        return True, event['id']
+    return mutate
+
+def test_write_behind_coalesces_changes_into_one_write(tmp_path, monkeypatch):
+    backend = SQLiteStorage(str(tmp_path / 'planner.db'))
+    monkeypatch.setattr('flaskr.storage.backend', backend)
+    monkeypatch.setattr('flaskr.storage.DURABILITY', 'buffered')
+    monkeypatch.setattr('flaskr.storage.WRITE_BEHIND_WINDOW', 60)
+    monkeypatch.setattr('flaskr.storage.write_buffer', storage.create_write_buffer())
+    write_spy = Mock(wraps=backend.write_events)
+    monkeypatch.setattr('flaskr.storage.backend.write_events', write_spy)
+
+    version = storage.version('maribelrb')
+    for number in range(5):
+        event = {"id": str(number), "recipe": "1", "synced": False, "timestamp": 20 + number}
+        assert storage.update_events('maribelrb', add_event(event)) == str(number)
+    # Not written yet, so only this process sees the change
+    assert storage.version('maribelrb') == (version[0], version[1] + 5)
+    assert len(backend.read_events('maribelrb')[0]) == 0
+    assert [event['id'] for event in storage.get_events('maribelrb', 21, 23, 2)] == ["1", "2"]
+
+    storage.flush_writes()
+    write_spy.assert_called_once()
+    assert len(backend.read_events('maribelrb')[0]) == 5
+    assert storage.write_buffer.stats() == {'mutations': 5, 'writes': 1, 'users': 0}
+
+def test_write_behind_replays_changes_over_concurrent_writes(tmp_path, monkeypatch):
+    backend = SQLiteStorage(str(tmp_path / 'planner.db'))
+    monkeypatch.setattr('flaskr.storage.backend', backend)
+    monkeypatch.setattr('flaskr.storage.DURABILITY', 'buffered')
+    monkeypatch.setattr('flaskr.storage.WRITE_BEHIND_WINDOW', 60)
+    monkeypatch.setattr('flaskr.storage.write_buffer', storage.create_write_buffer())
+
+    storage.update_events('maribelrb', add_event({"id": "a", "recipe": "1", "synced": False, "timestamp": 20}))
+    # Another replica writes in between
+    events, etag = backend.read_events('maribelrb')
+    events.add({"id": "b", "recipe": "2", "synced": False, "timestamp": 30})
+    assert backend.write_events('maribelrb', events, etag) == (True, None)
+
+    storage.flush_writes()
+    assert sorted(event['id'] for event in backend.read_events('maribelrb')[0]) == ["a", "b"]
+
+def test_write_behind_keeps_changes_when_reloading_after_a_write_fails(tmp_path):
+    from flaskr.write_behind import WriteBehind
+
+    backend = SQLiteStorage(str(tmp_path / 'planner.db'))
+    load = Mock(side_effect=[backend.read_events('maribelrb'), Exception('timeout')])
+
+    def store(username, events, etag):
+        if len(events) == 1:
+            # A change arrives while the first write is in flight
+            buffer.update(username, add_event({"id": "b", "recipe": "2", "synced": False, "timestamp": 30}))
+        return backend.write_events(username, events, etag)
+
+    buffer = WriteBehind(60, load, store, lambda username: None, 5)
+    buffer.update('maribelrb', add_event({"id": "a", "recipe": "1", "synced": False, "timestamp": 20}))
+
+    buffer.flush_all()
+    assert sorted(event['id'] for event in backend.read_events('maribelrb')[0]) == ["a", "b"]
+    assert buffer.stats()['users'] == 0
+
+############################################################################################################
+############################################ COMPACTION TESTS ##############################################
+############################################################################################################
+
+def test_compaction_archives_old_events_in_batches(monkeypatch):
+    from flaskr import compaction
+
+    old_events = [
+        {"id": event_id, "recipe": "1", "synced": False, "timestamp": 1578243461}
+        for event_id in ["a", "b", "c"]
+    ]
+    upcoming_event = {"id": "d", "recipe": "1", "synced": False, "timestamp": 3471698180}
+    stored_events = event_store.UserEvents([dict(event) for event in old_events] + [upcoming_event])
+
+    monkeypatch.setattr('flaskr.compaction.BATCH_SIZE', 2)
+    monkeypatch.setattr('flaskr.storage.list_event_owners', lambda: ["maribelrb"])
+    monkeypatch.setattr('flaskr.storage.get_events', lambda username, start=None, end=None, limit=None:
+                        event_store.UserEvents(stored_events.between(start, end)))
+    monkeypatch.setattr('flaskr.storage.read_events', lambda username: (stored_events, "etag"))
+    write_stub = Mock()
+    write_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.storage.write_events', write_stub)
+    archive_stub = Mock()
+    monkeypatch.setattr('flaskr.storage.archive_events', archive_stub)
+
+    report = compaction.run()
+    assert report == {'users': 1, 'events': 3, 'bytes': sum(len(json.dumps(event)) for event in old_events)}
+    assert [list(call.args[1]) for call in archive_stub.call_args_list] == [["a", "b"], ["c"]]
+    write_stub.assert_called_once()
+    assert [event['id'] for event in write_stub.call_args.args[1]] == ["d"]
+
+def test_compaction_keeps_events_moved_to_the_future(monkeypatch):
+    from flaskr import compaction
+
+    old_event = {"id": "a", "recipe": "1", "synced": False, "timestamp": 1578243461}
+    moved_event = dict(old_event, timestamp=3471698180)
+
+    monkeypatch.setattr('flaskr.storage.get_events', lambda username, start=None, end=None, limit=None:
+                        event_store.UserEvents([old_event]))
+    monkeypatch.setattr('flaskr.storage.read_events', lambda username: (event_store.UserEvents([moved_event]), "etag"))
+    write_stub = Mock()
+    monkeypatch.setattr('flaskr.storage.write_events', write_stub)
+    archive_stub = Mock()
+    monkeypatch.setattr('flaskr.storage.archive_events', archive_stub)
+
+    assert compaction.compact_user("maribelrb", int(time.time())) == (0, 0)
+    write_stub.assert_not_called()
+    assert archive_stub.call_args.args == ("maribelrb", {"a": None})
+
+############################################################################################################
+############################################ NOTIFICATIONS TESTS ###########################################
+############################################################################################################
+
+def test_notifications_fan_out_to_every_subscription_of_the_user():
+    from flaskr import notifications
+
+    first = notifications.subscribe(notifications.Subscription('maribelrb'))
+    second = notifications.subscribe(notifications.Subscription('maribelrb'))
+    other = notifications.subscribe(notifications.Subscription('javivm17'))
+    try:
+        notifications.publish('maribelrb', 'created', '1')
+        assert first.get(0) == {'type': 'created', 'id': '1'}
+        assert second.get(0) == {'type': 'created', 'id': '1'}
+        assert other.get(0) is None
+    finally:
+        for subscription in [first, second, other]:
+            notifications.unsubscribe(subscription)
+    assert notifications.subscribers == {}
+
+def test_notifications_replace_backlog_of_slow_subscriptions(monkeypatch):
+    from flaskr import notifications
+
+    monkeypatch.setattr('flaskr.notifications.QUEUE_SIZE', 2)
+    subscription = notifications.subscribe(notifications.Subscription('maribelrb'))
+    try:
+        for event_id in ['1', '2', '3']:
+            notifications.publish('maribelrb', 'updated', event_id)
+        assert subscription.get(0) == notifications.RESYNC
+        assert subscription.get(0) is None
+    finally:
+        notifications.unsubscribe(subscription)
+
+def test_stream_events_without_auth(client):
+    assert client.get('/api/v1/events/stream').status_code == 401
+
+def test_stream_events_receives_deletes(client, monkeypatch):
+    from flaskr import notifications
+
+    events_stub = Mock()
+    events_stub.return_value = (event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        }
+    ]), "etag")
+    monkeypatch.setattr('flaskr.controller.service.storage.read_events', events_stub)
+    put_stub = Mock()
+    put_stub.return_value = (True, None)
+    monkeypatch.setattr('flaskr.controller.service.storage.write_events', put_stub)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    stream = client.get('/api/v1/events/stream', buffered=False)
+    assert stream.status_code == 200
+    assert stream.mimetype == 'text/event-stream'
+    chunks = stream.iter_encoded()
+    assert next(chunks) == b': connected\n\n'
+
+    assert client.delete('/api/v1/events/6d0cde4325df4821afd2d71153f4ae06').status_code == 204
+    assert next(chunks) == b'event: deleted\ndata: {"type": "deleted", "id": "6d0cde4325df4821afd2d71153f4ae06"}\n\n'
+    stream.close()
+    assert notifications.subscribers == {}
+
+def test_stream_events_are_limited_per_worker(client, monkeypatch):
+    from flaskr import notifications
+
+    monkeypatch.setattr('flaskr.notifications.BLOCKING_STREAMS_MAX', 1)
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+
+    stream = client.get('/api/v1/events/stream', buffered=False)
+    assert stream.status_code == 200
+    rejected = client.get('/api/v1/events/stream', buffered=False)
+    assert rejected.status_code == 503
+    assert rejected.headers['Retry-After'] == '30'
+    # Other requests are still served
+    assert client.get('/').status_code == 200
+
+    stream.close()
+    assert notifications.blocking_streams == 0
+    reopened = client.get('/api/v1/events/stream', buffered=False)
+    assert reopened.status_code == 200
+    reopened.close()
+
+def test_broker_relays_messages_between_replicas():
+    from flaskr import broker
+    import threading
+    import queue
+
+    server = broker.Broker(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    received = queue.Queue()
+    publisher = broker.BrokerClient('127.0.0.1', server.server_address[1], lambda message: None)
+    listener = broker.BrokerClient('127.0.0.1', server.server_address[1], received.put)
+    try:
+        publisher.start()
+        listener.start()
+        deadline = time.time() + 5
+        while len(server.clients) < 2 or publisher.connection is None:
+            assert time.time() < deadline
+            time.sleep(0.01)
+        publisher.publish({'username': 'maribelrb', 'message': {'type': 'created', 'id': '1'}})
+        assert received.get(timeout=5) == {'username': 'maribelrb', 'message': {'type': 'created', 'id': '1'}}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+############################################################################################################
+############################################ RECIPE CACHE TESTS ############################################
+############################################################################################################
+
+def test_recipe_cache_hits_after_first_lookup(monkeypatch):
+    recipes_stub = Mock()
+    recipes_stub.return_value = {"_id": "1", "name": "test", "tags": []}
+    monkeypatch.setattr('flaskr.recipes.utils.communicate', recipes_stub)
+
+    assert recipes.get_recipe("1")["_id"] == "1"
+    assert recipes.get_recipes(["1", "1"])["1"]["_id"] == "1"
+    assert recipes_stub.call_count == 1
+    assert recipes.cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+def test_recipe_cache_caches_not_found_recipes(monkeypatch):
+    recipes_stub = Mock()
+    recipes_stub.return_value = None
+    monkeypatch.setattr('flaskr.recipes.utils.communicate', recipes_stub)
+
+    assert recipes.get_recipe("1") is None
+    assert recipes.get_recipe("1") is None
+    assert recipes_stub.call_count == 1
+
+def test_recipe_cache_does_not_cache_failures(monkeypatch):
+    recipes_stub = Mock()
+    recipes_stub.side_effect = [Exception("recipes down"), {"_id": "1"}]
+    monkeypatch.setattr('flaskr.recipes.utils.communicate', recipes_stub)
+
+    with pytest.raises(Exception):
+        recipes.get_recipe("1")
+    assert recipes.get_recipe("1") == {"_id": "1"}
+
+def test_recipe_cache_only_caches_not_found_answers(monkeypatch):
+    from prometheus_client import REGISTRY
+    from flaskr import utils
+    import requests
+    misses = REGISTRY.get_sample_value('planner_cache_lookups_total', {'cache': 'recipes', 'result': 'miss'}) or 0
+    hits = REGISTRY.get_sample_value('planner_cache_lookups_total', {'cache': 'recipes', 'result': 'hit'}) or 0
+
+    session_stub = Mock()
+    session_stub.request.side_effect = [Mock(status_code=503), Mock(status_code=429), Mock(status_code=404)]
+    monkeypatch.setattr('flaskr.utils.get_session', lambda: session_stub)
+    monkeypatch.setattr('flaskr.recipes.utils.communicate', utils.communicate.__wrapped__)
+
+    for attempt in range(2):
+        with pytest.raises(requests.HTTPError):
+            recipes.get_recipe("1")
+    assert recipes.get_recipe("1") is None
+    assert recipes.get_recipe("1") is None
+    assert session_stub.request.call_count == 3
+    assert REGISTRY.get_sample_value('planner_cache_lookups_total', {'cache': 'recipes', 'result': 'miss'}) == misses + 3
+    assert REGISTRY.get_sample_value('planner_cache_lookups_total', {'cache': 'recipes', 'result': 'hit'}) == hits + 1
+
+def test_recipe_cache_expires_entries():
+    from flaskr import utils
+    cache = utils.TTLCache(ttl=10, negative_ttl=10, max_entries=10)
+    cache.set("1", {"_id": "1"})
+    cache.entries["1"] = (0, {"_id": "1"})
+    assert cache.get("1") == (False, None)
+    assert cache.stats()['size'] == 0
+
+def test_recipe_cache_evicts_least_recently_used():
+    from flaskr import utils
+    cache = utils.TTLCache(ttl=10, negative_ttl=10, max_entries=2)
+    cache.set("1", {"_id": "1"})
+    cache.set("2", {"_id": "2"})
+    cache.get("1")
+    cache.set("3", {"_id": "3"})
+    assert list(cache.entries) == ["1", "3"]
+
+############################################################################################################
+############################################ HTTP CLIENT TESTS #############################################
+############################################################################################################
+
+def test_communicate_uses_pooled_session_with_timeouts(monkeypatch):
+    from flaskr import utils
+
+    response = Mock()
+    response.status_code = 200
+    response.json.return_value = {"_id": "1"}
+    session_stub = Mock()
+    session_stub.request.return_value = response
+    monkeypatch.setattr('flaskr.utils.get_session', lambda: session_stub)
+
+    # Bypass the circuit breaker, which earlier tests may have opened
+    assert utils.communicate.__wrapped__('GET', 'http://recipes/api/v1/recipes/1') == {"_id": "1"}
+    session_stub.request.assert_called_once_with(
+        'GET', 'http://recipes/api/v1/recipes/1',
+        timeout=(utils.HTTP_CONNECT_TIMEOUT, utils.HTTP_READ_TIMEOUT))
+
+def test_sessions_share_connection_pool():
+    from flaskr import utils
+    import threading
+
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(utils.get_session()))
+    thread.start()
+    thread.join()
+
+    assert sessions[0] is not utils.get_session()
+    assert sessions[0].get_adapter('http://recipes') is utils.get_session().get_adapter('http://recipes')
+    assert utils.adapter.max_retries.total == utils.HTTP_RETRIES
+
+def test_firebase_client_decodes_large_nodes_child_by_child():
+    from flaskr import firebase_client
+
+    tree = {
+        "maribelrb": {"a": {"id": "a", "recipe": "1", "synced": False, "timestamp": 3471698180}},
+        "javivm17": None,
+        "ñu": [1.5, "x,y}", {"nested": [True, False]}],
+        "count": 1234567
+    }
+    text = json.dumps(tree, ensure_ascii=False)
+    for size in [1, 3, 7, len(text)]:
+        chunks = [text[start:start + size] for start in range(0, len(text), size)]
+        assert list(firebase_client.iter_members(chunks)) == list(tree.items())
+    assert list(firebase_client.iter_members(['nu', 'll'])) == []
+    assert list(firebase_client.iter_members(['[null, {"id": "a"}]'])) == [("1", {"id": "a"})]
+
+def test_firebase_client_decodes_numbers_split_between_chunks():
+    from flaskr import firebase_client
+    import random
+
+    assert list(firebase_client.iter_members(['{"a": 1.', '5}'])) == [("a", 1.5)]
+    assert list(firebase_client.iter_members(['{"a": 1e', '3}'])) == [("a", 1000.0)]
+    assert list(firebase_client.iter_members(['{"a": -', '2.5E', '-', '1, "b": 7}'])) == [("a", -0.25), ("b", 7)]
+
+    tree = {str(number): [number * 1.25, -number, number * 1e-7, {"t": 3471698180 + number}] for number in range(50)}
+    text = json.dumps(tree)
+    chooser = random.Random(0)
+    for attempt in range(20):
+        cuts = sorted(chooser.sample(range(1, len(text)), 200))
+        chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+        assert dict(firebase_client.iter_members(chunks)) == tree
+
+def test_firebase_client_opens_circuit_on_server_errors(monkeypatch):
+    from flaskr import firebase_client
+    from circuitbreaker import CircuitBreakerError
+    import requests
+    monkeypatch.setattr(firebase_client.firebase_circuit, '_state', 'closed')
+    monkeypatch.setattr(firebase_client.firebase_circuit, '_failure_count', 0)
+
+    response = Mock()
+    response.status_code = 503
+    response.raise_for_status.side_effect = requests.HTTPError('503 Service Unavailable')
+    session_stub = Mock()
+    session_stub.request.return_value = response
+    client = firebase_client.FirebaseClient('https://planner.firebaseio.com/')
+    monkeypatch.setattr(client, 'session', lambda: session_stub)
+
+    for attempt in range(3):
+        with pytest.raises(requests.HTTPError):
+            client.get('/users', 'maribelrb')
+    with pytest.raises(CircuitBreakerError):
+        client.get('/users', 'maribelrb')
+    assert session_stub.request.call_count == 3
+    session_stub.request.assert_called_with(
+        'GET', 'https://planner.firebaseio.com/users/maribelrb.json', json=None, headers=None, params=None,
+        timeout=(firebase_client.FIREBASE_CONNECT_TIMEOUT, firebase_client.FIREBASE_READ_TIMEOUT), stream=False)
+
+############################################################################################################
+############################################ METRICS TESTS #################################################
+############################################################################################################
+
+def test_metrics_record_request_latency_per_route(client):
+    from prometheus_client import REGISTRY
+    labels = {'method': 'GET', 'route': '/api/v1/events', 'status': '401'}
+    before = REGISTRY.get_sample_value('planner_request_duration_seconds_count', labels) or 0
+
+    client.get('/api/v1/events')
+    response = client.get('/metrics')
     assert response.status_code == 200
+    assert REGISTRY.get_sample_value('planner_request_duration_seconds_count', labels) == before + 1
+    assert b'planner_circuit_breaker_state{name="communicate",state="closed"}' in response.data
+
+def test_metrics_count_dependency_errors(monkeypatch):
+    from prometheus_client import REGISTRY
+    from flaskr import utils
+    labels = {'dependency': 'recipes', 'operation': 'GET'}
+    before = REGISTRY.get_sample_value('planner_dependency_errors_total', labels) or 0
+
+    session_stub = Mock()
+    session_stub.request.side_effect = [Exception("recipes down"), Mock(status_code=503)]
+    monkeypatch.setattr('flaskr.utils.get_session', lambda: session_stub)
+
+    with pytest.raises(Exception):
+        utils.communicate.__wrapped__('GET', 'http://recipes/api/v1/recipes/1')
+    assert utils.communicate.__wrapped__('GET', 'http://recipes/api/v1/recipes/1') is None
+    assert REGISTRY.get_sample_value('planner_dependency_errors_total', labels) == before + 2
+
+def test_metrics_create_multiprocess_directory_outside_gunicorn(tmp_path):
+    import subprocess
+    import sys
+    metrics_dir = tmp_path / 'metrics'
+    environment = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(metrics_dir))
+    code = 'from flaskr import create_app; print(create_app().test_client().get("/metrics").status_code)'
+
+    result = subprocess.run([sys.executable, '-c', code], env=environment, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.stdout.strip() == '200', result.stderr
+    assert metrics_dir.is_dir()
+
+############################################################################################################
+############################################ TRACING TESTS #################################################
+############################################################################################################
+
+def test_tracing_spans_cover_dependencies_of_a_request(client, monkeypatch):
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+    from flaskr import firebase_client
+    from flaskr import tracing
+    from flaskr import utils
+    monkeypatch.setattr('flaskr.tracing.tracer', tracing.tracer)
+    monkeypatch.setattr('flaskr.tracing.provider', tracing.provider)
+    exporter = InMemorySpanExporter()
+    tracing.configure(SimpleSpanProcessor(exporter))
+    # Earlier tests may have opened the circuit breakers
+    monkeypatch.setattr(utils.communicate_circuit, '_state', 'closed')
+    monkeypatch.setattr(firebase_client.firebase_circuit, '_state', 'closed')
+
+    events = Mock(status_code=200)
+    events.json.return_value = {"1": {"id": "1", "recipe": "1", "synced": False, "timestamp": 3471698180}}
+    recipe = Mock(status_code=200)
+    recipe.json.return_value = {"_id": "1", "name": "test", "tags": []}
+    session_stub = Mock()
+    session_stub.request.side_effect = [events, recipe]
+    monkeypatch.setattr('flaskr.utils.get_session', lambda: session_stub)
+    monkeypatch.setattr('flaskr.storage.firebase.session', lambda: session_stub)
+    monkeypatch.setattr('flaskr.storage.firebase.get', Mock(return_value=None))
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    client.set_cookie('localhost', 'authToken', token)
+    response = client.get('/api/v1/events')
+    assert response.status_code == 200
+
+    spans = {span.name: span for span in exporter.get_finished_spans()}
+    assert set(spans) == {'GET /api/v1/events', 'firebase GET', 'recipes GET'}
+    request_span = spans['GET /api/v1/events']
+    assert request_span.attributes['http.response.status_code'] == 200
+    for name in ('firebase GET', 'recipes GET'):
+        assert spans[name].parent.span_id == request_span.context.span_id
+    traceparent = session_stub.request.call_args_list[1][1]['headers']['traceparent']
+    assert traceparent.split('-')[1] == format(request_span.context.trace_id, '032x')
+
+############################################################################################################
+############################################ RECIPES SERVICE TESTS #########################################
+############################################################################################################
+
+@pytest.fixture
+def recipes_server(monkeypatch):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from flaskr import utils
+    import threading
+    import time
+
+    server_state = {'requests': 0, 'batch_status': 200}
+
+    class RecipesHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            server_state['requests'] += 1
+            time.sleep(0.2)
+            self.reply(200, {"_id": self.path.rsplit('/', 1)[-1], "name": "test", "tags": []})
+
+        def do_POST(self):
+            server_state['requests'] += 1
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            time.sleep(0.2)
+            if server_state['batch_status'] != 200:
+                return self.reply(server_state['batch_status'], {"message": "Unavailable"})
+            self.reply(200, [{"_id": recipe_id, "name": "test", "tags": []} for recipe_id in body['ids']])
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RecipesHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr('flaskr.recipes.RECIPES_URL', f'http://127.0.0.1:{server.server_port}')
+    # Earlier tests may have opened the circuit breaker against http://recipes
+    monkeypatch.setattr('flaskr.recipes.utils.communicate', utils.communicate.__wrapped__)
+    yield server_state
+    server.shutdown()
+    server.server_close()
+
+def lookup_concurrently(recipe_ids, users):
+    import threading
+
+    results = []
+    barrier = threading.Barrier(users)
+
+    def lookup():
+        barrier.wait()
+        results.append(recipes.get_recipes(recipe_ids))
+
+    threads = [threading.Thread(target=lookup) for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_recipes_are_fetched_in_one_batch_shared_by_concurrent_users(recipes_server):
+    results = lookup_concurrently(["1", "2", "3"], users=10)
+
+    assert recipes_server['requests'] == 1
+    assert all(result["3"]["_id"] == "3" for result in results)
+
+def test_recipes_fall_back_to_single_lookups_without_batch_endpoint(recipes_server):
+    recipes_server['batch_status'] = 404
+    results = lookup_concurrently(["1", "2", "3"], users=10)
+
+    assert recipes_server['requests'] == 4
+    assert all(result["2"]["_id"] == "2" for result in results)
+
+    recipes.cache.clear()
+    recipes.get_recipes(["1", "2"])
+    assert recipes_server['requests'] == 6
+
+def test_recipes_batch_errors_fail_the_lookup_without_disabling_the_batch_endpoint(recipes_server):
+    import requests
+
+    recipes_server['batch_status'] = 503
+    with pytest.raises(requests.HTTPError):
+        recipes.get_recipes(["1", "2", "3"])
+
+    assert recipes_server['requests'] == 1
+    assert recipes.batch_unavailable_until == 0
+    assert recipes.cache.get("1") == (False, None)
+
+############################################################################################################
+############################################ GOOGLE CLIENT TESTS ###########################################
+############################################################################################################
+
+@pytest.fixture
+def google_token_server(monkeypatch):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    server_state = {'refreshes': 0}
+
+    class TokenHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            server_state['refreshes'] += 1
+            payload = json.dumps({"access_token": "accessToken", "expires_in": 3600, "token_type": "Bearer"}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TokenHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr('flaskr.google_calendar.TOKEN_URI', f'http://127.0.0.1:{server.server_port}/token')
+    monkeypatch.setenv('CLIENT_ID', 'clientId')
+    monkeypatch.setenv('CLIENT_SECRET', 'clientSecret')
+    yield server_state
+    server.shutdown()
+    server.server_close()
+
+def test_google_calendar_client_refreshes_once_per_expiry_window(google_token_server):
+    import datetime
+
+    with google_calendar.calendar_service('maribelrb', 'refreshToken') as service:
+        first_service = service
+    with google_calendar.calendar_service('maribelrb', 'refreshToken') as service:
+        assert service is first_service
+    assert google_token_server['refreshes'] == 1
+
+    client = google_calendar.clients['maribelrb']
+    client.credentials.expiry = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    with google_calendar.calendar_service('maribelrb', 'refreshToken') as service:
+        assert service is first_service
+    assert google_token_server['refreshes'] == 2
+
+def test_google_calendar_client_is_rebuilt_after_login_with_new_token(google_token_server):
+    with google_calendar.calendar_service('maribelrb', 'refreshToken') as service:
+        first_service = service
+    with google_calendar.calendar_service('maribelrb', 'otherRefreshToken') as service:
+        assert service is not first_service
+    assert google_token_server['refreshes'] == 2
+
+def test_google_calendar_clients_are_bounded(google_token_server, monkeypatch):
+    monkeypatch.setattr('flaskr.google_calendar.CLIENTS_CACHE_SIZE', 2)
+    for username in ['maribelrb', 'javivm17', 'user_test']:
+        with google_calendar.calendar_service(username, 'refreshToken'):
+            pass
+    assert list(google_calendar.clients) == ['javivm17', 'user_test']
+
+############################################################################################################
+############################################ WSGI TESTS ####################################################
+############################################################################################################
+
+def test_wsgi_worker_init_replaces_connection_pools():
+    from flaskr import wsgi, utils
+
+    parent_adapter = utils.adapter
+    parent_session = utils.get_session()
+    wsgi.init_clients()
+
+    assert utils.adapter is not parent_adapter
+    assert utils.get_session() is not parent_session
+    assert utils.get_session().get_adapter('https://example.com') is utils.adapter
+
+def test_wsgi_warm_up_without_database(monkeypatch):
+    from flaskr import wsgi
+
+    ping_stub = Mock()
+    ping_stub.side_effect = Exception("unreachable")
+    monkeypatch.setattr('flaskr.wsgi.storage.ping', ping_stub)
+
+    wsgi.warm_up()
+    assert ping_stub.call_count == 1
+    assert google_calendar.discovery_document is not None
+
+############################################################################################################
+############################################ ASGI TESTS ####################################################
+############################################################################################################
+
+def test_asgi_health():
+    from flaskr.asgi import create_asgi_app
+    import asyncio
+
+    async def request():
+        return await create_asgi_app().test_client().get('/')
+
+    response = asyncio.run(request())
+    assert response.status_code == 200
+
+def test_asgi_get_events_without_auth():
+    from flaskr.asgi import create_asgi_app
+    import asyncio
+
+    async def request():
+        return await create_asgi_app().test_client().get('/api/v1/events')
+
+    response = asyncio.run(request())
+    assert response.status_code == 401
+
+def test_asgi_get_events_with_auth(monkeypatch):
+    from flaskr.asgi import create_asgi_app
+    from unittest.mock import AsyncMock
+    import asyncio
+
+    events_stub = AsyncMock()
+    events_stub.return_value = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        },
+        {
+            "id": "612dd6ffb76744a2951ca14e0755d7d7",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 1578243461
+        }
+    ])
+    logged_in_stub = AsyncMock()
+    logged_in_stub.return_value = "auth_token"
+    recipes_stub = AsyncMock()
+    recipes_stub.return_value = {"_id": "1", "name": "test", "summary": "test", "tags": ["test"]}
+
+    monkeypatch.setattr('flaskr.async_service.read_events', events_stub)
+    monkeypatch.setattr('flaskr.async_service.check_user_logged_in', logged_in_stub)
+    monkeypatch.setattr('flaskr.async_service.communicate', recipes_stub)
+    monkeypatch.setattr('flaskr.async_service.read_version', AsyncMock(return_value=(0, 0)))
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+
+    async def request():
+        response = await create_asgi_app().test_client().get('/api/v1/events', headers={'Cookie': f'authToken={token}'})
+        return response.status_code, await response.get_json()
+
+    status_code, body = asyncio.run(request())
+    assert status_code == 200
+    assert body['isLogged'] == True
+    assert [event['id'] for event in body['events']] == ["6d0cde4325df4821afd2d71153f4ae06"]
+
+def test_asgi_get_events_is_served_uncached_when_the_version_cannot_be_read(monkeypatch):
+    from flaskr.asgi import create_asgi_app
+    from unittest.mock import AsyncMock
+    import asyncio
+
+    events_stub = AsyncMock()
+    events_stub.return_value = event_store.UserEvents()
+    monkeypatch.setattr('flaskr.async_service.read_events', events_stub)
+    monkeypatch.setattr('flaskr.async_service.check_user_logged_in', AsyncMock(return_value=None))
+    monkeypatch.setattr('flaskr.async_service.firebase_get', AsyncMock(side_effect=Exception('Permission denied')))
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+
+    async def requests():
+        client = create_asgi_app().test_client()
+        first = await client.get('/api/v1/events', headers={'Cookie': f'authToken={token}'})
+        headers = {'Cookie': f'authToken={token}', 'If-None-Match': first.headers['ETag']}
+        second = await client.get('/api/v1/events', headers=headers)
+        return first.status_code, second.status_code
+
+    assert asyncio.run(requests()) == (200, 200)
+    assert events_stub.call_count == 2
+
+def test_asgi_get_events_with_auth_and_fail_to_connect_with_recipes(monkeypatch):
+    from flaskr.asgi import create_asgi_app
+    from unittest.mock import AsyncMock
+    import asyncio
+
+    events_stub = AsyncMock()
+    events_stub.return_value = event_store.UserEvents([
+        {
+            "id": "6d0cde4325df4821afd2d71153f4ae06",
+            "recipe": "1",
+            "synced": False,
+            "timestamp": 3471698180
+        }
+    ])
+    logged_in_stub = AsyncMock()
+    logged_in_stub.return_value = None
+    recipes_stub = AsyncMock()
+    recipes_stub.side_effect = Exception("recipes down")
+
+    monkeypatch.setattr('flaskr.async_service.read_events', events_stub)
+    monkeypatch.setattr('flaskr.async_service.check_user_logged_in', logged_in_stub)
+    monkeypatch.setattr('flaskr.async_service.communicate', recipes_stub)
+    monkeypatch.setattr('flaskr.async_service.read_version', AsyncMock(return_value=(0, 0)))
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+
+    async def request():
+        response = await create_asgi_app().test_client().get('/api/v1/events', headers={'Cookie': f'authToken={token}'})
+        return response.status_code, await response.get_json()
+
+    status_code, body = asyncio.run(request())
+    assert status_code == 500
+    assert body['message'] == 'Failed to communicate with recipes service'
+
+def test_asgi_create_event_uses_sync_service(monkeypatch):
+    from flaskr.asgi import create_asgi_app
+    import asyncio
+
+    create_stub = Mock()
+    create_stub.return_value = (True, "Created event successfully")
+    monkeypatch.setattr('flaskr.async_service.service.create_event', create_stub)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+    body = {
+        "timestamp": int(time.time()) + 86400,
+        "id": "1"
+    }
+
+    async def request():
+        return await create_asgi_app().test_client().post('/api/v1/events', json=body, headers={'Cookie': f'authToken={token}'})
+
+    response = asyncio.run(request())
+    assert response.status_code == 201
+    create_stub.assert_called_once_with('maribelrb', body)
+
+def test_asgi_delete_event_with_too_many_conflicts(monkeypatch):
+    from flaskr.asgi import create_asgi_app
+    import asyncio
+
+    delete_stub = Mock()
+    delete_stub.return_value = (False, service.CONFLICT_MESSAGE, 409)
+    monkeypatch.setattr('flaskr.async_service.service.delete_event', delete_stub)
+
+    token = jwt.encode({'username': 'maribelrb', 'plan': 'base'}, JWT_SECRET, algorithm='HS256')
+
+    async def request():
+        return await create_asgi_app().test_client().delete('/api/v1/events/1', headers={'Cookie': f'authToken={token}'})
+
+    response = asyncio.run(request())
+    assert response.status_code == 409
+    delete_stub.assert_called_once_with('maribelrb', '1')
+
+def test_asgi_recipe_lookups_survive_the_cancelled_request_that_started_them(monkeypatch):
+    from flaskr import async_service
+    import asyncio
+
+    recipes.cache.clear()
+
+    async def lookups():
+        release = asyncio.Event()
+
+        async def fetch_recipes(recipe_ids):
+            await release.wait()
+            return {recipe_id: {"_id": recipe_id} for recipe_id in recipe_ids}
+        monkeypatch.setattr('flaskr.async_service.fetch_recipes', fetch_recipes)
+
+        owner = asyncio.ensure_future(async_service.get_recipes(["1", "2"]))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(async_service.get_recipes(["1", "2"]))
+        await asyncio.sleep(0)
+        # The client of the first request disconnects
+        owner.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await waiter
+
+    assert asyncio.run(lookups()) == {"1": {"_id": "1"}, "2": {"_id": "2"}}
+    assert recipes.cache.get("1") == (True, {"_id": "1"})
+
+def test_asgi_recipes_are_fetched_once_for_concurrent_requests(recipes_server, monkeypatch):
+    from flaskr import async_service
+    from circuitbreaker import CircuitBreaker
+    import asyncio
+
+    monkeypatch.setattr('flaskr.utils.communicate_circuit', CircuitBreaker(failure_threshold=3, recovery_timeout=10))
+
+    async def lookups():
+        try:
+            return await asyncio.gather(*[async_service.get_recipes(["1", "2", "3"]) for _ in range(50)])
+        finally:
+            await async_service.close_client()
+
+    results = asyncio.run(lookups())
+    assert recipes_server['requests'] == 1
+    assert all(result["2"]["_id"] == "2" for result in results)
+
+def test_asgi_recipes_batch_errors_fail_the_lookup_without_disabling_the_batch_endpoint(recipes_server, monkeypatch):
+    from flaskr import async_service
+    from circuitbreaker import CircuitBreaker
+    import asyncio
+    import httpx
+
+    monkeypatch.setattr('flaskr.utils.communicate_circuit', CircuitBreaker(failure_threshold=3, recovery_timeout=10))
+    recipes_server['batch_status'] = 503
+
+    async def lookup():
+        try:
+            return await async_service.get_recipes(["1", "2", "3"])
+        finally:
+            await async_service.close_client()
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(lookup())
+    assert recipes_server['requests'] == 1
+    assert recipes.batch_unavailable_until == 0